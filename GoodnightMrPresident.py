@@ -8,28 +8,55 @@ import math
 from math import ceil
 
 import appdirs
+import assets
 import bacon
+import combat
+import drawbatch
+import gamedata
+import hotreload
+import profiling
+import questscript
+import random
+import replay
+import spriteindex
+import textcache
 import tiled
+import uipanel
 import optparse
-import random
 import cPickle as pickle
+import time
+import traceback
 
 from common import Rect, clamp
-
-font_tiny = bacon.Font(bacon.get_resource_path('res/tinyfont.ttf'), 12)
-font_tiny.height = font_tiny.descent - font_tiny.ascent
-
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/combat-tiles.png'))
-end_image = tiled.Tileset.get_cached_image(bacon.get_resource_path('res/end.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/props.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/sprites.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/tiles_act1.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/tiles_act2.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/tiles_act2p2.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/tiles_act3.png'))
-tiled.Tileset.get_cached_image(bacon.get_resource_path('res/tiles_basement.png'))
-title_image = tiled.Tileset.get_cached_image(bacon.get_resource_path('res/title.png'))
-ui_image = tiled.Tileset.get_cached_image(bacon.get_resource_path('res/ui.png'))
+from combat import Slot, ItemAttack, Character, add_attack_to_itemattack_list
+
+# Loaded on first use, see assets.py
+font_tiny = assets.font('res/tinyfont.ttf', 12)
+end_image = assets.image('res/end.png')
+title_image = assets.image('res/title.png')
+ui_image = assets.image('res/ui.png')
+
+# Maps grouped by act, in the order the story reaches them; while on a map the
+# textures of the next act are prefetched
+map_acts = [
+    ['title'],
+    ['act1'],
+    ['act2'],
+    ['hotel_ground', 'hotel_l1', 'hotel_l2', 'hotel_basement'],
+    ['act3', 'act3_basement'],
+    ['end'],
+]
+
+def get_next_act_textures(map_id):
+    for i, act in enumerate(map_acts[:-1]):
+        if map_id in act:
+            textures = []
+            for next_map_id in map_acts[i + 1]:
+                for path in tiled.get_map_textures('res/' + next_map_id + '.tmx'):
+                    if path not in textures:
+                        textures.append(path)
+            return textures
+    return []
 
 bacon.window.width = 640
 bacon.window.height = 480
@@ -44,17 +71,6 @@ ui_scale = 4
 ui_width = bacon.window.width
 ui_height = bacon.window.height
 
-def weighted_choice(seq, weight_key):
-    total = sum(weight_key(c) for c in seq)
-    r = random.uniform(0, total)
-    upto = 0
-    for c in seq:
-        w = weight_key(c)
-        if upto + w > r:
-            return c
-        upto += w
-    return seq[-1]
-
 def map_to_ui(x, y):
     return (x * map_scale, y * map_scale)
 
@@ -62,28 +78,23 @@ def open_res(path, mode='rb'):
     return open(bacon.get_resource_path(path), mode)
 
 class Sprite(object):
-    name = '??'
-    effect_dead = False
-    script_index = 0
-    properties = {}
+    __slots__ = ['image', 'x', 'y', 'name', 'effect_dead', 'script_index', 'properties']
 
     def __init__(self, image, x, y):
         self.image = image
         self.x = x
         self.y = y
-       
-class Slot(object):
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.character = None
-        self.sprite = None
+        self.name = '??'
+        self.effect_dead = False
+        self.script_index = 0
+        self.properties = {}
+
 
 class UI(object):
     def __init__(self):
         self.ts = 4
-        self.font = font_tiny
-        self.image = ui_image
+        self.font = font_tiny.get()
+        self.image = ui_image.get()
         self.stat_border = self.get_border_tiles(0)
         self.stat_border_disabled = self.get_border_tiles(3)
         self.stat_border_active = self.get_border_tiles(6)
@@ -103,6 +114,8 @@ class UI(object):
         self.info_arrow = self.get_tile_2x(15)
         self.health_background_image = self.get_tile(58)
         self.health_image = self.get_tile(59)
+        self.hud_panel = uipanel.RetainedPanel(self.draw_hud_panel)
+        self.stat_panels = [uipanel.RetainedPanel(self.draw_stat_panel) for i in range(4)]
 
     def get_border_tiles(self, index):
         return [self.get_tile(index + i) for i in [0, 1, 2, 16, 17, 18, 32, 33, 34]]
@@ -111,13 +124,13 @@ class UI(object):
         ts = self.ts
         x = i % 16
         y = i / 16
-        return self.image.get_region(x * ts, y * ts, (x + 1) * ts, (y + 1) * ts)
+        return drawbatch.set_atlas(self.image.get_region(x * ts, y * ts, (x + 1) * ts, (y + 1) * ts), self.image)
 
     def get_tile_2x(self, i):
         ts = self.ts * 2
         x = i % 8
         y = i / 8
-        return self.image.get_region(x * ts, y * ts, (x + 1) * ts, (y + 1) * ts)
+        return drawbatch.set_atlas(self.image.get_region(x * ts, y * ts, (x + 1) * ts, (y + 1) * ts), self.image)
 
     def align_rect(self, rect):
         tx = ceil(rect.width / self.ts)
@@ -143,39 +156,40 @@ class UI(object):
         x2 = rect.x2 / ui_scale
         y2 = rect.y2 / ui_scale
 
+        batch = drawbatch.batch
+
         # corners
-        bacon.draw_image(border_tiles[0], x1 - ts, y1 - ts)
-        bacon.draw_image(border_tiles[2], x2, y1 - ts)
-        bacon.draw_image(border_tiles[6], x1 - ts, y2)
-        bacon.draw_image(border_tiles[8], x2, y2)
+        batch.add(border_tiles[0], x1 - ts, y1 - ts)
+        batch.add(border_tiles[2], x2, y1 - ts)
+        batch.add(border_tiles[6], x1 - ts, y2)
+        batch.add(border_tiles[8], x2, y2)
 
         # top/bottom
-        bacon.draw_image(border_tiles[1], x1, y1 - ts, x2, y1)
-        bacon.draw_image(border_tiles[7], x1, y2, x2, y2 + ts)
+        batch.add(border_tiles[1], x1, y1 - ts, x2, y1)
+        batch.add(border_tiles[7], x1, y2, x2, y2 + ts)
 
         # left/right
-        bacon.draw_image(border_tiles[3], x1 - ts, y1, x1, y2)
-        bacon.draw_image(border_tiles[5], x2, y1, x2 + ts, y2)
+        batch.add(border_tiles[3], x1 - ts, y1, x1, y2)
+        batch.add(border_tiles[5], x2, y1, x2 + ts, y2)
 
         # fill
-        bacon.draw_image(border_tiles[4], x1, y1, x2, y2)
+        batch.add(border_tiles[4], x1, y1, x2, y2)
 
+        batch.flush()
         bacon.pop_transform()
 
     def draw_image(self, image, x, y):
         bacon.draw_image(image, x, y, x + image.width * ui_scale, y + image.height * ui_scale)
 
     def draw_speech_box(self, text, speaker_x, speaker_y):
-        width = min(self.font.measure_string(text), ui_width / 2)
+        width = min(textcache.measure_string(self.font, text), ui_width / 2)
         x1 = max(0, min(speaker_x, ui_width - width - 16))
         x2 = x1 + width
         y2 = speaker_y - 28
 
-        style = bacon.Style(self.font)
-        run = bacon.GlyphRun(style, text)
-        glyph_layout = bacon.GlyphLayout([run], x1, y2, width, None, bacon.Alignment.left, bacon.VerticalAlignment.bottom)
+        glyph_layout = textcache.get_layout(self.font, text, width, None, bacon.Alignment.left, bacon.VerticalAlignment.bottom)
         if glyph_layout.content_width < 48:
-            glyph_layout = bacon.GlyphLayout([run], x1, y2, 48, None, bacon.Alignment.center, bacon.VerticalAlignment.bottom)
+            glyph_layout = textcache.get_layout(self.font, text, 48, None, bacon.Alignment.center, bacon.VerticalAlignment.bottom)
         y1 = y2 - glyph_layout.content_height - 8 # HACK workaround
         x2 = x1 + max(glyph_layout.content_width, 48)
 
@@ -183,35 +197,31 @@ class UI(object):
         self.draw_image(self.speech_point, speaker_x + 16, y2)
 
         bacon.set_color(0, 0, 0, 1)
-        bacon.draw_glyph_layout(glyph_layout)
+        textcache.draw_layout(glyph_layout, x1, y2)
         bacon.set_color(1, 1, 1, 1)
 
     def draw_info_box(self, text, speaker_x, speaker_y):
-        width = min(self.font.measure_string(text), 250, ui_width - speaker_x - 16)
+        width = min(textcache.measure_string(self.font, text), 250, ui_width - speaker_x - 16)
         x1 = speaker_x
         x2 = x1 + width
         y1 = speaker_y
 
-        style = bacon.Style(self.font)
-        run = bacon.GlyphRun(style, text)
-        glyph_layout = bacon.GlyphLayout([run], x1, y1, width, None, bacon.Alignment.left, bacon.VerticalAlignment.top)
+        glyph_layout = textcache.get_layout(self.font, text, width, None, bacon.Alignment.left, bacon.VerticalAlignment.top)
         if y1 + glyph_layout.content_height > ui_height - 116:
-            glyph_layout.y = y1 = ui_height - 116 - glyph_layout.content_height
+            y1 = ui_height - 116 - glyph_layout.content_height
         y2 = y1 + glyph_layout.content_height
         x2 = x1 + glyph_layout.content_width
 
         self.draw_box(Rect(x1, y1, x2, y2), self.info_border)
         self.draw_image(self.info_arrow, x1 - 32, speaker_y)
-        bacon.draw_glyph_layout(glyph_layout)
+        textcache.draw_layout(glyph_layout, x1, y1)
 
     def draw_message_box(self, text):
-        width = min(self.font.measure_string(text), ui_width / 3)
+        width = min(textcache.measure_string(self.font, text), ui_width / 3)
         cx = ui_width / 2
         cy = ui_height / 2 - 32
 
-        style = bacon.Style(self.font)
-        run = bacon.GlyphRun(style, text)
-        glyph_layout = bacon.GlyphLayout([run], cx - width / 2, cy, width, None, bacon.Alignment.center, bacon.VerticalAlignment.center)
+        glyph_layout = textcache.get_layout(self.font, text, width, None, bacon.Alignment.center, bacon.VerticalAlignment.center)
         y1 = cy - glyph_layout.content_height / 2
         y2 = cy + glyph_layout.content_height / 2
         x1 = cx - glyph_layout.content_width / 2
@@ -220,29 +230,56 @@ class UI(object):
         self.draw_box(Rect(x1, y1, x2, y2))
 
         bacon.set_color(0, 0, 0, 1)
-        bacon.draw_glyph_layout(glyph_layout)
+        textcache.draw_layout(glyph_layout, cx - width / 2, cy)
         bacon.set_color(1, 1, 1, 1)
 
     def draw_text_box(self, text, x, y, border_tiles):
-        width = self.font.measure_string(text) + 8
+        width = textcache.measure_string(self.font, text) + 8
         x1 = x - width / 2
         y1 = y - self.font.height
         x2 = x + width / 2
         y2 = y
         self.draw_box(Rect(x1, y1, x2, y2), border_tiles)
-        bacon.draw_string(self.font, text, x1 + 4, y1, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(self.font, text, x1 + 4, y1, vertical_align = bacon.VerticalAlignment.top)
+
+    def get_box_bounds(self, rect):
+        # Screen rectangle covered by draw_box, including the border
+        border = self.ts * ui_scale
+        return (rect.x1 - border, rect.y1 - border, rect.x2 + border, rect.y2 + border)
+
+    def draw_hud_panel(self, quest_name, room_name, money):
+        self.draw_box(Rect(0, 0, ui_width, self.font.height), self.stat_border)
+        textcache.draw_string(debug.font, quest_name, 0, 0, align=bacon.Alignment.left, vertical_align=bacon.VerticalAlignment.top)
+        textcache.draw_string(debug.font, room_name, ui_width / 2, 0, align=bacon.Alignment.center, vertical_align=bacon.VerticalAlignment.top)
+        textcache.draw_string(debug.font, '$%d' % money, ui_width, 0, align=bacon.Alignment.right, vertical_align=bacon.VerticalAlignment.top)
+
+    def draw_stat_panel(self, rect, border, name, level, xp, next_xp, votes, max_votes, spin, max_spin):
+        padding = 4
+        line_height = self.font.height
+        x1, y1, x2, y2 = rect
+        self.draw_box(Rect(x1, y1, x2, y2), border)
+
+        if name is not None:
+            x = x1 + padding
+            y = y1 - self.font.ascent + padding
+            textcache.draw_string(self.font, name, x, y)
+            textcache.draw_string(self.font, 'LVL: %d' % level, x, y + line_height)
+            textcache.draw_string(self.font, 'XP: %d/%d' % (xp, next_xp), x, y + line_height * 2)
+            textcache.draw_string(self.font, 'Votes: %d/%d' % (votes, max_votes), x, y + line_height * 3)
+            textcache.draw_string(self.font, 'Spin:  %d/%d' % (spin, max_spin), x, y + line_height * 4)
 
     def draw_combat_selection_box(self, text, x, y):
-        width = self.font.measure_string(text) + 8
+        width = textcache.measure_string(self.font, text) + 8
         x1 = x - width / 2
         y1 = y - self.font.height / 2
         x2 = x1 + width
         y2 = y + self.font.height
         self.draw_box(Rect(x1, y1, x2, y2), self.stat_border_active)
         self.draw_image(self.combat_selected_arrow, x - 8, y1 - 16)
-        bacon.draw_string(self.font, text, x1 + 4, y1 + 4, vertical_align=bacon.VerticalAlignment.top)
+        textcache.draw_string(self.font, text, x1 + 4, y1 + 4, vertical_align=bacon.VerticalAlignment.top)
 
-ui = UI()
+# Created by start_game, so importing the game doesn't load the UI textures
+ui = None
 
 
 class MenuItem(object):
@@ -276,12 +313,12 @@ class Menu(object):
         self.selected_index = 0
 
         height = self.visible_item_count * ui.font.height
-        width = max(ui.font.measure_string(item.name) for item in self.visible_items)
+        width = max(textcache.measure_string(ui.font, item.name) for item in self.visible_items)
         width = max(width, self.min_width)
 
         if self.title:
             height += ui.font.height * 2
-            width = max(width, ui.font.measure_string(self.title))
+            width = max(width, textcache.measure_string(ui.font, self.title))
         
         if self.scrollable:
             height += 64
@@ -353,7 +390,7 @@ class Menu(object):
 
         y = y1
         if self.title:
-            bacon.draw_string(ui.font, self.title, x, y, None, None, align, bacon.VerticalAlignment.top)
+            textcache.draw_string(ui.font, self.title, x, y, None, None, align, bacon.VerticalAlignment.top)
             y += ui.font.height * 2
 
         if self.scrollable:
@@ -371,7 +408,7 @@ class Menu(object):
                 info_y = y
 
             self.activate_menu_item_color(i == self.selected_index, item.enabled)
-            bacon.draw_string(ui.font, item.name, x, y, align = align, vertical_align = bacon.VerticalAlignment.top)
+            textcache.draw_string(ui.font, item.name, x, y, align = align, vertical_align = bacon.VerticalAlignment.top)
             y += ui.font.height
 
         bacon.set_color(1, 1, 1, 1)
@@ -399,6 +436,7 @@ class Menu(object):
 
 class World(object):
     active_script = None
+    active_script_trigger = None
     active_script_sprite = None
     map_script_sprite = None
     current_character = None
@@ -406,13 +444,14 @@ class World(object):
 
     def __init__(self, map_id):
         map = tiled.parse('res/' + map_id + '.tmx')
+        self.map_id = map_id
         self.menu_stack = []
 
         self.timeouts = []
 
         self.map = map
         self.tile_size = map.tile_width
-        self.sprites = []
+        self.sprites = spriteindex.SpriteIndex(self.tile_size)
         self.camera_x = self.camera_y = 0
         
         self.player_slots = [None] * 4
@@ -427,8 +466,7 @@ class World(object):
                     continue
                 x = obj.x / self.tile_size
                 y = obj.y / self.tile_size
-                sprite = self.add_sprite(obj.image, x, y - 1)
-                sprite.name = obj.name
+                sprite = self.add_sprite(obj.image, x, y - 1, obj.name)
                 sprite.properties = obj.properties
 
         for layer in self.map.layers[:]:
@@ -455,7 +493,7 @@ class World(object):
         else:
             return False
 
-    def add_sprite(self, image, x, y):
+    def add_sprite(self, image, x, y, name=None):
         if hasattr(image, 'properties'):
             if 'player_slot' in image.properties:
                 self.player_slots[int(image.properties['player_slot']) - 1] = Slot(x, y)
@@ -465,14 +503,13 @@ class World(object):
                 return
 
         sprite = Sprite(image, x, y)
+        if name is not None:
+            sprite.name = name
         self.sprites.append(sprite)
         return sprite
 
     def get_sprite_at(self, x, y):
-        for sprite in self.sprites:
-            if sprite.x == x and sprite.y == y:
-                return sprite
-        return None
+        return self.sprites.get_at(x, y)
 
     def push_menu(self, menu):
         menu.layout()
@@ -496,6 +533,7 @@ class World(object):
                 if timeout in self.timeouts:
                     self.timeouts.remove(timeout)
 
+    @profiling.timed('draw_world')
     def draw_world(self):
         ts = self.tile_size
 
@@ -509,16 +547,23 @@ class World(object):
         bacon.translate(-viewport.x1, -viewport.y1)
         
         self.map.draw(viewport)
-        for sprite in self.sprites:
+        batch = drawbatch.batch
+        visible = self.sprites.get_visible(int(math.floor(viewport.x1 / ts)),
+                                           int(math.floor(viewport.y1 / ts)),
+                                           int(math.floor(viewport.x2 / ts)),
+                                           int(math.floor(viewport.y2 / ts)))
+        for sprite in visible:
             if sprite.effect_dead:
+                batch.flush()
                 bacon.push_transform()
                 bacon.translate(sprite.x * ts + 4, sprite.y * ts + 4)
                 bacon.rotate(-math.pi / 2)
                 bacon.draw_image(sprite.image, -4, -4)
                 bacon.pop_transform()
             else:
-                bacon.draw_image(sprite.image, sprite.x * ts, sprite.y * ts)
+                batch.add(sprite.image, sprite.x * ts, sprite.y * ts)
 
+        batch.flush()
         bacon.pop_transform()
         self.draw_dialog()
 
@@ -531,7 +576,7 @@ class World(object):
                             self.camera_x + map_width,
                             self.camera_y + map_height)
 
-            width = min(ui_width / 2, debug.font.measure_string(self.dialog_text))
+            width = min(ui_width / 2, textcache.measure_string(debug.font, self.dialog_text))
             if self.dialog_sprite:
                 speaker_x = (self.dialog_sprite.x * ts - viewport.x1) * map_scale
                 speaker_y = (self.dialog_sprite.y * ts - viewport.y1) * map_scale
@@ -545,6 +590,7 @@ class World(object):
         self.draw_hud()
         self.draw_stats()
 
+    @profiling.timed('draw_menu')
     def draw_menu(self):
         for menu in self.menu_stack:
             menu.draw()
@@ -555,18 +601,18 @@ class World(object):
     def get_quest_name(self):
         return self.quest_name
 
+    @profiling.timed('draw_hud')
     def draw_hud(self):
-        ui.draw_box(Rect(0, 0, ui_width, ui.font.height), ui.stat_border)
-        bacon.draw_string(debug.font, self.get_quest_name(), 0, 0, align=bacon.Alignment.left, vertical_align=bacon.VerticalAlignment.top)
-        bacon.draw_string(debug.font, self.get_room_name(), ui_width / 2, 0, align=bacon.Alignment.center, vertical_align=bacon.VerticalAlignment.top)
-        bacon.draw_string(debug.font, '$%d' % game.money, ui_width, 0, align=bacon.Alignment.right, vertical_align=bacon.VerticalAlignment.top)
+        # Drawn from a texture, rendered again only when the text changes
+        bounds = ui.get_box_bounds(Rect(0, 0, ui_width, ui.font.height))
+        ui.hud_panel.draw(bounds, (self.get_quest_name(), self.get_room_name(), game.money))
 
+    @profiling.timed('draw_stats')
     def draw_stats(self):
         margin = 4
         padding = 4
         box_width = ui_width / 4 - margin * 2
         box_height = ui.font.height * 5 + padding * 2
-        line_height = ui.font.height
 
         for i in range(4):
             character = game.allies[i] if i < len(game.allies) else None
@@ -579,18 +625,15 @@ class World(object):
 
             x = margin + i * (box_width + margin * 2)
             y = ui_height - box_height - margin
-            ui.draw_box(Rect(x, y, x + box_width, y + box_height), border)
-            
+            rect = Rect(x, y, x + box_width, y + box_height)
+
             if character:
-                y -= ui.font.ascent
-                x += padding
-                y += padding
-                bacon.set_color(1, 1, 1, 1)
-                bacon.draw_string(ui.font, character.data.name, x, y)
-                bacon.draw_string(ui.font, 'LVL: %d' % character.level, x, y + line_height)
-                bacon.draw_string(ui.font, 'XP: %d/%d' % (character.xp, get_level_row(character.level + 1).xp), x, y + line_height * 2)
-                bacon.draw_string(ui.font, 'Votes: %d/%d' % (character.votes, character.max_votes), x, y + line_height * 3)
-                bacon.draw_string(ui.font, 'Spin:  %d/%d' % (character.spin, character.max_spin), x, y + line_height * 4)
+                state = ((rect.x1, rect.y1, rect.x2, rect.y2), border, character.data.name,
+                         character.level, character.xp, get_level_row(character.level + 1).xp,
+                         character.votes, character.max_votes, character.spin, character.max_spin)
+            else:
+                state = ((rect.x1, rect.y1, rect.x2, rect.y2), border) + (None,) * 8
+            ui.stat_panels[i].draw(ui.get_box_bounds(rect), state)
 
     def on_dismiss_dialog(self):
         self.continue_script()
@@ -635,189 +678,199 @@ class World(object):
             self.active_script = None
 
     def run_script(self, sprite, trigger):
-        if trigger not in game_data.script:
+        if trigger not in game_data.script_code:
             return
         if sprite is None:
             sprite = self.map_script_sprite
         if sprite is None:
             sprite = self.map_script_sprite = Sprite(None, -100, -100)
-        self.active_script = game_data.script[trigger]
+        self.active_script = game_data.script_code[trigger]
+        self.active_script_trigger = trigger
         self.active_script_sprite = sprite
         self.continue_script()
 
-    def run_script_row(self, sprite, script_row):
-        action = script_row.action
-        if action.startswith('_'):
-            return False
+    def rebind_data(self, old_data, data):
+        hotreload.rebind_script(self, data)
 
-        param = script_row.param
-        dialog = script_row.dialog
-        if action == 'Say':
-            if param:
-                sprite = self.get_script_sprite(param)
-            self.do_dialog(sprite, dialog)
-        elif action == 'PlayerSay':
-            self.do_dialog(self.player_sprite, dialog)
-        elif action == 'Message':
-            self.do_dialog(None, dialog)
-        elif action == 'QuestName':
-            self.quest_name = dialog
-            return False
-        elif action == 'Encounter':
-            game.push_world(CombatWorld('combat1', param))
-        elif action == 'Destroy':
-            self.sprites.remove(sprite)
-            return False
-        elif action == 'GiveItem':
-            game.quest_items.append(game_data.quest_items[param])
-            return self.do_dialog(None, dialog)
-        elif action == 'GiveVotes':
-            amount = int(param)
-            for ally in game.allies:
-                ally.votes = min(ally.votes + amount, ally.max_votes)
-            return self.do_dialog(None, dialog)
-        elif action == 'GiveSpin':
-            amount = int(param)
-            for ally in game.allies:
-                ally.spin = min(ally.spin + amount, ally.max_spin)
-            return self.do_dialog(None, dialog)
-        elif action == 'RestoreVotes':
-            for ally in game.allies:
-                ally.votes = ally.max_votes
-            return self.do_dialog(None, dialog)
-        elif action == 'RestoreSpin':
-            for ally in game.allies:
-                ally.spin = ally.max_spin
-            return self.do_dialog(None, dialog)
-        elif action == 'GiveMoney':
-            game.money += int(param)
-            return self.do_dialog(None, dialog)
-        elif action == 'RequireItem' or action == 'RequireItemMessage' or action == 'RequireItemPlayerSay':
-            if param in (item.id for item in game.quest_items) or debug.disable_require:
-                return False # satisfied, move to next line immediately
-            else:
-                if action == 'RequireItemMessage':
-                    dialog_sprite = None
-                elif action == 'RequireItemPlayerSay':
-                    dialog_sprite = self.player_sprite
-                else:
-                    dialog_sprite = sprite
-                self.do_dialog(dialog_sprite, dialog)
-                sprite.script_index -= 1
-                self.active_script = None
-        elif action == 'RequireFlag' or action == 'RequireFlagPlayerSay':
-            if param in game.quest_flags  or debug.disable_require:
-                return False # satisfied, move to next line immediately
-            else:
-                self.do_dialog(sprite if action == 'RequireFlag' else self.player_sprite, dialog)
-                sprite.script_index -= 1
-                self.active_script = None
-        elif action == 'SetFlag':
-            game.quest_flags.add(param)
-            return False
-        elif action == 'UnsetFlag':
-            if param in game.quest_flags:
-                game.quest_flags.remove(param)
-            return False
-        elif action == 'Increment':
-            if param not in game.quest_vars:
-                game.quest_vars[param] = 0
-            game.quest_vars[param] += 1
-            return False
-        elif action == 'RequireCount':
-            value = 0
-            param, required_value = param.split(':')
-            param = param.strip()
-            required_value = int(required_value)
-            if param in game.quest_vars:
-                value = game.quest_vars[param]
-            if value >= required_value or debug.disable_require:
-                return False # satisfied
-            else:
-                self.do_dialog(sprite, dialog)
-                sprite.script_index -= 1
-                self.active_script = None
-        elif action == 'LearnAttack':
-            character = game.player
-            attack_id = param
-            if ':' in param:
-                character_id, attack_id = param.split(':')
-                character = game.get_ally(character_id)
-                if not character:
-                    debug.println('Missing ally: %s' % character_id)
-                    return False
-            attack = game_data.attacks[attack_id]
-            if attack.spin_cost:
-                character.spin_attacks.append(game_data.attacks[attack_id])
-            else:
-                character.standard_attacks.append(game_data.attacks[attack_id])
-            return self.do_dialog(None, dialog)
-        elif action == 'AddAlly':
-            character_id, level = param.split(':')
-            game.allies.append(Character(character_id, int(level), game.player.item_attacks, False))
-            return self.do_dialog(None, dialog)
-        elif action == 'RemoveAlly':
-            ally = game.get_ally(param)
-            if ally:
-                game.allies.remove(ally)
-            return self.do_dialog(None, dialog)
-        elif action == 'GotoMap':
-            game.goto_map(param)
-        elif action == 'BeginCombat':
-            self.begin_round()
-        elif action == 'Shop':
-            self.push_menu(ShopMenu(self, param))
-            return True
-        elif action == 'Label':
-            return False
-        elif action == 'Reset' or action == 'Jump':
-            for i, row in enumerate(self.active_script):
-                if row.action == 'Label' and row.param == param:
-                    sprite.script_index = i
-                    break
-            return action == 'Reset'
-        elif action == 'Save':
-            if game.save(param):
-                self.do_dialog(None, 'Game saved.')
-            else:
-                self.do_dialog(None, 'Error saving game, progress will be lost on exit')
-        elif action == 'PlaySound':
-            try:
-                bacon.Sound(param).play()
-            except:
-                pass
-            return False
-        elif action in ('CheatXP', 'CheatCunning', 'CheatWit', 'CheatFlair', 'CheatSpeed', 'CheatCharisma'):
-            if ':' in param:
-                character_id, value = param.split(':')
-                character = game.get_ally(character_id)
-                value = int(value)
-            else:
-                character = game.player
-                value = int(param)
-            if action == 'CheatXP':
-                character.xp = int(value)
-                character.level = get_level_for_xp(game.player.xp)
-                level_row = get_level_row(character.level)
-                character.max_spin = level_row.spin
-                character.max_votes = level_row.votes
-            elif action == 'CheatCunning':
-              character.cunning = value
-            elif action == 'CheatWit':
-              character.wit = value
-            elif action == 'CheatFlair':
-              character.flair = value
-            elif action == 'CheatSpeed':
-              character.speed = value
-            elif action == 'CheatCharisma':
-                character.charism = value
+    def run_script_row(self, sprite, op):
+        # Returns False only if this script row performs no yielding UI
+        return self.script_ops[op[0]](self, sprite, *op[1:])
+
+    def script_nop(self, sprite):
+        return False
+
+    def script_say(self, sprite, sprite_name, dialog):
+        if sprite_name:
+            sprite = self.get_script_sprite(sprite_name)
+        self.do_dialog(sprite, dialog)
+        return True
+
+    def script_player_say(self, sprite, dialog):
+        self.do_dialog(self.player_sprite, dialog)
+        return True
+
+    def script_message(self, sprite, dialog):
+        self.do_dialog(None, dialog)
+        return True
+
+    def script_quest_name(self, sprite, dialog):
+        self.quest_name = dialog
+        return False
+
+    def script_encounter(self, sprite, encounter_id):
+        game.push_world(CombatWorld('combat1', encounter_id))
+        return True
+
+    def script_destroy(self, sprite):
+        self.sprites.remove(sprite)
+        return False
+
+    def script_give_item(self, sprite, item_id, dialog):
+        game.quest_items.append(game_data.quest_items[item_id])
+        return self.do_dialog(None, dialog)
+
+    def script_give_votes(self, sprite, amount, dialog):
+        for ally in game.allies:
+            ally.votes = min(ally.votes + amount, ally.max_votes)
+        return self.do_dialog(None, dialog)
+
+    def script_give_spin(self, sprite, amount, dialog):
+        for ally in game.allies:
+            ally.spin = min(ally.spin + amount, ally.max_spin)
+        return self.do_dialog(None, dialog)
+
+    def script_restore_votes(self, sprite, dialog):
+        for ally in game.allies:
+            ally.votes = ally.max_votes
+        return self.do_dialog(None, dialog)
+
+    def script_restore_spin(self, sprite, dialog):
+        for ally in game.allies:
+            ally.spin = ally.max_spin
+        return self.do_dialog(None, dialog)
+
+    def script_give_money(self, sprite, amount, dialog):
+        game.money += amount
+        return self.do_dialog(None, dialog)
+
+    def fail_script_requirement(self, sprite, speaker, dialog):
+        if speaker == questscript.speaker_none:
+            dialog_sprite = None
+        elif speaker == questscript.speaker_player:
+            dialog_sprite = self.player_sprite
+        else:
+            dialog_sprite = sprite
+        self.do_dialog(dialog_sprite, dialog)
+        sprite.script_index -= 1
+        self.active_script = None
+        return True
+
+    def script_require_item(self, sprite, item_id, speaker, dialog):
+        if item_id in (item.id for item in game.quest_items) or debug.disable_require:
+            return False # satisfied, move to next line immediately
+        return self.fail_script_requirement(sprite, speaker, dialog)
+
+    def script_require_flag(self, sprite, flag, speaker, dialog):
+        if flag in game.quest_flags or debug.disable_require:
+            return False # satisfied, move to next line immediately
+        return self.fail_script_requirement(sprite, speaker, dialog)
+
+    def script_set_flag(self, sprite, flag):
+        game.quest_flags.add(flag)
+        return False
+
+    def script_unset_flag(self, sprite, flag):
+        game.quest_flags.discard(flag)
+        return False
+
+    def script_increment(self, sprite, name):
+        game.quest_vars[name] = game.quest_vars.get(name, 0) + 1
+        return False
+
+    def script_require_count(self, sprite, name, required_value, dialog):
+        if game.quest_vars.get(name, 0) >= required_value or debug.disable_require:
+            return False # satisfied
+        return self.fail_script_requirement(sprite, questscript.speaker_sprite, dialog)
+
+    def get_script_character(self, character_id):
+        if character_id is None:
+            return game.player
+        character = game.get_ally(character_id)
+        if not character:
+            debug.println('Missing ally: %s' % character_id)
+        return character
+
+    def script_learn_attack(self, sprite, character_id, attack_id, dialog):
+        character = self.get_script_character(character_id)
+        if not character:
             return False
+        attack = game_data.attacks[attack_id]
+        if attack.spin_cost:
+            character.spin_attacks.append(attack)
         else:
-            raise Exception('Unsupported script action "%s"' % action)
+            character.standard_attacks.append(attack)
+        return self.do_dialog(None, dialog)
 
-        # Return False only if this script row performs no yielding UI
+    def script_add_ally(self, sprite, character_id, level, dialog):
+        game.allies.append(Character(game_data, character_id, level, game.player.item_attacks, False))
+        return self.do_dialog(None, dialog)
+
+    def script_remove_ally(self, sprite, character_id, dialog):
+        ally = game.get_ally(character_id)
+        if ally:
+            game.allies.remove(ally)
+        return self.do_dialog(None, dialog)
+
+    def script_goto_map(self, sprite, map_id):
+        game.goto_map(map_id)
+        return True
+
+    def script_begin_combat(self, sprite):
+        self.begin_round()
         return True
 
+    def script_shop(self, sprite, shop_id):
+        self.push_menu(ShopMenu(self, shop_id))
+        return True
+
+    def script_jump(self, sprite, label_index, reset):
+        sprite.script_index = label_index
+        return reset
+
+    def script_save(self, sprite, trigger):
+        if game.save(trigger):
+            self.do_dialog(None, 'Game saved.')
+        else:
+            self.do_dialog(None, 'Error saving game, progress will be lost on exit')
+        return True
+
+    def script_play_sound(self, sprite, path):
+        try:
+            bacon.Sound(path).play()
+        except:
+            pass
+        return False
+
+    def script_cheat_xp(self, sprite, character_id, value):
+        character = self.get_script_character(character_id)
+        if not character:
+            return False
+        character.xp = value
+        character.level = get_level_for_xp(game.player.xp)
+        level_row = get_level_row(character.level)
+        character.max_spin = level_row.spin
+        character.max_votes = level_row.votes
+        return False
+
+    def script_cheat_stat(self, sprite, character_id, stat, value):
+        character = self.get_script_character(character_id)
+        if not character:
+            return False
+        setattr(character, stat, value)
+        return False
+
+World.script_ops = [getattr(World, 'script_' + name).im_func for name in questscript.opcode_names]
+
 class MapMenu(Menu):
     def __init__(self, world):
         super(MapMenu, self).__init__(world)
@@ -870,7 +923,7 @@ class InventoryConsumeMenu(Menu):
     def on_consume(self, ia, ally):
         for effect in ia.attack.effects:
             if effect.function == 'add_permanent':
-                effect.apply(ally)
+                effect.apply(ally, game)
         ally.remove_item_attack(ia.attack)
         self.world.pop_all_menus()
 
@@ -906,16 +959,6 @@ class ShopMenu(Menu):
         self.world.on_dismiss_dialog()
 
         
-def get_tile_collision(tile):
-    if not hasattr(tile, 'properties'):
-        return ''
-    if 'c' not in tile.properties:
-        return ''
-    c = tile.properties['c']
-    if not c:
-        c = 'udlr'
-    return c
-
 class MapWorld(World):
      
     input_movement = {
@@ -931,7 +974,7 @@ class MapWorld(World):
 
         player_slot = self.player_slots[0]
         if player_slot:
-            self.player_sprite = Sprite(game.player.image, player_slot.x, player_slot.y)
+            self.player_sprite = Sprite(game_sprites[game.player.id], player_slot.x, player_slot.y)
             self.player_sprite.name = 'Player'
             self.sprites.append(self.player_sprite)
         else:
@@ -991,38 +1034,18 @@ class MapWorld(World):
                 y + dy < 0 or y + dy >= self.map.rows:
                 return
 
-            tile_index = self.map.get_tile_index(x * self.tile_size, 
-                                                 y * self.tile_size)
-            next_tile_index = self.map.get_tile_index((x + dx) * self.tile_size, 
-                                                      (y + dy) * self.tile_size)
-            for layer in self.map.layers:
-                tile = layer.images[tile_index]
-                next_tile = layer.images[next_tile_index]
+            if not debug.disable_collision and \
+                not self.map.collision_model.can_move(y * self.map.cols + x, dx, dy):
+                return
 
-                c = get_tile_collision(tile)
-                next_c = get_tile_collision(next_tile)
-            
-                if not debug.disable_collision:
-                    if dx < 0 and ('l' in c or 'r' in next_c):
-                        return
-                    elif dx > 0 and ('r' in c or 'l' in next_c):
-                        return
-                    elif dy < 0 and ('u' in c or 'd' in next_c):
-                        return
-                    elif dy > 0 and ('d' in c or 'u' in next_c):
-                        return
-
-            self.player_sprite.x += dx
-            self.player_sprite.y += dy
+            self.sprites.move(self.player_sprite, x + dx, y + dy)
         
     def on_collide(self, other):
-        if other.name in game_data.script:
+        if other.name in game_data.script_code:
             self.run_script(other, other.name)
 
     def get_script_sprite(self, param):
-        for sprite in self.sprites:
-            if sprite.name == param:
-                return sprite
+        return self.sprites.get_named(param)
 
     def get_room_name(self):
         if not self.rooms_layer:
@@ -1038,6 +1061,45 @@ class MapWorld(World):
 
         return ''
 
+    def reload(self):
+        # Rebuilds the world from its changed map, keeping the player's
+        # position, destroyed sprites and the progress of scripts
+        world = MapWorld(self.map_id)
+        world.map_script_sprite = self.map_script_sprite
+        world.quest_name = self.quest_name
+
+        old_sprites = dict((sprite.name, sprite) for sprite in self.sprites)
+        map_sprite_names = set(obj.name for layer in self.map.object_layers for obj in layer.objects if obj.image)
+        for sprite in list(world.sprites):
+            if sprite is world.player_sprite:
+                continue
+            if sprite.name in old_sprites:
+                sprite.script_index = old_sprites[sprite.name].script_index
+                sprite.effect_dead = old_sprites[sprite.name].effect_dead
+            elif sprite.name in map_sprite_names:
+                world.sprites.remove(sprite)
+
+        if self.player_sprite and world.player_sprite:
+            world.sprites.move(world.player_sprite, self.player_sprite.x, self.player_sprite.y)
+
+        def get_new_sprite(sprite):
+            if sprite is None or sprite is self.map_script_sprite:
+                return sprite
+            if sprite is self.player_sprite:
+                return world.player_sprite
+            return world.get_script_sprite(sprite.name) or sprite
+
+        world.active_script = self.active_script
+        world.active_script_trigger = self.active_script_trigger
+        world.active_script_sprite = get_new_sprite(self.active_script_sprite)
+        world.dialog_text = self.dialog_text
+        world.dialog_sprite = get_new_sprite(self.dialog_sprite)
+        world.menu_stack = self.menu_stack
+        for menu in world.menu_stack:
+            menu.world = world
+        world.update_camera()
+        return world
+
     
 class TitleMenu(Menu):
     def __init__(self, world):
@@ -1062,7 +1124,7 @@ class TitleMenu(Menu):
 class TitleWorld(World):
     def __init__(self, map):
         super(TitleWorld, self).__init__(map)
-        self.background = title_image
+        self.background = title_image.get()
         self.after(2, self.show_menu)
         
     def show_menu(self):
@@ -1083,7 +1145,7 @@ class EndWorld(World):
     def __init__(self, map):
         super(EndWorld, self).__init__(map)
         game.play_music('res/wwing2.ogg')
-        self.background = end_image
+        self.background = end_image.get()
 
     def draw(self):
         bacon.draw_image(self.background, 0, 0, ui_width, ui_height)
@@ -1092,7 +1154,7 @@ class EndWorld(World):
         x = 16
         self.y = 16 - ui.font.ascent
         def out(text):
-            bacon.draw_string(ui.font, text, x, self.y); 
+            textcache.draw_string(ui.font, text, x, self.y); 
             self.y += ui.font.height
 
         out('Goodnight, Mr President')
@@ -1118,159 +1180,6 @@ class EndWorld(World):
         if key == bacon.Keys.escape:
             bacon.quit()
 
-class Effect(object):
-    id = None
-    apply_to_source = False
-    function = None
-    rounds_min = None
-    rounds_max = None
-    attribute = None
-    value = None
-
-    def _add_value(self, character, value):
-        if self.attribute == 'spin':
-            character.spin = clamp(character.spin + value, 0, character.max_spin)
-        elif self.attribute == 'votes':
-            if isinstance(game.world, CombatWorld):
-                game.world.apply_damage(character, -value)
-            else:
-                character.votes = clamp(character.votes + value, 0, character.max_votes)
-        elif self.attribute == 'wit':
-            character.wit = max(0, character.wit + value)
-        elif self.attribute == 'cunning':
-            character.cunning = max(0, character.cunning + value)
-        elif self.attribute == 'charisma':
-            character.charisma = max(0, character.charisma + value)
-        elif self.attribute == 'flair':
-            character.flair = max(0, character.flair + value)
-        elif self.attribute == 'resistance':
-            character.resistance = max(0, character.resistance + value)
-        elif self.attribute == 'money':
-            game.money = max(0, game.money + value)
-
-    def apply(self, character):
-        if self.function == 'reduce':
-            self._add_value(character, -self.value)
-        elif self.function == 'add' or self.function == 'add_permanent':
-            self._add_value(character, self.value)
-        elif self.function == 'revive':
-            character.votes = int(character.max_votes * self.value)
-            game.world.set_dead(character, False)
-            game.world.add_floater(character, 'Revived!', ui.floater_border_grey)
-        elif self.function == 'call_friends':
-            character_id, level = self.attribute.split(':')
-            game.world.ai_summon(character_id, int(level), self.value)
-
-    def unapply(self, character):
-        if self.function == 'reduce':
-            self._add_value(character, self.value)
-        elif self.function == 'add':
-            self._add_value(character, -self.value)
-
-    def update(self, character):
-        if self.function == 'drain':
-            game.world.add_floater(character, self.id, ui.floater_border_grey, 1) 
-            self._add_value(character, -self.value)
-
-class ActiveEffect(object):
-    def __init__(self, effect, rounds):
-        self.effect = effect
-        self.rounds = rounds
-
-class ItemAttack(object):
-    def __init__(self, attack, quantity=1):
-        self.attack = attack
-        self.quantity = quantity
-
-def add_attack_to_itemattack_list(item_attacks, attack):
-    for ia in item_attacks:
-        if ia.attack is attack:
-            ia.quantity += 1
-            return
-    item_attacks.append(ItemAttack(attack, 1))
-       
-class Character(object):
-    accumulated_spin_damage = 0
-
-    def __init__(self, id, level, item_attacks, ai=True):
-        level = int(level)
-        self.id = id
-        self.image = game_sprites[id]
-        self.level = level
-        level_row = get_level_row(level)
-        self.xp = level_row.xp
-        self.ai = ai
-        self.dead = False
-        self.summoning_sickness = True
-        self.data = row = random.choice(game_data.characters[id])
-        if ai:
-            self.votes = self.max_votes = self.calc_stat(row.votes_base, row.votes_lvl)
-            self.spin = self.max_spin = self.calc_stat(row.spin_base, row.spin_lvl)
-        else:
-            self.votes = self.max_votes = level_row.votes
-            self.max_spin = level_row.spin
-            self.spin = 0
-
-        self.speed = self.calc_stat(row.speed_base, row.speed_lvl)
-        self.wit = self.calc_stat(row.wit_base, row.wit_lvl)
-        self.cunning = self.calc_stat(row.cunning_base, row.cunning_lvl)
-        self.charisma = self.calc_stat(row.charisma_base, row.charisma_lvl)
-        self.flair = self.calc_stat(row.flair_base, row.flair_lvl)
-        self.resistance = 0
-        self.active_effects = []
-        self.item_attacks = item_attacks
-
-        if ai:
-            self.spin_attacks = row.spin_attacks
-            self.standard_attacks = row.standard_attacks
-        else:
-            self.spin_attacks = list(row.spin_attacks)
-            self.standard_attacks = list(row.standard_attacks)
-
-    def add_item_attack(self, attack):
-        add_attack_to_itemattack_list(self.item_attacks, attack)
-
-    def remove_item_attack(self, attack):
-        for ia in self.item_attacks:
-            if ia.attack is attack:
-                ia.quantity -= 1
-                if ia.quantity == 0:
-                    self.item_attacks.remove(ia)
-                return
-        
-    def calc_stat(self, base, exp):
-        return base + (self.level - 1) * exp
-    
-    def add_active_effect(self, active_effect):
-        for ae in self.active_effects:
-            if ae.effect.id == active_effect.effect.id:
-                return
-
-        self.active_effects.append(active_effect)
-        active_effect.effect.apply(self)
-        debug.println('Add effect %s to %s' % (active_effect.effect.id, self.id))
-        
-        if active_effect.rounds == 0:
-            self.remove_active_effect(active_effect)
-
-    def remove_active_effect(self, active_effect):
-        active_effect.effect.unapply(self)
-        self.active_effects.remove(active_effect)
-        debug.println('Remove effect %s from %s' % (active_effect.effect.id, self.id))
-
-    def remove_all_active_effects(self):
-        for ae in self.active_effects[:]:
-            self.remove_active_effect(ae)
-
-    def has_effect_function(self, function):
-        for ae in self.active_effects:
-            if ae.effect.function == function:
-                return True
-        return False
-    
-    def get_effects_abbrv(self):
-        return ' '.join(ae.effect.abbrv for ae in self.active_effects)
-
 class CombatMenu(Menu):
     min_width = 96
 
@@ -1434,24 +1343,10 @@ class CombatWorld(World):
         self.floaters = []
         self.active_attack = None
         self.active_targets = None
-        self.current_character_index = -1
 
-        self.characters = []
-        for i, ally in enumerate(game.allies):
-            ally.accumulated_spin_damage = 0
-            self.fill_slot(self.player_slots[i], ally)
-        
-        self.ai_item_attacks = list(encounter.item_attacks)
-        if encounter.monster1:
-            self.fill_slot(self.monster_slots[0], Character(encounter.monster1, encounter.monster1_lvl, self.ai_item_attacks))
-        if encounter.monster2:
-            self.fill_slot(self.monster_slots[1], Character(encounter.monster2, encounter.monster2_lvl, self.ai_item_attacks))
-        if encounter.monster3:
-            self.fill_slot(self.monster_slots[2], Character(encounter.monster3, encounter.monster3_lvl, self.ai_item_attacks))
-        if encounter.monster4:
-            self.fill_slot(self.monster_slots[3], Character(encounter.monster4, encounter.monster4_lvl, self.ai_item_attacks))
-
-        self.slots = self.player_slots + self.monster_slots
+        self.combat = combat.Combat(game_data, encounter, game, self.player_slots, self.monster_slots, debug=debug, listener=self)
+        self.combat.start()
+        self.slots = self.combat.slots
 
         self.run_script(self.player_slots[0].sprite, self.encounter.id)
 
@@ -1459,7 +1354,7 @@ class CombatWorld(World):
             self.begin_round()
             
     def restart(self):
-        del self.sprites[:]
+        self.sprites.clear()
         for slot in self.slots:
             slot.character = None
         self.pop_all_menus()
@@ -1478,30 +1373,37 @@ class CombatWorld(World):
 
     @property
     def current_character(self):
-        if self.current_character_index >= 0:
-            return self.characters[self.current_character_index]
+        return self.combat.current_character
+
+    def rebind_data(self, old_data, data):
+        super(CombatWorld, self).rebind_data(old_data, data)
+        self.encounter = data.encounters.get(self.encounter.id, self.encounter)
+        if hasattr(self, 'combat'):
+            hotreload.rebind_combat(self.combat, old_data, data)
 
-    def fill_slot(self, slot, character):
-        slot.character = character
-        if character.id == 'Lobbyist001' and self.encounter.id == 'P-med-12':
+    def on_slot_filled(self, slot):
+        if slot.character.id == 'Lobbyist001' and self.encounter.id == 'P-med-12':
             slot.y = 4
-        slot.sprite = Sprite(character.image, slot.x, slot.y)
+        slot.sprite = Sprite(game_sprites[slot.character.id], slot.x, slot.y)
         self.sprites.append(slot.sprite)
-        self.characters.append(character)
 
-    def get_slot(self, character):
-        for slot in self.slots:
-            if slot.character is character:
-                return slot
-        return None
+    def on_slot_cleared(self, slot):
+        self.sprites.remove(slot.sprite)
+
+    def on_dead(self, character, dead):
+        self.combat.get_slot(character).sprite.effect_dead = dead
+
+    def on_floater(self, character, text, style, offset=0):
+        if style == 'damage':
+            border = ui.floater_border_red
+        elif style == 'heal':
+            border = ui.floater_border_green
+        else:
+            border = ui.floater_border_grey
+        self.add_floater(character, text, border, offset)
 
     def begin_round(self):
-        for character in self.characters:
-            character.summoning_sickness = False
-        self.characters.sort(key=lambda c:c.speed, reverse=True)
-        self.current_character_index = 0
-        while self.current_character_index < len(self.characters) and self.current_character.dead:
-            self.current_character_index += 1
+        self.combat.begin_round()
         self.begin_turn()
 
     def get_script_sprite(self, param):
@@ -1511,7 +1413,7 @@ class CombatWorld(World):
         return None
 
     def begin_turn(self):
-        if self.current_character_index >= len(self.characters):
+        if self.combat.round_over:
             self.begin_round()
             return
 
@@ -1530,12 +1432,7 @@ class CombatWorld(World):
             self.begin_turn_end_effects(miss_turn)
             return
 
-        ae = effects[effect_index]
-        ae.rounds -= 1
-        debug.println('Update effect %s on %s' % (ae.effect.id, self.current_character.id))
-        ae.effect.update(self.current_character)
-        if ae.rounds <= 0:
-            self.current_character.remove_active_effect(ae)
+        self.combat.update_effect(self.current_character, effects[effect_index])
 
         if self.floaters:
             # Queue up next effect if this one generated a floater
@@ -1565,25 +1462,14 @@ class CombatWorld(World):
         self.active_targets = None
 
         # Check end condition
-        win = True
-        lose = True
-        for character in self.characters:
-            if not character.dead:
-                if character.ai:
-                    win = False
-                else:
-                    lose = False
-        
-        if win:
+        outcome = self.combat.get_outcome()
+        if outcome == 'win':
             self.win()
-        elif lose:
+        elif outcome == 'lose':
             self.lose()
         else:
             # Next character's turn
-            self.current_character_index += 1
-            while self.current_character_index < len(self.characters) and \
-                (self.current_character.dead or self.current_character.summoning_sickness):
-                self.current_character_index += 1
+            self.combat.next_character()
             self.begin_turn()
 
     def win(self):
@@ -1593,11 +1479,7 @@ class CombatWorld(World):
             game.push_world(WinCombatWorld(self))
 
     def reset(self):
-        for character in self.characters:
-            character.remove_all_active_effects()
-            if character.dead:
-                character.dead = False
-                character.votes = character.max_votes / 2
+        self.combat.reset()
 
     def lose(self):
         self.push_menu(GameOverMenu(self))
@@ -1608,104 +1490,9 @@ class CombatWorld(World):
         super(CombatWorld, self).on_dismiss_dialog()
 
     def ai(self):
-        source = self.current_character
-
-        # List of all possible attacks
-        attacks = list(source.standard_attacks)
-
-        # Add spin attacks we can afford
-        attacks += [a for a in source.spin_attacks if a.spin_cost <= source.spin]
-
-        # Add item attacks
-        attacks += [ia.attack for ia in source.item_attacks if ia.attack.spin_cost <= source.spin]
-
-        # Filter health gain attacks
-        health_targets = [slot.character for slot in self.monster_slots if slot.character and not slot.character.dead and slot.character.votes < slot.character.max_votes]
-        if health_targets:
-            health_gain_max = max(character.max_votes - character.votes for character in health_targets)
-        else:
-            health_gain_max = 0
-        attacks = [attack for attack in attacks if attack.health_benefit <= health_gain_max]
-
-        # Filter revive attacks
-        revive_targets = [slot.character for slot in self.monster_slots if slot.character and slot.character.dead]
-        if not revive_targets:
-            attacks = [attack for attack in attacks if not attack.is_revive]
-
-        # Filter summon attacks
-        can_summon = len([slot for slot in self.monster_slots if not slot.character or slot.character.dead]) > 0
-        if not can_summon:
-            attacks = [attack for attack in attacks if not attack.is_summon]
-
-        # Random choice of attack
-        attack = weighted_choice(attacks, lambda a: a.weight)
-
-        # Find applicable targets
-        target_type = attack.target_type
-        if target_type == 'AllEnemy':
-            slots = [slot for slot in self.player_slots if slot.character and not slot.character.dead]
-        elif target_type == 'AllFriendly':
-            slots = [slot for slot in self.monster_slots if slot.character and not slot.character.dead]
-        elif target_type == 'DeadFriendly':
-            slots = [slot for slot in self.monster_slots if slot.character and slot.character.dead]
-        elif target_type == 'All':
-            slots = [slot for slot in self.slots if slot.character and not slot.character.dead]
-        elif target_type == 'None':
-            slots = [self.get_slot(source)]
-        else:
-            assert False, 'Unsupported target type'
-
-        # Calculate target slots
-        slots.sort(key=lambda slot: slot.x)
-        target_count = min(attack.target_count, len(slots))
-        max_slot_index = len(slots) - target_count + 1
-        slot_index = -1
-
-        # Choose slot to revive
-        if attack.is_revive:
-            for i, slot in enumerate(slots):
-                if slot.character.dead:
-                    slot_index = i
-                    break
-
-        # Choose slot for health benefit
-        if slot_index == -1 and attack.health_benefit > 0:
-            best_health = 0
-            for i, slot in enumerate(slots):
-                health = slot.character.max_votes - slot.character.votes
-                if health > best_health:
-                    best_health = health
-                    slot_index = i
-
-        # Choose slot randomly
-        if slot_index == -1:
-            slot_index = random.randrange(0, max_slot_index)
-
-        targets = [slot.character for slot in slots[slot_index:slot_index + target_count]]
-
+        attack, targets = self.combat.choose_ai_action(self.current_character)
         self.action_attack(attack, targets)
 
-    def ai_summon(self, character_id, level, count):
-        did_destroy = False
-        for slot in self.monster_slots:
-            if slot.character and slot.character.dead:
-                self.sprites.remove(slot.sprite)
-                slot.character = None
-                did_destroy = True
-        
-        if did_destroy:
-            self.after(0.5, partial(self.ai_summon2, character_id, level, count))
-        else:
-            self.ai_summon2(character_id, level, count)
-
-    def ai_summon2(self, character_id, level, count):
-        for i, slot in enumerate(self.monster_slots):
-            if not slot.character:
-                self.fill_slot(slot, Character(character_id, level, self.ai_item_attacks))
-                count -= 1
-                if count == 0:
-                    return
-
     def action_attack(self, attack, targets):
         self.pop_all_menus()
 
@@ -1714,135 +1501,7 @@ class CombatWorld(World):
         self.after(1, self.action_attack_step2)
 
     def action_attack_step2(self):
-        source = self.current_character
-        attack = self.active_attack
-        targets = self.active_targets
-        
-        if not attack.underlying_stat:
-            base_stat = 0
-        elif attack.underlying_stat == 'Cunning':
-            base_stat = max(source.cunning, 0)
-        elif attack.underlying_stat == 'Wit':
-            base_stat = max(source.wit, 0)
-        elif attack.underlying_stat == 'Money':
-            base_stat = max(source.cunning, 0)
-            game.money = max(0, game.money - self.encounter.bribe_cost)
-            debug.println('%s consumed %d money, has %d remaining' % (source.id, self.encounter.bribe_cost, game.money))
-        else:
-            assert False
-        
-        # Health attacks (negative damage) need negative base_stat
-        if attack.base_damage_min < 0:
-            base_stat = -base_stat
-
-        # Consume spin
-        if attack.spin_cost:
-            source.spin = max(0, source.spin - attack.spin_cost)
-            debug.println('%s consumed %d spin, has %d remaining' % (source.id, attack.spin_cost, source.spin))
-
-        # Consume item
-        if (not attack in source.spin_attacks) and (not attack in source.standard_attacks):
-            debug.println('%s consumed item %s' % (source.id, attack.name))
-            source.remove_item_attack(attack)
-
-        # Apply effects to source
-        critical_fail_effect = None
-        for effect in attack.effects:
-            if effect.id == 'Critical Fail':
-                critical_fail_effect = effect
-            else:
-                rounds = random.randrange(effect.rounds_min, effect.rounds_max + 1)
-                if effect.apply_to_source:
-                    source.add_active_effect(ActiveEffect(effect, rounds))
-
-        # Attack targets
-        critical_fail = True
-        total_damage = 0
-        for target in targets:
-            floater_offset = 1
-            # Immunity
-            if attack in target.data.immunities:
-                self.add_floater(target, 'Immune', ui.floater_border_grey)
-                debug.println('%s is immune to %s' % (target.id, attack.name))
-                continue
-
-            # Crit
-            modifiers = 0
-            if attack.crit_chance_max:
-                crit_chance = random.randrange(attack.crit_chance_min, attack.crit_chance_max + 1)
-                crit_success = random.randrange(0, 100) <= crit_chance + source.flair
-                debug.println('crit_chance = %s, crit_success = %s, flair = %s' % (crit_chance, crit_success, source.flair))
-            else:
-                crit_success = False
-                debug.println('no crit chance calculated')
-
-            # Damage
-            if crit_success:
-                self.add_floater(target, 'Critical Hit!', ui.floater_border_grey, floater_offset)
-                floater_offset += 1
-                debug.println('Critical hit')
-                damage = base_stat + (attack.crit_base_damage + modifiers)
-            else:
-                damage = base_stat + (random.randrange(attack.base_damage_min, attack.base_damage_max + 1) + modifiers)
-        
-            # Cheat damage
-            if debug.massive_damage and not source.ai:
-                damage *= 100
-
-            if damage > 0:
-                # Charisma
-                damage = max(0, damage - target.charisma)
-
-                # Resistance and weakness
-                if attack in target.data.resistance:
-                    self.add_floater(target, 'Resist', ui.floater_border_grey, floater_offset)
-                    floater_offset += 1
-                    debug.println('%s is resistant to %s' % (target.id, attack.name))
-                    damage -= damage * 0.3
-                elif attack in target.data.weaknesses:
-                    self.add_floater(target, 'Weakness', ui.floater_border_grey, floater_offset)
-                    floater_offset += 1
-                    debug.println('%s is weak to %s' % (target.id, attack.name))
-                    damage += damage * 0.3
-
-                # Global resistance (defense)
-                if target.resistance:
-                    self.add_floater(target, 'Defends', ui.floater_border_grey, floater_offset)
-                    floater_offset += 1
-                    debug.println('%s defends' % target.id)
-                damage -= damage * min(1, target.resistance)
-                
-            tried_damage = attack.base_damage_min != 0 or attack.base_damage_max != 0 or attack.crit_base_damage != 0
-            if not tried_damage or damage != 0:
-                critical_fail = False
-
-            # Apply damage
-            damage = int(damage)
-            if tried_damage:
-                self.apply_damage(target, damage)
-
-            # Apply target effects
-            for effect in attack.effects:
-                rounds = random.randrange(effect.rounds_min, effect.rounds_max + 1)
-                if not effect.apply_to_source:
-                    target.add_active_effect(ActiveEffect(effect, rounds))
-
-            debug.println('%s attacks %s with %s for %d' % (source.id, target.id, attack.name, damage))
-
-            if damage > 0:
-                total_damage += damage
-
-        # Award spin for total damage
-        if attack.spin_cost == 0:
-            self.award_spin(source, max(0, total_damage))
-
-        # Critical fail effect
-        if critical_fail and critical_fail_effect:
-            debug.println('Critical fail')
-            rounds = random.randrange(effect.rounds_min, critical_fail_effect.rounds_max + 1)
-            if effect.apply_to_source:
-                source.add_active_effect(ActiveEffect(critical_fail_effect, rounds))
-                self.add_floater(source, 'Critical fail', ui.floater_border_grey)
+        self.combat.attack(self.current_character, self.active_attack, self.active_targets)
 
         if self.floaters:
             self.after(2, self.end_turn)
@@ -1850,34 +1509,10 @@ class CombatWorld(World):
             self.after(1, self.end_turn)
 
     def apply_damage(self, target, damage):
-        target.votes -= damage
-        target.votes = int(clamp(target.votes, 0, target.max_votes))
-
-        if damage >= 0:
-            self.add_floater(target, '%d' % damage, ui.floater_border_red)
-        elif damage < 0:
-            self.add_floater(target, '%d' % -damage, ui.floater_border_green)
-            
-        if target.votes == 0:
-            target.votes = 0
-            self.set_dead(target, True)
-            
-    def set_dead(self, character, dead):
-        character.dead = dead
-        self.get_slot(character).sprite.effect_dead = dead
-
-    def award_spin(self, target, damage):
-        bonus = (damage + target.accumulated_spin_damage + max(target.wit, 0)) / 5
-        if bonus <= 0:
-            target.accumulated_spin_damage += damage
-        else:
-            target.accumulated_spin_damage = 0
+        self.combat.apply_damage(target, damage)
 
-        debug.println('Awarded %d spin; %d left over damage for next time' % (bonus, target.accumulated_spin_damage))
-        target.spin = min(target.spin + bonus, target.max_spin)
-        
     def add_floater(self, character, text, border, offset=0):
-        slot = self.get_slot(character)
+        slot = self.combat.get_slot(character)
         self.floaters.append(Floater(text, slot.x * self.tile_size * map_scale + 16, slot.y * self.tile_size * map_scale - offset * 28 - 16, border))
 
     def draw(self):
@@ -2003,19 +1638,19 @@ class WinCombatWorld(World):
 
         # Title
         ui.draw_box(Rect(x1, y1, x2, y1 + ui.font.height), ui.floater_border_red)
-        bacon.draw_string(ui.font, 'Victory!', cx, y, align = bacon.Alignment.center, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'Victory!', cx, y, align = bacon.Alignment.center, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height + 16
 
         # XP
         bacon.set_color(0, 0, 0, 1)
-        bacon.draw_string(ui.font, 'XP Reward: %d' % encounter.xp, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'XP Reward: %d' % encounter.xp, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         if encounter.money:
             y += ui.font.height
-            bacon.draw_string(ui.font, 'Kickback: $%d' % encounter.money, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+            textcache.draw_string(ui.font, 'Kickback: $%d' % encounter.money, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height * 2
 
         if encounter.item_attack_drops:
-            bacon.draw_string(ui.font, 'Loot:', x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+            textcache.draw_string(ui.font, 'Loot:', x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
             y += ui.font.height
 
             for ia in encounter.item_attack_drops:
@@ -2023,7 +1658,7 @@ class WinCombatWorld(World):
                     name = ia.attack.name
                 else:
                     name = '%s (x%d)' % (ia.attack.name, ia.quantity)
-                bacon.draw_string(ui.font, name, x1 + 32, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+                textcache.draw_string(ui.font, name, x1 + 32, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
                 y += ui.font.height
 
         bacon.set_color(1, 1, 1, 1)
@@ -2194,20 +1829,20 @@ class LevelUpWorld(World):
 
         # Title
         ui.draw_box(Rect(x1, y1, x2, y1 + ui.font.height), ui.floater_border_red)
-        bacon.draw_string(ui.font, 'LEVEL UP %s!' % character.data.name, cx, y, align = bacon.Alignment.center, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'LEVEL UP %s!' % character.data.name, cx, y, align = bacon.Alignment.center, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height + 16
 
         # XP
         bacon.set_color(0, 0, 0, 1)
-        bacon.draw_string(ui.font, 'XP: %d' % character.xp, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'XP: %d' % character.xp, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height
-        bacon.draw_string(ui.font, 'Level: %d' % character.level, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'Level: %d' % character.level, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height
-        bacon.draw_string(ui.font, 'Max Votes: %d' % character.max_votes, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'Max Votes: %d' % character.max_votes, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height
-        bacon.draw_string(ui.font, 'Max Spin: %d' % character.max_spin, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'Max Spin: %d' % character.max_spin, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height * 2
-        bacon.draw_string(ui.font, 'Skill Points to Assign: %d' % self.skill_points, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
+        textcache.draw_string(ui.font, 'Skill Points to Assign: %d' % self.skill_points, x1, y, align = bacon.Alignment.left, vertical_align = bacon.VerticalAlignment.top)
         y += ui.font.height
         bacon.set_color(1, 1, 1, 1)
 
@@ -2216,13 +1851,18 @@ class LevelUpWorld(World):
 class Debug(object):
     def __init__(self):
         self.enabled = False
-        self.font = font_tiny
         self.show_slot_stats = -1
         self.massive_damage = False
         self.message = None
         self.message_timeout = 0
         self.disable_collision = False
         self.disable_require = False
+        self.show_draw_stats = False
+        self.show_profile = False
+
+    @property
+    def font(self):
+        return font_tiny.get()
 
     def on_key_pressed(self, key):
         if not self.enabled:
@@ -2257,6 +1897,18 @@ class Debug(object):
         elif key == bacon.Keys.f7:
             self.disable_require = not self.disable_require
             self.println('disable_require = %s' % self.disable_require)
+        elif key == bacon.Keys.f8:
+            self.show_draw_stats = not self.show_draw_stats
+            self.println('show_draw_stats = %s' % self.show_draw_stats)
+        elif key == bacon.Keys.f9:
+            self.show_profile = not self.show_profile
+            profiling.profiler.enabled = self.show_profile
+            profiling.profiler.reset()
+            self.println('show_profile = %s' % self.show_profile)
+        elif key == bacon.Keys.f10:
+            path = time.strftime('trace-%Y%m%d-%H%M%S.json')
+            if profiling.profiler.export_trace(path):
+                self.println('exported %s' % path)
         elif key == bacon.Keys.numpad_add:
             if isinstance(game.world, CombatWorld):
                 game.world.apply_damage(game.world.current_character, -10)
@@ -2268,20 +1920,37 @@ class Debug(object):
         if self.enabled:
             print msg
 
+    @profiling.timed('debug.draw')
     def draw(self):
         if self.enabled:
             self.message_timeout -= bacon.timestep
             if self.message and self.message_timeout > 0:
                 self.draw_string(self.message, 0, ui_height)
+            if self.show_draw_stats:
+                batch = drawbatch.batch
+                self.draw_string('quads %d flushes %d' % (batch.last_quad_count, batch.last_flush_count), 0, ui_height - self.font.height)
+            if self.show_profile:
+                self.draw_profile()
+
+    def draw_profile(self):
+        times, counters = profiling.profiler.get_summary()
+        y = self.font.height * 2
+        self.draw_string('%-16s %7s %7s %7s %7s' % ('ms', 'last', 'p50', 'p95', 'p99'), 0, y)
+        for name, last, p50, p95, p99 in times:
+            y += self.font.height
+            self.draw_string('%-16s %7.2f %7.2f %7.2f %7.2f' % (name, last, p50, p95, p99), 0, y)
+        for name, last, p50, p95, p99 in counters:
+            y += self.font.height
+            self.draw_string('%-16s %7d %7d %7d %7d' % (name, last, p50, p95, p99), 0, y)
 
     def draw_string(self, text, x, y):
         if self.enabled:
             bacon.push_color()
-            w = self.font.measure_string(text)
+            w = textcache.measure_string(self.font, text)
             bacon.set_color(0, 0, 0, 1)
             bacon.fill_rect(x, y + self.font.ascent, x + w, y + self.font.descent)
             bacon.set_color(1, 1, 1, 1)
-            bacon.draw_string(self.font, text, x, y)
+            textcache.draw_string(self.font, text, x, y)
             bacon.pop_color()
         
 debug = Debug()
@@ -2405,7 +2074,7 @@ class Savegame(object):
             if ally.id == 'Player':
                 character = game.player
             else:
-                character = Character(ally.id, ally.level, game.player.item_attacks, False)
+                character = Character(game_data, ally.id, ally.level, game.player.item_attacks, False)
                 game.allies.append(character)
             ally.restore(character)
         game.world.run_script(None, self.trigger)
@@ -2414,7 +2083,7 @@ class Game(bacon.Game):
     def __init__(self):
         self.music = None
 
-        self.player = Character('Player', 1, [], False)
+        self.player = Character(game_data, 'Player', 1, [], False)
         self.allies = [self.player]
         self.quest_items = []
         self.quest_flags = set()
@@ -2422,6 +2091,15 @@ class Game(bacon.Game):
         self.money = 0
         self.map_worlds = {}
         self.time = 0
+        self.watcher = None
+
+        # Input recording and replay, see replay.py
+        self.tick = 0
+        self.timestep = None
+        self.recorder = None
+        self.replay = None
+        self.replay_speed = 1
+        self.replay_start_time = None
 
         self.world = None
         self.world_stack = []
@@ -2471,25 +2149,163 @@ class Game(bacon.Game):
         else:
             world = MapWorld(map_id)
         self.map_worlds[map_id] = world
+        if self.watcher:
+            self.watch_files(world.map.source_files)
         self.world = world
         self.world.run_script(None, map_id)
         del self.world_stack[:]
+        assets.prefetch(get_next_act_textures(map_id))
+
+    def watch(self, ods_dir=None):
+        # Reload game data and maps when they change.  With ods_dir the
+        # spreadsheets are watched and re-imported, otherwise the bundle is.
+        self.watch_ods_dir = ods_dir
+        if ods_dir:
+            self.watch_data_files = [os.path.abspath(os.path.join(ods_dir, filename)) for filename in gamedata.import_files]
+        else:
+            self.watch_data_files = [os.path.abspath(bacon.get_resource_path('res/game_data.bin'))]
+        self.watcher = hotreload.FileWatcher(self.watch_data_files)
+        for world in self.map_worlds.values():
+            self.watch_files(world.map.source_files)
+
+    def watch_files(self, paths):
+        for path in paths:
+            self.watcher.add(path)
+
+    def reload(self, paths):
+        if any(path in self.watch_data_files for path in paths):
+            self.reload_data()
+
+        for path in paths:
+            tiled.Tileset.image_cache.pop(path, None)
+        tiled.map_cache.invalidate(paths)
+        for map_id, world in self.map_worlds.items():
+            if type(world) is MapWorld and any(os.path.abspath(path) in paths for path in world.map.source_files):
+                self.reload_map(map_id)
+
+    def reload_data(self):
+        global game_data
+        start = time.time()
+        bundle_path = bacon.get_resource_path('res/game_data.bin')
+        try:
+            if self.watch_ods_dir:
+                data = gamedata.import_ods(self.watch_ods_dir, bundle_path, previous=game_data)
+            else:
+                data = gamedata.load(bundle_path)
+        except Exception as e:
+            logging.error('Error reloading game data: %s' % e)
+            return
+
+        old_data = game_data
+        game_data = data
+        hotreload.rebind_party(self, old_data, data)
+        worlds = set(self.map_worlds.values() + self.world_stack + [self.world])
+        for world in worlds:
+            world.rebind_data(old_data, data)
+        debug.println('Reloaded game data in %dms' % ((time.time() - start) * 1000))
+
+    def reload_map(self, map_id):
+        start = time.time()
+        old_world = self.map_worlds[map_id]
+        try:
+            world = old_world.reload()
+        except Exception as e:
+            logging.error('Error reloading map %s: %s' % (map_id, e))
+            return
+
+        self.map_worlds[map_id] = world
+        if self.world is old_world:
+            self.world = world
+        self.world_stack = [world if w is old_world else w for w in self.world_stack]
+        self.watch_files(world.map.source_files)
+        debug.println('Reloaded map %s in %dms' % (map_id, (time.time() - start) * 1000))
 
     def play_music(self, file):
         sound = bacon.Sound(file, stream=True)
         self.music = bacon.Voice(sound)
         self.music.play()
 
+    def record(self, recorder):
+        self.recorder = recorder
+        self.timestep = recorder.timestep
+
+    def start_replay(self, input_replay, speed=1):
+        self.replay = input_replay
+        self.timestep = input_replay.timestep
+        self.replay_speed = speed
+        self.replay_start_time = time.time()
+
+        # Live key presses are ignored, so keep the held keys separately
+        bacon.keys = set()
+
     def on_tick(self):
+        if not self.replay:
+            self.run_tick()
+            return
+
+        # Several ticks a frame to fast forward
+        for i in range(self.replay_speed):
+            if self.replay.done and self.tick > self.replay.last_tick:
+                self.end_replay()
+                return
+            for key, pressed in self.replay.get_events(self.tick):
+                if pressed:
+                    bacon.keys.add(key)
+                else:
+                    bacon.keys.discard(key)
+                self.dispatch_key(key, pressed)
+            self.run_tick()
+
+    def end_replay(self):
+        duration = time.time() - self.replay_start_time
+        print 'Replayed %d ticks in %.2fs (%.1f ticks/s)' % (self.tick, duration, self.tick / max(duration, 0.001))
+        self.replay = None
+        bacon.quit()
+
+    def run_tick(self):
+        if self.timestep is not None:
+            bacon.timestep = self.timestep
         self.time += bacon.timestep
+        drawbatch.batch.begin_frame()
+        profiler = profiling.profiler
+        profiler.begin_frame()
+
+        if self.watcher:
+            changed = self.watcher.update(bacon.timestep)
+            if changed:
+                self.reload(changed)
 
         bacon.clear(0, 0, 0, 1)
+        start = profiler.begin()
         self.world.update()
+        profiler.end('update', start)
         self.world.draw()
 
         debug.draw()
 
+        # Prefetched textures, loaded after drawing so they don't delay the frame
+        start = profiler.begin()
+        assets.update()
+        profiler.end('assets', start)
+
+        # Flow fields movers asked for, built a slice at a time
+        start = profiler.begin()
+        self.world.map.update_flow_fields()
+        profiler.end('flow_fields', start)
+
+        profiler.count('quads', drawbatch.batch.quad_count)
+        profiler.count('flushes', drawbatch.batch.flush_count)
+        profiler.end_frame()
+        self.tick += 1
+
     def on_key(self, key, pressed):
+        if self.replay:
+            return
+        if self.recorder:
+            self.recorder.record(self.tick, key, pressed)
+        self.dispatch_key(key, pressed)
+
+    def dispatch_key(self, key, pressed):
         if pressed:
             self.world.on_key_pressed(key)
             debug.on_key_pressed(key)
@@ -2502,228 +2318,78 @@ class Game(bacon.Game):
                 return ally
         return None
 
-class TableRow(object):
-    pass
-
-def parse_table(table, columns, cls=TableRow, index_unique=False, index_multi=False):
-    headers = table[0]
-    column_map = []
-    column_count = 0
-    for name, header in columns.items():
-        index = headers.index(header)
-        if index != -1:
-            column_map.append((index, name))
-            column_count = max(column_count, index + 1)
-        else:
-            logging.warn('Unmapped column "%s"' % header)
-
-    if index_unique or index_multi:
-        obj_table = {}
-    else:
-        obj_table = []
-
-    for row in table[1:]:
-        if len(row) < column_count:
-            row.extend([''] * (column_count - len(row)))
-
-        if row[0] == '':
-            continue
-
-        obj_row = cls()
-        for i, name in column_map:
-            setattr(obj_row, name, row[i])
-
-        if index_multi:
-            key = row[0]
-            if key not in obj_table:
-                obj_table[key] = []
-            obj_table[key].append(obj_row)
-        elif index_unique:
-            key = row[0]
-            obj_table[key] = obj_row
-        else:
-            obj_table.append(obj_row)
-
-    return obj_table
-
-class GameData(object):
-    pass
-
-def convert_idlist_to_objlist(value, index):
-    result = []
-    for id in value.split(','):
-        id = id.strip()
-        if id:
-            result.append(index[id])
-    return result
-
-def ai_get_health_benefit(attack):
-    # Get min health benefit
-    if attack.target_type != 'AllFriendly' and attack.target_type != 'None':
-        return 0
-
-    h = max(0, -attack.base_damage_max)
-    for effect in attack.effects:
-        if effect.attribute == 'votes' and effect.function == 'add_permanent':
-            h += effect.value
-
-    return h
-
-def ai_is_revive_attack(attack):
-    for effect in attack.effects:
-        if effect.function == 'revive':
-            return True
-    return False
-
-def ai_is_summon_attack(attack):
-    for effect in attack.effects:
-        if effect.function == 'call_friends':
-            return True
-    return False
-
 def main():
     parser = optparse.OptionParser()
     parser.add_option('--import-ods')
+    parser.add_option('--import-full', action='store_true', help='re-parse every sheet instead of only those changed since the last import')
     parser.add_option('--debug', action='store_true')
+    parser.add_option('--watch', action='store_true', help='reload game data and maps when they change, re-importing the spreadsheets if --import-ods is given')
+    parser.add_option('--record', metavar='PATH', help='record key input to PATH for --replay')
+    parser.add_option('--replay', metavar='PATH', help='play back input recorded with --record, then exit')
+    parser.add_option('--replay-speed', type='int', default=1, metavar='TICKS', help='ticks to run each frame when replaying')
+    parser.add_option('--seed', type='int', help='random seed (default from the time when recording)')
+    parser.add_option('--balance', type='int', metavar='RUNS', help='simulate each encounter RUNS times and report statistics')
+    parser.add_option('--balance-encounters', default='', help='comma separated encounter IDs to simulate (default all)')
+    parser.add_option('--balance-levels', default='', help='comma separated party levels (default highest monster level)')
+    parser.add_option('--balance-allies', default='', help='comma separated ally sets, e.g. "none,Wife,Wife+Leo"')
+    parser.add_option('--balance-money', type='int', default=0)
+    parser.add_option('--balance-seed', type='int', default=0)
+    parser.add_option('--balance-processes', type='int', help='worker processes (default one per CPU)')
     options, args = parser.parse_args()
     
     debug.enabled = options.debug
 
     global game_data
     if options.import_ods:
-        import odsimport
-        combat_db = odsimport.import_ods(os.path.join(options.import_ods, 'Combat.ods'))
-        quest_db = odsimport.import_ods(os.path.join(options.import_ods, 'Quest.ods'))
-        level_db = odsimport.import_ods(os.path.join(options.import_ods, 'Levels.ods'))
-        game_data = GameData()
-        
-        game_data.quest_items = parse_table(quest_db['Items'], dict(id = 'ID',
-            name = 'Name',
-            description = 'Description',), index_unique=True)
-
-        game_data.effects = parse_table(combat_db['Effects'], dict(id = 'ID',
-            abbrv = 'Abbrev',
-            apply_to_source = 'Apply To Source',
-            function = 'Function',
-            rounds_min = 'Number Rounds Base',
-            rounds_max = 'Number Rounds Max',
-            attribute = 'Attribute Effected',
-            value = 'Value',), index_unique=True, cls=Effect)
-
-        game_data.attacks = parse_table(combat_db['Attacks'], dict(id = 'ID',
-            name = 'Attack Name',
-            description = 'Description',
-            spin_cost = 'Spin Cost',
-            target_type = 'Target Type',
-            target_count = 'Target Count',
-            underlying_stat = 'Underlying Stat',
-            effects = 'Special Effects',
-            base_damage_min = 'Base Damage',
-            base_damage_max = 'Max Base Damage',
-            crit_base_damage = 'Crit Base Damage',
-            crit_chance_min = 'Chance To Crit Base (%)',
-            crit_chance_max = 'Chance To Crit Max (%)',
-            weight = 'AI Weight',), index_unique=True)
-
-        for attack in game_data.attacks.values():
-            attack.target_count = int(attack.target_count)
-            attack.effects = convert_idlist_to_objlist(attack.effects, game_data.effects)
-            attack.spin_cost = attack.spin_cost if attack.spin_cost else 0
-            attack.weight = attack.weight if attack.weight else 1
-            attack.health_benefit = ai_get_health_benefit(attack)
-            attack.is_revive = ai_is_revive_attack(attack)
-            attack.is_summon = ai_is_summon_attack(attack)
-
-        game_data.standard_attacks = parse_table(combat_db['StandardAttacks'], dict(group = 'AttackGroup',
-            attack = 'Attack',), index_multi=True)
-
-        for attacks in game_data.standard_attacks.values():
-            for i, row in enumerate(attacks):
-                attacks[i] = game_data.attacks[row.attack]
-
-        game_data.characters = parse_table(combat_db['Characters'], dict(id = 'ID',
-            name = 'Name',
-            votes_base = 'Votes',
-            votes_lvl = 'Votes Lvl',
-            spin_base = 'SP',
-            spin_lvl = 'SP Lvl',
-            speed_base = 'Spd',
-            speed_lvl = 'Spd Lvl',
-            wit_base = 'Wit',
-            wit_lvl = 'Wit Lvl',
-            cunning_base = 'Cun',
-            cunning_lvl = 'Cun Lvl',
-            charisma_base = 'Cha',
-            charisma_lvl = 'Cha Lvl',
-            flair_base = 'Flr',
-            flair_lvl = 'Flr Lvl',
-            attack_group = 'AttackGroup',
-            immunities = 'Immunities',
-            resistance = 'Resistance',
-            weaknesses = 'Weaknesses',), index_multi=True)
-
-        # Parse characters
-        for characters in game_data.characters.values():
-            for character in characters:
-                character.immunities = convert_idlist_to_objlist(character.immunities, game_data.attacks)
-                character.resistance = convert_idlist_to_objlist(character.resistance, game_data.attacks)
-                character.weaknesses = convert_idlist_to_objlist(character.weaknesses, game_data.attacks)
-                attacks = game_data.standard_attacks[character.attack_group]
-                character.spin_attacks = [attack for attack in attacks if attack.spin_cost]
-                character.standard_attacks = [attack for attack in attacks if not attack.spin_cost]
-                
-        game_data.encounters = parse_table(combat_db['Encounters'], dict(id = 'ID',
-            name = 'Name',
-            monster1 = 'Monster 1',
-            monster1_lvl = 'Monster 1 Lvl',
-            monster2 = 'Monster 2',
-            monster2_lvl = 'Monster 2 Lvl',
-            monster3 = 'Monster 3',
-            monster3_lvl = 'Monster 3 Lvl',
-            monster4 = 'Monster 4',
-            monster4_lvl = 'Monster 4 Lvl',
-            item_attacks = 'Attack Items',
-            bribe_cost = 'Bribe Cost',
-            xp = 'XP',
-            money = 'Money',
-            item_attack_drops = 'Attack Drops',), index_unique=True)
-
-        for encounter in game_data.encounters.values():
-            encounter.item_attacks = [ItemAttack(attack, 1) for attack in convert_idlist_to_objlist(encounter.item_attacks, game_data.attacks)]
-            attack_drops = convert_idlist_to_objlist(encounter.item_attack_drops, game_data.attacks)
-            encounter.item_attack_drops = []
-            for attack in attack_drops:
-                add_attack_to_itemattack_list(encounter.item_attack_drops, attack)
-
-        game_data.script = parse_table(quest_db['Script'], dict(trigger = 'Trigger',
-            action = 'Action',
-            param = 'Param',
-            dialog = 'Dialog',), index_multi=True)
-
-        game_data.levels = parse_table(level_db['Levels'], dict(level = 'Level',
-            xp = 'XP',
-            votes = 'Votes',
-            spin = 'Spin',
-            skill_points = 'Skill Points',))
-
-        game_data.shops = parse_table(quest_db['Shops'], dict(shop_id = 'ID',
-            item_attack = 'Attack Item',
-            price = 'Price',), index_multi=True)
-        for shop in game_data.shops.values():
-            for ware in shop:
-                ware.item_attack = game_data.attacks[ware.item_attack]
-
-        pickle.dump(game_data, open_res('res/game_data.bin', 'wb'))
+        bundle_path = bacon.get_resource_path('res/game_data.bin')
+        game_data = gamedata.import_ods(options.import_ods, bundle_path, not options.import_full)
     else:
-        game_data = pickle.load(open_res('res/game_data.bin', 'rb'))
+        game_data = gamedata.load(bacon.get_resource_path('res/game_data.bin'))
+
+    if options.balance:
+        import balance
+        encounter_ids = [id.strip() for id in options.balance_encounters.split(',') if id.strip()]
+        levels = [int(level) for level in options.balance_levels.split(',') if level.strip()]
+        reports = balance.run(game_data, options.balance,
+            encounter_ids=encounter_ids,
+            levels=levels,
+            ally_sets=balance.parse_ally_sets(options.balance_allies),
+            seed=options.balance_seed,
+            processes=options.balance_processes,
+            money=options.balance_money)
+        balance.print_report(reports)
+        return
 
     global game_sprites
     game_sprites = load_sprites('res/sprites.tsx')
-    start_game(args)
-
-def start_game(args):
-    global game
+    start_game(args, options.watch, options.import_ods,
+        record_path=options.record,
+        replay_path=options.replay,
+        replay_speed=options.replay_speed,
+        seed=options.seed)
+
+def start_game(args, watch=False, ods_dir=None, record_path=None, replay_path=None, replay_speed=1, seed=None):
+    global game, ui
+
+    # Seeded before the game is created, as creating characters is random
+    input_replay = None
+    if replay_path:
+        input_replay = replay.InputReplay(replay_path)
+        seed = input_replay.seed
+        args = input_replay.args
+    elif record_path and seed is None:
+        seed = int(time.time())
+    if seed is not None:
+        random.seed(seed)
+
+    ui = UI()
     game = Game()
+    if watch:
+        game.watch(ods_dir)
+    if input_replay:
+        game.start_replay(input_replay, replay_speed)
+    elif record_path:
+        game.record(replay.InputRecorder(record_path, seed, replay.default_timestep, args))
 
     game.goto_map('title')
     if args:
@@ -2735,8 +2401,13 @@ def start_game(args):
 
     bacon.run(game)
 
-import traceback
-try:
-    main()
-except:
-    traceback.print_exc()
+def run():
+    try:
+        main()
+    except:
+        traceback.print_exc()
+
+# run_game.py calls run(); importing this module alone doesn't start the game,
+# so tools like benchmark.py can use it
+if __name__ == '__main__':
+    run()
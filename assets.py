@@ -0,0 +1,96 @@
+# Lazily loaded images and fonts.  Nothing is loaded when the game is imported;
+# a handle loads its asset the first time get() is called, so tools that import
+# the game without showing it (--import-ods, --balance, --help) don't pay for
+# it, and the title screen only waits for what it draws.
+#
+# Textures that will probably be needed soon, such as the tilesets of the next
+# act, can be prefetched.  bacon creates textures on the thread that owns the
+# window, so prefetching isn't done on a thread; update() loads queued images
+# between frames instead, within a time budget, so a map change finds them in
+# the cache rather than stalling on them.
+
+import collections
+import os.path
+import timeit
+
+import bacon
+import tiled
+
+timer = timeit.default_timer
+
+class ImageHandle(object):
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def loaded(self):
+        return is_image_loaded(self.path)
+
+    def get(self):
+        # Through the tileset image cache, so maps share the image
+        return tiled.Tileset.get_cached_image(bacon.get_resource_path(self.path))
+
+class FontHandle(object):
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.font = None
+
+    @property
+    def loaded(self):
+        return self.font is not None
+
+    def get(self):
+        if self.font is None:
+            font = bacon.Font(bacon.get_resource_path(self.path), self.size)
+            # Line height without the line gap, which is how the UI spaces text
+            font.height = font.descent - font.ascent
+            self.font = font
+        return self.font
+
+def is_image_loaded(path):
+    return os.path.abspath(bacon.get_resource_path(path)) in tiled.Tileset.image_cache
+
+class AssetManager(object):
+    def __init__(self, budget=0.004):
+        # Seconds of each update() that may be spent loading prefetched images
+        self.budget = budget
+        self.queue = collections.deque()
+        self.load_count = 0
+
+    def image(self, path):
+        return ImageHandle(path)
+
+    def font(self, path, size):
+        return FontHandle(path, size)
+
+    def prefetch(self, paths):
+        for path in paths:
+            if path not in self.queue and not is_image_loaded(path):
+                self.queue.append(path)
+
+    def update(self):
+        # At least one image is loaded when any are queued, so a slow load
+        # doesn't stall the queue
+        start = timer()
+        while self.queue:
+            path = self.queue.popleft()
+            if not is_image_loaded(path):
+                tiled.Tileset.get_cached_image(bacon.get_resource_path(path))
+                self.load_count += 1
+            if timer() - start > self.budget:
+                break
+
+assets = AssetManager()
+
+def image(path):
+    return assets.image(path)
+
+def font(path, size):
+    return assets.font(path, size)
+
+def prefetch(paths):
+    assets.prefetch(paths)
+
+def update():
+    assets.update()
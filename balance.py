@@ -0,0 +1,126 @@
+# Monte Carlo encounter balancing.  Runs seeded combat.resolve_encounter
+# simulations across a process pool and reports per-encounter statistics.
+#
+# Every batch of runs gets its own random.Random seeded from the base seed and
+# the batch's configuration, so results do not depend on how many processes
+# are used or how batches are scheduled.
+
+import multiprocessing
+import random
+import zlib
+
+import combat
+
+batch_size = 50
+
+_data = None
+
+def _init_worker(data):
+    global _data
+    _data = data
+
+def get_batch_seed(seed, encounter_id, level, ally_ids, batch_index):
+    key = '%d:%s:%d:%s:%d' % (seed, encounter_id, level, '+'.join(ally_ids), batch_index)
+    return zlib.crc32(key) & 0xffffffff
+
+def run_batch(args):
+    encounter_id, level, ally_ids, money, count, seed = args
+    rng = random.Random(seed)
+    results = []
+    for i in range(count):
+        party = combat.create_party(_data, level, ally_ids, rng, money)
+        result = combat.resolve_encounter(_data, encounter_id, party, rng)
+        results.append((result.outcome, result.turns, result.votes_lost, result.spin_used))
+    return results
+
+def get_encounter_level(encounter):
+    levels = [encounter.monster1_lvl, encounter.monster2_lvl, encounter.monster3_lvl, encounter.monster4_lvl]
+    return int(max(level for level in levels if level != ''))
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+class BalanceReport(object):
+    def __init__(self, encounter_id, level, ally_ids, results):
+        self.encounter_id = encounter_id
+        self.level = level
+        self.ally_ids = ally_ids
+        self.runs = len(results)
+        self.wins = len([r for r in results if r[0] == 'win'])
+        self.timeouts = len([r for r in results if r[0] == 'timeout'])
+        self.turns_to_kill = [r[1] for r in results if r[0] == 'win']
+        self.votes_lost = [r[2] for r in results]
+        self.spin_used = [r[3] for r in results]
+
+    @property
+    def win_rate(self):
+        return float(self.wins) / self.runs if self.runs else 0.0
+
+    def format(self):
+        return '%-10s %3d %-20s %6.1f%% %4d %4d %4d %5.0f%% %5.0f%% %5.0f%% %4d %4d %4d' % (
+            self.encounter_id, self.level, '+'.join(self.ally_ids) or '-',
+            self.win_rate * 100,
+            percentile(self.turns_to_kill, 10), percentile(self.turns_to_kill, 50), percentile(self.turns_to_kill, 90),
+            percentile(self.votes_lost, 10) * 100, percentile(self.votes_lost, 50) * 100, percentile(self.votes_lost, 90) * 100,
+            percentile(self.spin_used, 10), percentile(self.spin_used, 50), percentile(self.spin_used, 90))
+
+report_header = '%-10s %3s %-20s %7s %14s %20s %14s' % ('Encounter', 'Lvl', 'Allies', 'Win', 'Turns p10/50/90', 'Votes lost p10/50/90', 'Spin p10/50/90')
+
+def run(data, runs, encounter_ids=None, levels=None, ally_sets=None, seed=0, processes=None, money=0):
+    # levels defaults to each encounter's highest monster level; ally_sets is a
+    # list of ally id lists, defaulting to the player alone.
+    if not encounter_ids:
+        encounter_ids = sorted(data.encounters.keys())
+    if not ally_sets:
+        ally_sets = [[]]
+
+    configs = []
+    for encounter_id in encounter_ids:
+        encounter_levels = levels or [get_encounter_level(data.encounters[encounter_id])]
+        for level in encounter_levels:
+            for ally_ids in ally_sets:
+                configs.append((encounter_id, level, tuple(ally_ids)))
+
+    tasks = []
+    for encounter_id, level, ally_ids in configs:
+        for batch_index, start in enumerate(range(0, runs, batch_size)):
+            count = min(batch_size, runs - start)
+            tasks.append((encounter_id, level, ally_ids, money, count, get_batch_seed(seed, encounter_id, level, ally_ids, batch_index)))
+
+    if processes == 1:
+        _init_worker(data)
+        batches = map(run_batch, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (data,))
+        try:
+            batches = pool.map(run_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = {}
+    for task, batch in zip(tasks, batches):
+        results.setdefault(task[:3], []).extend(batch)
+
+    return [BalanceReport(encounter_id, level, list(ally_ids), results[(encounter_id, level, ally_ids)])
+            for encounter_id, level, ally_ids in configs]
+
+def parse_ally_sets(value):
+    # "none,Wife,Wife+Leo" -> [[], ['Wife'], ['Wife', 'Leo']]
+    ally_sets = []
+    for ally_set in value.split(','):
+        ally_set = ally_set.strip()
+        if ally_set in ('', 'none'):
+            ally_sets.append([])
+        else:
+            ally_sets.append([id.strip() for id in ally_set.split('+')])
+    return ally_sets
+
+def print_report(reports):
+    print report_header
+    for report in reports:
+        print report.format()
@@ -0,0 +1,324 @@
+# Benchmarks of the load, render, script and combat hot paths:
+#
+#   python benchmark.py [--save-baseline] [--output results.json] [names...]
+#
+# Each case is timed several times and its best time compared with
+# benchmark_baseline.json; the run exits with an error if any case is more
+# than --threshold slower than its baseline.  --output writes the results as
+# JSON for charting over time.  Baselines depend on the machine, so save them
+# on the machine the benchmarks are compared on.
+#
+# Runs on the headless bacon stand-in, so it needs no display.  Names select
+# cases by prefix, e.g. "tiled" or "combat".
+
+import headless
+headless.install()
+
+import array
+import glob
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+import bacon
+import balance
+import collision
+import combat
+import flowfield
+import gamedata
+import mapfile
+import odsimport
+import pathfind
+import questscript
+import tiled
+from common import Rect
+
+timer = timeit.default_timer
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+benchmarks = []
+
+def benchmark(func):
+    # Registers func, which returns a list of (case name, setup, run); setup()
+    # is untimed and its result, unless None, is passed to run()
+    benchmarks.append(func)
+    return func
+
+def get_maps():
+    return sorted(glob.glob(bacon.get_resource_path('res/*.tmx')))
+
+def get_map_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def load_game_data():
+    return gamedata.load(bacon.get_resource_path('res/game_data.bin'))
+
+@benchmark
+def bench_maps():
+    cases = []
+    for path in get_maps():
+        name = get_map_name(path)
+        cases.append(('tiled.parse/%s' % name, lambda path=path: tiled.map_cache.discard(path), lambda path=path: tiled.parse(path)))
+        cases.append(('tiled.parse_tmx/%s' % name, None, lambda path=path: tiled.parse_tmx(path)))
+    return cases
+
+@benchmark
+def bench_ods():
+    cases = []
+    for path in sorted(glob.glob(bacon.get_resource_path('Local/*.ods'))):
+        name = os.path.basename(path)
+        cases.append(('odsimport.import_ods/%s' % name, None, lambda path=path: odsimport.import_ods(path)))
+    return cases
+
+@benchmark
+def bench_game_data():
+    return [('gamedata.load', None, lambda: load_game_data())]
+
+@benchmark
+def bench_draw():
+    cases = []
+    for path in get_maps():
+        tm = tiled.parse(path)
+        if not tm.layers:
+            continue
+        name = get_map_name(path)
+        full = Rect(0, 0, tm.cols * tm.tile_width, tm.rows * tm.tile_height)
+        screen = Rect(0, 0, min(full.x2, 160), min(full.y2, 120))
+
+        def clear_chunks(tm=tm):
+            tm.chunks = {}
+
+        cases.append(('Tilemap.draw/%s/full' % name, None, lambda tm=tm, rect=full: tm.draw(rect)))
+        cases.append(('Tilemap.draw/%s/screen' % name, None, lambda tm=tm, rect=screen: tm.draw(rect)))
+        cases.append(('Tilemap.draw/%s/bake' % name, clear_chunks, lambda tm=tm, rect=full: tm.draw(rect)))
+    return cases
+
+@benchmark
+def bench_path():
+    # Across the largest map, between the first walkable tile that can be
+    # left and the last walkable tile reachable from it
+    path = max(get_maps(), key=lambda path: tiled.parse(path).cols * tiled.parse(path).rows)
+    tm = tiled.parse(path)
+    model = tm.collision_model
+    walkable = [tile for i, tile in enumerate(tm.tiles[:-1]) if tile.walkable and model.exits[i]]
+    start = walkable[0]
+    for goal in reversed(walkable):
+        if tm.find_path(start.ty * tm.cols + start.tx, goal.ty * tm.cols + goal.tx, tm.cols * tm.rows):
+            break
+
+    def run():
+        return tm.get_path(start,
+                           lambda tile: tile is goal,
+                           lambda tile: max(abs(tile.tx - goal.tx), abs(tile.ty - goal.ty)),
+                           tm.cols * tm.rows)
+
+    def run_cells():
+        return tm.find_path(start.ty * tm.cols + start.tx, goal.ty * tm.cols + goal.tx, tm.cols * tm.rows)
+    return [('Tilemap.get_path/%s' % get_map_name(path), None, run),
+            ('Tilemap.find_path/%s' % get_map_name(path), None, run_cells)]
+
+@benchmark
+def bench_tiles():
+    # Walkability of a fresh copy of the largest map, at a few points and at
+    # every tile
+    path = max(get_maps(), key=lambda path: tiled.parse(path).cols * tiled.parse(path).rows)
+
+    def run_points(tm):
+        width = tm.cols * tm.tile_width
+        height = tm.rows * tm.tile_height
+        return sum(1 for i in range(64) if tm.get_tile_at(i * 37 % width, i * 53 % height).walkable)
+
+    def run_all(tm):
+        return sum(1 for tile in tm.tiles if tile.walkable)
+    name = get_map_name(path)
+    return [('Tilemap.get_tile_at/%s' % name, lambda: tiled.parse(path), run_points),
+            ('Tilemap.tiles/%s' % name, lambda: tiled.parse(path), run_all)]
+
+@benchmark
+def bench_large_path():
+    # A map bigger than any made so far: rooms 12 cells across with a door in
+    # each wall and a little furniture, between the corners furthest apart
+    # that are connected
+    cols = rows = 256
+    rng = random.Random(0)
+    flags = [mapfile.unwalkable if rng.random() < 0.05 else 0 for i in range(cols * rows)]
+    for wall in range(12, cols, 12):
+        for i in range(cols):
+            flags[wall * cols + i] = flags[i * cols + wall] = mapfile.unwalkable
+        for room in range(0, cols, 12):
+            door = rng.randrange(room + 1, min(room + 11, cols))
+            flags[wall * cols + door] = flags[door * cols + wall] = 0
+    flags[0] = flags[-1] = 0
+    model = collision.CollisionModel(cols, rows, array.array('B', flags))
+    walkable = model.walkable['all']
+    path_finder = pathfind.PathFinder(cols, rows)
+    graph = pathfind.RegionGraph(model)
+    graph.update()
+    start = 0
+    for goal in reversed(range(cols * rows)):
+        if walkable[goal] and graph.find(start, goal, cols * rows):
+            break
+
+    def new_graph():
+        return pathfind.RegionGraph(model)
+
+    # Toggles a cell in the middle of the map on a graph of its own
+    changed_model = model.copy()
+    changed_graph = pathfind.RegionGraph(changed_model)
+    changed_graph.update()
+    changed_cell = rows / 2 * cols + cols / 2 + 3
+
+    def change_cell():
+        changed_model.set_walkable(changed_cell, not changed_model.is_walkable(changed_cell))
+        changed_graph.invalidate(changed_cell)
+        return changed_graph
+
+    def new_flow_field():
+        return flowfield.FlowField(model, goal)
+
+    def build_flow_field(field):
+        while not field.complete:
+            field.build(cols * rows)
+    return [('pathfind.PathFinder/256', None, lambda: path_finder.find_to(walkable, model.exits, start, goal, cols * rows)),
+            ('pathfind.RegionGraph/256', None, lambda: graph.find(start, goal, cols * rows)),
+            ('pathfind.RegionGraph.update/256', new_graph, lambda graph: graph.update()),
+            ('pathfind.RegionGraph.update/256/cell', change_cell, lambda graph: graph.update()),
+            ('flowfield.FlowField/256', new_flow_field, build_flow_field)]
+
+@benchmark
+def bench_combat():
+    data = load_game_data()
+
+    def run():
+        rng = random.Random(0)
+        for encounter_id, encounter in sorted(data.encounters.items()):
+            level = balance.get_encounter_level(encounter)
+            party = combat.create_party(data, level, (), rng)
+            combat.resolve_encounter(data, encounter_id, party, rng)
+    return [('combat.resolve_encounter/all', None, run)]
+
+@benchmark
+def bench_scripts():
+    import GoodnightMrPresident as gmp
+    gmp.game_data = load_game_data()
+    gmp.game_sprites = gmp.load_sprites('res/sprites.tsx')
+
+    # Rows that leave the map world, open menus or write files only yield
+    def yield_row(world, sprite, *args):
+        return True
+    script_ops = list(gmp.World.script_ops)
+    for name in ['encounter', 'destroy', 'goto_map', 'begin_combat', 'shop', 'save']:
+        script_ops[questscript.opcodes[name]] = yield_row
+
+    def setup():
+        gmp.game = gmp.Game()
+        world = gmp.MapWorld('act1')
+        world.script_ops = script_ops
+        gmp.game.world = world
+        return world
+
+    def run(world):
+        # Every script to the end, dismissing each dialog straight away
+        for trigger in sorted(gmp.game_data.script_code):
+            world.run_script(gmp.Sprite(None, -100, -100), trigger)
+            steps = 0
+            while world.active_script and steps < 1000:
+                world.dialog_text = None
+                world.continue_script()
+                steps += 1
+    return [('World.continue_script/all', setup, run)]
+
+def time_case(setup, run, repeat):
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup else None
+        start = timer()
+        if arg is None:
+            run()
+        else:
+            run(arg)
+        times.append(timer() - start)
+    times.sort()
+    return dict(best=times[0], median=times[len(times) / 2], repeat=repeat)
+
+def run_benchmarks(prefixes, repeat):
+    results = {}
+    for func in benchmarks:
+        for name, setup, run in func():
+            if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+                continue
+            # Once untimed, to warm caches the game would have warm
+            time_case(setup, run, 1)
+            results[name] = time_case(setup, run, repeat)
+            print '%-48s %10.3fms' % (name, results[name]['best'] * 1000)
+    return results
+
+def load_baseline():
+    if not os.path.exists(baseline_path):
+        return {}
+    f = open(baseline_path, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def save_baseline(baseline):
+    f = open(baseline_path, 'w')
+    try:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def get_regressions(results, baseline, threshold, min_delta):
+    # Very short cases are noisy, so they must also be min_delta seconds slower
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline and result['best'] > baseline[name] * (1 + threshold) and \
+            result['best'] - baseline[name] > min_delta:
+            regressions.append((name, baseline[name], result['best']))
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [names...]')
+    parser.add_option('--repeat', type='int', default=5, help='timed runs of each case (default 5)')
+    parser.add_option('--threshold', type='float', default=0.25, help='fail when a case is this fraction slower than its baseline (default 0.25)')
+    parser.add_option('--min-delta', type='float', default=0.1, metavar='MS', help='ignore regressions smaller than this many ms (default 0.1)')
+    parser.add_option('--output', metavar='PATH', help='write results as JSON to PATH')
+    parser.add_option('--save-baseline', action='store_true', help='save the results as the new baseline')
+    options, args = parser.parse_args()
+
+    results = run_benchmarks(args, options.repeat)
+    baseline = load_baseline()
+    regressions = get_regressions(results, baseline, options.threshold, options.min_delta / 1000)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(dict(time=time.time(),
+                           python=platform.python_version(),
+                           platform=platform.platform(),
+                           threshold=options.threshold,
+                           results=results,
+                           baseline=dict((name, baseline[name]) for name in results if name in baseline),
+                           regressions=[name for name, old, new in regressions]),
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.save_baseline:
+        baseline.update((name, result['best']) for name, result in results.items())
+        save_baseline(baseline)
+        print 'Saved baseline to %s' % baseline_path
+    elif regressions:
+        for name, old, new in regressions:
+            print 'Regression: %s %.3fms -> %.3fms (%+.0f%%)' % (name, old * 1000, new * 1000, (new / old - 1) * 100)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Compiled collision model of a map, built once from its per-cell mapfile
+# collision flags when the map is loaded, so movement checks, pathfinding and
+# AI answer "can this move here" with array lookups instead of looking at tile
+# properties.
+#
+# walkable[movement_class] has a byte per cell, 1 where movers of that class
+# may stand.  blocked has the mapfile.collide_* bits of the directions a mover
+# can't leave each cell in, from the walls on either side of the edge and the
+# edge of the map.  exits has a bit for each of the 8 directions a mover can
+# leave each cell in, ignoring walkability; diagonal exits need both L-shaped
+# routes around the corner to be open.
+
+import array
+
+import mapfile
+
+# Flags that make a cell unwalkable for each movement class
+movement_classes = {
+    'all': mapfile.unwalkable,
+    'animal': mapfile.unwalkable | mapfile.unwalkable_animal,
+    'villager': mapfile.unwalkable | mapfile.unwalkable_villager,
+    'entrance': mapfile.unwalkable | mapfile.unwalkable_entrance,
+}
+
+# Exit bits; the straight ones are the same as the collide bits
+exit_up = mapfile.collide_up
+exit_down = mapfile.collide_down
+exit_left = mapfile.collide_left
+exit_right = mapfile.collide_right
+exit_up_left = 16
+exit_up_right = 32
+exit_down_left = 64
+exit_down_right = 128
+
+exit_directions = {
+    (0, -1): exit_up,
+    (0, 1): exit_down,
+    (-1, 0): exit_left,
+    (1, 0): exit_right,
+    (-1, -1): exit_up_left,
+    (1, -1): exit_up_right,
+    (-1, 1): exit_down_left,
+    (1, 1): exit_down_right,
+}
+
+# Whole-map operations are done with str.translate and a single pass over the
+# zipped neighbour cells, as building the model is part of loading a map
+
+def get_table(func):
+    # str.translate table mapping each flags byte to func(flags)
+    return ''.join(chr(func(flags)) for flags in range(256))
+
+walkable_tables = dict((movement_class, get_table(lambda flags, mask=mask: 0 if flags & mask else 1))
+                       for movement_class, mask in movement_classes.items())
+
+collide_all = mapfile.collide_up | mapfile.collide_down | mapfile.collide_left | mapfile.collide_right
+own_blocked_table = get_table(lambda flags: flags & collide_all)
+# Walls of the cell above, below, left and right of a cell that block it
+above_blocked_table = get_table(lambda flags: mapfile.collide_up if flags & mapfile.collide_down else 0)
+below_blocked_table = get_table(lambda flags: mapfile.collide_down if flags & mapfile.collide_up else 0)
+left_blocked_table = get_table(lambda flags: mapfile.collide_left if flags & mapfile.collide_right else 0)
+right_blocked_table = get_table(lambda flags: mapfile.collide_right if flags & mapfile.collide_left else 0)
+
+def get_walkable_cells(flags, movement_class):
+    return array.array('B', flags.tostring().translate(walkable_tables[movement_class]))
+
+def get_blocked_cells(cols, rows, flags):
+    # Cells past the edge of the map block as walls do
+    data = flags.tostring()
+    size = cols * rows
+    own = data.translate(own_blocked_table)
+    above = chr(mapfile.collide_up) * cols + data[:-cols].translate(above_blocked_table)
+    below = data[cols:].translate(below_blocked_table) + chr(mapfile.collide_down) * cols
+    left_data = data.translate(left_blocked_table)
+    right_data = data.translate(right_blocked_table)
+    left = ''.join(chr(mapfile.collide_left) + left_data[i:i + cols - 1] for i in range(0, size, cols))
+    right = ''.join(right_data[i + 1:i + cols] + chr(mapfile.collide_right) for i in range(0, size, cols))
+    return array.array('B', [a | b | c | d | e for a, b, c, d, e in
+                             zip(bytearray(own), bytearray(above), bytearray(below), bytearray(left), bytearray(right))])
+
+def get_exit_cells(cols, rows, blocked):
+    # A diagonal exit needs the cell's two straight exits towards it open,
+    # and the neighbours on both sides open towards the diagonal cell.
+    # Padding past the edges is never looked at, as the cell itself is
+    # blocked towards the edge.
+    cells = bytearray(blocked.tostring())
+    padding = bytearray([collide_all])
+    above = padding * cols + cells[:-cols]
+    below = cells[cols:] + padding * cols
+    left = padding + cells[:-1]
+    right = cells[1:] + padding
+    up = exit_up
+    down = exit_down
+    return array.array('B', [(~mask & collide_all) |
+        (0 if mask & (up | exit_left) or a & exit_left or l & up else exit_up_left) |
+        (0 if mask & (up | exit_right) or a & exit_right or r & up else exit_up_right) |
+        (0 if mask & (down | exit_left) or b & exit_left or l & down else exit_down_left) |
+        (0 if mask & (down | exit_right) or b & exit_right or r & down else exit_down_right)
+        for mask, a, b, l, r in zip(cells, above, below, left, right)])
+
+class CollisionModel(object):
+    def __init__(self, cols, rows, collision):
+        self.cols = cols
+        self.rows = rows
+        self.flags = array.array('B', collision)
+        self.walkable = dict((movement_class, get_walkable_cells(self.flags, movement_class)) for movement_class in movement_classes)
+        self.blocked = get_blocked_cells(cols, rows, self.flags)
+        self.exits = get_exit_cells(cols, rows, self.blocked)
+
+    def copy(self):
+        # Walkability changes per map instance; directions never change
+        model = CollisionModel.__new__(CollisionModel)
+        model.__dict__.update(self.__dict__)
+        model.flags = array.array('B', self.flags)
+        model.walkable = dict((movement_class, array.array('B', cells)) for movement_class, cells in self.walkable.items())
+        return model
+
+    def is_walkable(self, index, movement_class='all'):
+        return self.walkable[movement_class][index] != 0
+
+    def set_walkable(self, index, walkable):
+        # For every movement class, as the Collision layer's 'All' does
+        if walkable:
+            self.flags[index] &= ~mapfile.unwalkable
+        else:
+            self.flags[index] |= mapfile.unwalkable
+        for movement_class, mask in movement_classes.items():
+            self.walkable[movement_class][index] = 0 if self.flags[index] & mask else 1
+
+    def can_move(self, index, dx, dy):
+        # Whether walls or the map edge allow a step of (dx, dy) from the cell
+        return (self.exits[index] & exit_directions[dx, dy]) != 0
@@ -0,0 +1,653 @@
+# Combat rules, independent of rendering and timing.  CombatWorld drives a
+# Combat instance and animates it through the listener hooks; resolve_encounter
+# runs a whole fight synchronously for balancing.
+
+import random
+
+def weighted_choice(seq, weight_key, rng=random):
+    total = sum(weight_key(c) for c in seq)
+    r = rng.uniform(0, total)
+    upto = 0
+    for c in seq:
+        w = weight_key(c)
+        if upto + w > r:
+            return c
+        upto += w
+    return seq[-1]
+
+def clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+class Slot(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.character = None
+        self.sprite = None
+
+class Effect(object):
+    id = None
+    apply_to_source = False
+    function = None
+    rounds_min = None
+    rounds_max = None
+    attribute = None
+    value = None
+
+    def _add_value(self, character, value, party, combat):
+        if self.attribute == 'spin':
+            character.spin = clamp(character.spin + value, 0, character.max_spin)
+        elif self.attribute == 'votes':
+            if combat:
+                combat.apply_damage(character, -value)
+            else:
+                character.votes = clamp(character.votes + value, 0, character.max_votes)
+        elif self.attribute == 'wit':
+            character.wit = max(0, character.wit + value)
+        elif self.attribute == 'cunning':
+            character.cunning = max(0, character.cunning + value)
+        elif self.attribute == 'charisma':
+            character.charisma = max(0, character.charisma + value)
+        elif self.attribute == 'flair':
+            character.flair = max(0, character.flair + value)
+        elif self.attribute == 'resistance':
+            character.resistance = max(0, character.resistance + value)
+        elif self.attribute == 'money':
+            party.money = max(0, party.money + value)
+
+    def apply(self, character, party, combat=None):
+        if self.function == 'reduce':
+            self._add_value(character, -self.value, party, combat)
+        elif self.function == 'add' or self.function == 'add_permanent':
+            self._add_value(character, self.value, party, combat)
+        elif self.function == 'revive':
+            character.votes = int(character.max_votes * self.value)
+            combat.set_dead(character, False)
+            combat.add_floater(character, 'Revived!', 'info')
+        elif self.function == 'call_friends':
+            character_id, level = self.attribute.split(':')
+            combat.call_friends(character_id, int(level), self.value)
+
+    def unapply(self, character, party, combat=None):
+        if self.function == 'reduce':
+            self._add_value(character, self.value, party, combat)
+        elif self.function == 'add':
+            self._add_value(character, -self.value, party, combat)
+
+    def update(self, character, party, combat):
+        if self.function == 'drain':
+            combat.add_floater(character, self.id, 'info', 1)
+            self._add_value(character, -self.value, party, combat)
+
+class ActiveEffect(object):
+    def __init__(self, effect, rounds):
+        self.effect = effect
+        self.rounds = rounds
+
+class ItemAttack(object):
+    def __init__(self, attack, quantity=1):
+        self.attack = attack
+        self.quantity = quantity
+
+def add_attack_to_itemattack_list(item_attacks, attack):
+    for ia in item_attacks:
+        if ia.attack is attack:
+            ia.quantity += 1
+            return
+    item_attacks.append(ItemAttack(attack, 1))
+
+class Character(object):
+    accumulated_spin_damage = 0
+
+    def __init__(self, data, id, level, item_attacks, ai=True, rng=random):
+        level = int(level)
+        self.id = id
+        self.level = level
+        level_row = data.levels[level - 1]
+        self.xp = level_row.xp
+        self.ai = ai
+        self.dead = False
+        self.summoning_sickness = True
+        self.data = row = rng.choice(data.characters[id])
+        if ai:
+            self.votes = self.max_votes = self.calc_stat(row.votes_base, row.votes_lvl)
+            self.spin = self.max_spin = self.calc_stat(row.spin_base, row.spin_lvl)
+        else:
+            self.votes = self.max_votes = level_row.votes
+            self.max_spin = level_row.spin
+            self.spin = 0
+
+        self.speed = self.calc_stat(row.speed_base, row.speed_lvl)
+        self.wit = self.calc_stat(row.wit_base, row.wit_lvl)
+        self.cunning = self.calc_stat(row.cunning_base, row.cunning_lvl)
+        self.charisma = self.calc_stat(row.charisma_base, row.charisma_lvl)
+        self.flair = self.calc_stat(row.flair_base, row.flair_lvl)
+        self.resistance = 0
+        self.active_effects = []
+        self.item_attacks = item_attacks
+
+        if ai:
+            self.spin_attacks = row.spin_attacks
+            self.standard_attacks = row.standard_attacks
+        else:
+            self.spin_attacks = list(row.spin_attacks)
+            self.standard_attacks = list(row.standard_attacks)
+
+    def add_item_attack(self, attack):
+        add_attack_to_itemattack_list(self.item_attacks, attack)
+
+    def remove_item_attack(self, attack):
+        for ia in self.item_attacks:
+            if ia.attack is attack:
+                ia.quantity -= 1
+                if ia.quantity == 0:
+                    self.item_attacks.remove(ia)
+                return
+
+    def calc_stat(self, base, exp):
+        return base + (self.level - 1) * exp
+
+    def add_active_effect(self, active_effect, combat):
+        for ae in self.active_effects:
+            if ae.effect.id == active_effect.effect.id:
+                return
+
+        self.active_effects.append(active_effect)
+        active_effect.effect.apply(self, combat.party, combat)
+        combat.debug.println('Add effect %s to %s' % (active_effect.effect.id, self.id))
+
+        if active_effect.rounds == 0:
+            self.remove_active_effect(active_effect, combat)
+
+    def remove_active_effect(self, active_effect, combat):
+        active_effect.effect.unapply(self, combat.party, combat)
+        self.active_effects.remove(active_effect)
+        combat.debug.println('Remove effect %s from %s' % (active_effect.effect.id, self.id))
+
+    def remove_all_active_effects(self, combat):
+        for ae in self.active_effects[:]:
+            self.remove_active_effect(ae, combat)
+
+    def has_effect_function(self, function):
+        for ae in self.active_effects:
+            if ae.effect.function == function:
+                return True
+        return False
+
+    def get_effects_abbrv(self):
+        return ' '.join(ae.effect.abbrv for ae in self.active_effects)
+
+class Party(object):
+    def __init__(self, allies, item_attacks, money=0):
+        self.allies = allies
+        self.item_attacks = item_attacks
+        self.money = money
+
+class NullDebug(object):
+    massive_damage = False
+
+    def println(self, msg):
+        pass
+
+class CombatListener(object):
+    # Presentation hooks called by Combat.  CombatWorld implements the same
+    # methods to create sprites, floaters and delays; this version does nothing
+    # so fights resolve immediately.
+
+    def after(self, timeout, func):
+        func()
+
+    def on_slot_filled(self, slot):
+        pass
+
+    def on_slot_cleared(self, slot):
+        pass
+
+    def on_dead(self, character, dead):
+        pass
+
+    def on_floater(self, character, text, style, offset=0):
+        pass
+
+class Combat(object):
+    def __init__(self, data, encounter, party, player_slots, monster_slots, rng=random, debug=None, listener=None):
+        self.data = data
+        self.encounter = encounter
+        self.party = party
+        self.player_slots = player_slots
+        self.monster_slots = monster_slots
+        self.slots = player_slots + monster_slots
+        self.rng = rng
+        self.debug = debug or NullDebug()
+        self.listener = listener or CombatListener()
+        self.characters = []
+        self.current_character_index = -1
+        self.ai_item_attacks = []
+
+    def start(self):
+        encounter = self.encounter
+        for i, ally in enumerate(self.party.allies):
+            ally.accumulated_spin_damage = 0
+            self.fill_slot(self.player_slots[i], ally)
+
+        self.ai_item_attacks = list(encounter.item_attacks)
+        monsters = [(encounter.monster1, encounter.monster1_lvl),
+                    (encounter.monster2, encounter.monster2_lvl),
+                    (encounter.monster3, encounter.monster3_lvl),
+                    (encounter.monster4, encounter.monster4_lvl)]
+        for slot, (character_id, level) in zip(self.monster_slots, monsters):
+            if character_id:
+                self.fill_slot(slot, self.create_monster(character_id, level))
+
+    def create_monster(self, character_id, level):
+        return Character(self.data, character_id, level, self.ai_item_attacks, rng=self.rng)
+
+    def fill_slot(self, slot, character):
+        slot.character = character
+        self.characters.append(character)
+        self.listener.on_slot_filled(slot)
+
+    def get_slot(self, character):
+        for slot in self.slots:
+            if slot.character is character:
+                return slot
+        return None
+
+    @property
+    def current_character(self):
+        if self.current_character_index >= 0:
+            return self.characters[self.current_character_index]
+
+    @property
+    def round_over(self):
+        return self.current_character_index < 0 or self.current_character_index >= len(self.characters)
+
+    def begin_round(self):
+        for character in self.characters:
+            character.summoning_sickness = False
+        self.characters.sort(key=lambda c:c.speed, reverse=True)
+        self.current_character_index = 0
+        while self.current_character_index < len(self.characters) and self.current_character.dead:
+            self.current_character_index += 1
+
+    def next_character(self):
+        self.current_character_index += 1
+        while self.current_character_index < len(self.characters) and \
+            (self.current_character.dead or self.current_character.summoning_sickness):
+            self.current_character_index += 1
+
+    def update_effect(self, character, ae):
+        ae.rounds -= 1
+        self.debug.println('Update effect %s on %s' % (ae.effect.id, character.id))
+        ae.effect.update(character, self.party, self)
+        if ae.rounds <= 0:
+            character.remove_active_effect(ae, self)
+
+    def get_outcome(self):
+        win = True
+        lose = True
+        for character in self.characters:
+            if not character.dead:
+                if character.ai:
+                    win = False
+                else:
+                    lose = False
+
+        if win:
+            return 'win'
+        elif lose:
+            return 'lose'
+        return None
+
+    def reset(self):
+        for character in self.characters:
+            character.remove_all_active_effects(self)
+            if character.dead:
+                character.dead = False
+                character.votes = character.max_votes / 2
+
+    def get_sides(self, character):
+        # Returns (friendly_slots, enemy_slots) from the point of view of character
+        if character.ai:
+            return self.monster_slots, self.player_slots
+        return self.player_slots, self.monster_slots
+
+    def get_target_slots(self, source, target_type):
+        friendly_slots, enemy_slots = self.get_sides(source)
+        if target_type == 'AllEnemy':
+            slots = [slot for slot in enemy_slots if slot.character and not slot.character.dead]
+        elif target_type == 'AllFriendly':
+            slots = [slot for slot in friendly_slots if slot.character and not slot.character.dead]
+        elif target_type == 'DeadFriendly':
+            slots = [slot for slot in friendly_slots if slot.character and slot.character.dead]
+        elif target_type == 'All':
+            slots = [slot for slot in self.slots if slot.character and not slot.character.dead]
+        elif target_type == 'None':
+            slots = [self.get_slot(source)]
+        else:
+            assert False, 'Unsupported target type'
+        slots.sort(key=lambda slot: slot.x)
+        return slots
+
+    def choose_ai_action(self, source):
+        friendly_slots, enemy_slots = self.get_sides(source)
+
+        # List of all possible attacks
+        attacks = list(source.standard_attacks)
+
+        # Add spin attacks we can afford
+        attacks += [a for a in source.spin_attacks if a.spin_cost <= source.spin]
+
+        # Add item attacks
+        attacks += [ia.attack for ia in source.item_attacks if ia.attack.spin_cost <= source.spin]
+
+        # Bribes are only offered to the player when they can pay
+        if not source.ai and self.party.money < self.encounter.bribe_cost:
+            attacks = [attack for attack in attacks if attack.underlying_stat != 'Money']
+
+        # Filter health gain attacks
+        health_targets = [slot.character for slot in friendly_slots if slot.character and not slot.character.dead and slot.character.votes < slot.character.max_votes]
+        if health_targets:
+            health_gain_max = max(character.max_votes - character.votes for character in health_targets)
+        else:
+            health_gain_max = 0
+        attacks = [attack for attack in attacks if attack.health_benefit <= health_gain_max]
+
+        # Filter revive attacks
+        revive_targets = [slot.character for slot in friendly_slots if slot.character and slot.character.dead]
+        if not revive_targets:
+            attacks = [attack for attack in attacks if not attack.is_revive]
+
+        # Filter summon attacks
+        can_summon = len([slot for slot in friendly_slots if not slot.character or slot.character.dead]) > 0
+        if not can_summon:
+            attacks = [attack for attack in attacks if not attack.is_summon]
+
+        # Random choice of attack
+        attack = weighted_choice(attacks, lambda a: a.weight, self.rng)
+
+        # Calculate target slots
+        slots = self.get_target_slots(source, attack.target_type)
+        target_count = min(attack.target_count, len(slots))
+        max_slot_index = len(slots) - target_count + 1
+        slot_index = -1
+
+        # Choose slot to revive
+        if attack.is_revive:
+            for i, slot in enumerate(slots):
+                if slot.character.dead:
+                    slot_index = i
+                    break
+
+        # Choose slot for health benefit
+        if slot_index == -1 and attack.health_benefit > 0:
+            best_health = 0
+            for i, slot in enumerate(slots):
+                health = slot.character.max_votes - slot.character.votes
+                if health > best_health:
+                    best_health = health
+                    slot_index = i
+
+        # Choose slot randomly
+        if slot_index == -1:
+            slot_index = self.rng.randrange(0, max_slot_index)
+
+        targets = [slot.character for slot in slots[slot_index:slot_index + target_count]]
+        return attack, targets
+
+    def call_friends(self, character_id, level, count):
+        did_destroy = False
+        for slot in self.monster_slots:
+            if slot.character and slot.character.dead:
+                self.listener.on_slot_cleared(slot)
+                slot.character = None
+                did_destroy = True
+
+        if did_destroy:
+            self.listener.after(0.5, lambda: self.summon(character_id, level, count))
+        else:
+            self.summon(character_id, level, count)
+
+    def summon(self, character_id, level, count):
+        for slot in self.monster_slots:
+            if not slot.character:
+                self.fill_slot(slot, self.create_monster(character_id, level))
+                count -= 1
+                if count == 0:
+                    return
+
+    def attack(self, source, attack, targets):
+        rng = self.rng
+        debug = self.debug
+
+        if not attack.underlying_stat:
+            base_stat = 0
+        elif attack.underlying_stat == 'Cunning':
+            base_stat = max(source.cunning, 0)
+        elif attack.underlying_stat == 'Wit':
+            base_stat = max(source.wit, 0)
+        elif attack.underlying_stat == 'Money':
+            base_stat = max(source.cunning, 0)
+            self.party.money = max(0, self.party.money - self.encounter.bribe_cost)
+            debug.println('%s consumed %d money, has %d remaining' % (source.id, self.encounter.bribe_cost, self.party.money))
+        else:
+            assert False
+
+        # Health attacks (negative damage) need negative base_stat
+        if attack.base_damage_min < 0:
+            base_stat = -base_stat
+
+        # Consume spin
+        if attack.spin_cost:
+            source.spin = max(0, source.spin - attack.spin_cost)
+            debug.println('%s consumed %d spin, has %d remaining' % (source.id, attack.spin_cost, source.spin))
+
+        # Consume item
+        if (not attack in source.spin_attacks) and (not attack in source.standard_attacks):
+            debug.println('%s consumed item %s' % (source.id, attack.name))
+            source.remove_item_attack(attack)
+
+        # Apply effects to source
+        critical_fail_effect = None
+        for effect in attack.effects:
+            if effect.id == 'Critical Fail':
+                critical_fail_effect = effect
+            else:
+                rounds = rng.randrange(effect.rounds_min, effect.rounds_max + 1)
+                if effect.apply_to_source:
+                    source.add_active_effect(ActiveEffect(effect, rounds), self)
+
+        # Attack targets
+        critical_fail = True
+        total_damage = 0
+        for target in targets:
+            floater_offset = 1
+            # Immunity
+            if attack in target.data.immunities:
+                self.add_floater(target, 'Immune', 'info')
+                debug.println('%s is immune to %s' % (target.id, attack.name))
+                continue
+
+            # Crit
+            modifiers = 0
+            if attack.crit_chance_max:
+                crit_chance = rng.randrange(attack.crit_chance_min, attack.crit_chance_max + 1)
+                crit_success = rng.randrange(0, 100) <= crit_chance + source.flair
+                debug.println('crit_chance = %s, crit_success = %s, flair = %s' % (crit_chance, crit_success, source.flair))
+            else:
+                crit_success = False
+                debug.println('no crit chance calculated')
+
+            # Damage
+            if crit_success:
+                self.add_floater(target, 'Critical Hit!', 'info', floater_offset)
+                floater_offset += 1
+                debug.println('Critical hit')
+                damage = base_stat + (attack.crit_base_damage + modifiers)
+            else:
+                damage = base_stat + (rng.randrange(attack.base_damage_min, attack.base_damage_max + 1) + modifiers)
+
+            # Cheat damage
+            if debug.massive_damage and not source.ai:
+                damage *= 100
+
+            if damage > 0:
+                # Charisma
+                damage = max(0, damage - target.charisma)
+
+                # Resistance and weakness
+                if attack in target.data.resistance:
+                    self.add_floater(target, 'Resist', 'info', floater_offset)
+                    floater_offset += 1
+                    debug.println('%s is resistant to %s' % (target.id, attack.name))
+                    damage -= damage * 0.3
+                elif attack in target.data.weaknesses:
+                    self.add_floater(target, 'Weakness', 'info', floater_offset)
+                    floater_offset += 1
+                    debug.println('%s is weak to %s' % (target.id, attack.name))
+                    damage += damage * 0.3
+
+                # Global resistance (defense)
+                if target.resistance:
+                    self.add_floater(target, 'Defends', 'info', floater_offset)
+                    floater_offset += 1
+                    debug.println('%s defends' % target.id)
+                damage -= damage * min(1, target.resistance)
+
+            tried_damage = attack.base_damage_min != 0 or attack.base_damage_max != 0 or attack.crit_base_damage != 0
+            if not tried_damage or damage != 0:
+                critical_fail = False
+
+            # Apply damage
+            damage = int(damage)
+            if tried_damage:
+                self.apply_damage(target, damage)
+
+            # Apply target effects
+            for effect in attack.effects:
+                rounds = rng.randrange(effect.rounds_min, effect.rounds_max + 1)
+                if not effect.apply_to_source:
+                    target.add_active_effect(ActiveEffect(effect, rounds), self)
+
+            debug.println('%s attacks %s with %s for %d' % (source.id, target.id, attack.name, damage))
+
+            if damage > 0:
+                total_damage += damage
+
+        # Award spin for total damage
+        if attack.spin_cost == 0:
+            self.award_spin(source, max(0, total_damage))
+
+        # Critical fail effect
+        if critical_fail and critical_fail_effect:
+            debug.println('Critical fail')
+            rounds = rng.randrange(effect.rounds_min, critical_fail_effect.rounds_max + 1)
+            if effect.apply_to_source:
+                source.add_active_effect(ActiveEffect(critical_fail_effect, rounds), self)
+                self.add_floater(source, 'Critical fail', 'info')
+
+    def apply_damage(self, target, damage):
+        target.votes -= damage
+        target.votes = int(clamp(target.votes, 0, target.max_votes))
+
+        if damage >= 0:
+            self.add_floater(target, '%d' % damage, 'damage')
+        elif damage < 0:
+            self.add_floater(target, '%d' % -damage, 'heal')
+
+        if target.votes == 0:
+            target.votes = 0
+            self.set_dead(target, True)
+
+    def set_dead(self, character, dead):
+        character.dead = dead
+        self.listener.on_dead(character, dead)
+
+    def award_spin(self, target, damage):
+        bonus = (damage + target.accumulated_spin_damage + max(target.wit, 0)) / 5
+        if bonus <= 0:
+            target.accumulated_spin_damage += damage
+        else:
+            target.accumulated_spin_damage = 0
+
+        self.debug.println('Awarded %d spin; %d left over damage for next time' % (bonus, target.accumulated_spin_damage))
+        target.spin = min(target.spin + bonus, target.max_spin)
+
+    def add_floater(self, character, text, style, offset=0):
+        self.listener.on_floater(character, text, style, offset)
+
+    def play_turn(self):
+        # Plays the current character's turn with the AI choosing for both
+        # sides, then advances to the next character.  Returns the outcome
+        # once one side is defeated.
+        if self.round_over:
+            self.begin_round()
+
+        character = self.current_character
+        miss_turn = character.has_effect_function('miss_turn')
+        for ae in character.active_effects[:]:
+            if character.dead:
+                break
+            self.update_effect(character, ae)
+
+        if not character.dead and not miss_turn:
+            attack, targets = self.choose_ai_action(character)
+            self.attack(character, attack, targets)
+
+        outcome = self.get_outcome()
+        if not outcome:
+            self.next_character()
+        return outcome
+
+class CombatResult(object):
+    def __init__(self, encounter_id, outcome, rounds, turns, votes_lost, spin_used):
+        self.encounter_id = encounter_id
+        self.outcome = outcome
+        self.rounds = rounds
+        self.turns = turns
+        self.votes_lost = votes_lost
+        self.spin_used = spin_used
+
+    @property
+    def won(self):
+        return self.outcome == 'win'
+
+def create_party(data, level, ally_ids=(), rng=random, money=0):
+    item_attacks = []
+    allies = [Character(data, 'Player', level, item_attacks, False, rng)]
+    for ally_id in ally_ids:
+        allies.append(Character(data, ally_id, level, item_attacks, False, rng))
+    return Party(allies, item_attacks, money)
+
+def resolve_encounter(data, encounter_id, party, rng=random, max_turns=500):
+    # Runs the whole encounter synchronously.  Outcome is 'win', 'lose' or
+    # 'timeout' if neither side is defeated within max_turns.
+    encounter = data.encounters[encounter_id]
+    player_slots = [Slot(i, 0) for i in range(4)]
+    monster_slots = [Slot(i, 1) for i in range(4)]
+    combat = Combat(data, encounter, party, player_slots, monster_slots, rng)
+    combat.start()
+
+    start_votes = sum(ally.votes for ally in party.allies)
+    spin_used = 0
+
+    outcome = None
+    rounds = 0
+    turns = 0
+    while not outcome and turns < max_turns:
+        if combat.round_over:
+            combat.begin_round()
+            rounds += 1
+        character = combat.current_character
+        spin = character.spin
+        outcome = combat.play_turn()
+        if not character.ai:
+            spin_used += max(0, spin - character.spin)
+        turns += 1
+
+    end_votes = sum(ally.votes for ally in party.allies)
+    if start_votes:
+        votes_lost = float(start_votes - end_votes) / start_votes
+    else:
+        votes_lost = 0.0
+    return CombatResult(encounter_id, outcome or 'timeout', rounds, turns, votes_lost, spin_used)
@@ -1,6 +1,8 @@
 import bacon
 
 class Rect(object):
+    __slots__ = ['x1', 'y1', 'x2', 'y2']
+
     def __init__(self, x1, y1, x2, y2):
         self.x1 = x1
         self.y1 = y1
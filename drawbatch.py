@@ -0,0 +1,76 @@
+# Batched image drawing.  Quads are collected with add() and submitted
+# together by flush(), grouped by the atlas (source image) they come from so
+# the renderer switches textures as rarely as possible.
+#
+# Grouping reorders quads, so quads that may overlap and come from different
+# atlases must be separated with split(), e.g. between tile layers.  A batch
+# holds quads in the current transform and color; flush before changing
+# either, and before drawing anything that doesn't go through the batch.
+
+import bacon
+
+def get_atlas(image):
+    # Regions made by tiled and UI are tagged with the image they were cut from
+    return getattr(image, 'atlas', image)
+
+def set_atlas(region, image):
+    region.atlas = get_atlas(image)
+    return region
+
+class DrawBatch(object):
+    def __init__(self):
+        self.groups = []
+        self.quads = {}
+        self.atlases = []
+
+        # Totals for the current frame and the last finished one
+        self.quad_count = 0
+        self.flush_count = 0
+        self.last_quad_count = 0
+        self.last_flush_count = 0
+
+    def begin_frame(self):
+        self.last_quad_count = self.quad_count
+        self.last_flush_count = self.flush_count
+        self.quad_count = 0
+        self.flush_count = 0
+
+    def add(self, image, x1, y1, x2=None, y2=None):
+        if x2 is None:
+            x2 = x1 + image.width
+        if y2 is None:
+            y2 = y1 + image.height
+        atlas = get_atlas(image)
+        quads = self.quads.get(atlas)
+        if quads is None:
+            quads = self.quads[atlas] = []
+            self.atlases.append(atlas)
+        quads.append((image, x1, y1, x2, y2))
+
+    def split(self):
+        # Quads added after this are drawn after all quads added before it
+        if self.atlases:
+            self.groups.append((self.atlases, self.quads))
+            self.atlases = []
+            self.quads = {}
+
+    def flush(self):
+        self.split()
+        if not self.groups:
+            return
+
+        quads = []
+        for atlases, atlas_quads in self.groups:
+            for atlas in atlases:
+                quads.extend(atlas_quads[atlas])
+        del self.groups[:]
+
+        self.quad_count += len(quads)
+        self.flush_count += 1
+        submit(quads)
+
+def submit(quads):
+    for image, x1, y1, x2, y2 in quads:
+        bacon.draw_image(image, x1, y1, x2, y2)
+
+batch = DrawBatch()
@@ -0,0 +1,123 @@
+# Flow fields: a distance map from every cell of a map to one goal cell, for
+# a movement class, so any number of movers heading to the same goal each
+# read their next step with an array lookup instead of searching a path.
+#
+# A field is a Dijkstra search outwards from the goal, with the same moves and
+# costs as pathfind.  Fields are built a slice at a time within a time budget
+# each frame, nearest cells first, so movers near the goal get directions
+# straight away and a new field never causes a hitch.  Changing walkability
+# restarts every field of the map.  As with pathfind, a mover may start on a
+# cell it can't walk on: such cells get a step out but aren't passed through.
+# The least recently used fields are dropped once more than max_size are
+# cached.
+
+import array
+import collections
+import heapq
+import timeit
+
+import pathfind
+
+timer = timeit.default_timer
+
+infinity = float('inf')
+
+class FlowField(object):
+    def __init__(self, model, goal, movement_class='all'):
+        self.goal = goal
+        self.movement_class = movement_class
+        size = model.cols * model.rows
+        self.distances = array.array('d', [infinity]) * size
+        self.next_cells = array.array('i', [-1]) * size
+        self.straight_moves = pathfind.get_straight_moves(model.cols)
+        self.diagonal_moves = pathfind.get_diagonal_moves(model.cols)
+        self.reset(model)
+
+    def reset(self, model):
+        # Starts the search again, e.g. when walkability has changed
+        self.model = model
+        size = len(self.distances)
+        self.distances[:] = array.array('d', [infinity]) * size
+        self.next_cells[:] = array.array('i', [-1]) * size
+        self.open = []
+        if 0 <= self.goal < size and model.walkable[self.movement_class][self.goal]:
+            self.distances[self.goal] = 0.0
+            self.open.append((0.0, self.goal))
+
+    @property
+    def complete(self):
+        return not self.open
+
+    def build(self, max_cells):
+        # Settles up to max_cells more cells; moves are symmetric, so a move
+        # from the cell to a neighbour means the neighbour can step back
+        walkable = self.model.walkable[self.movement_class]
+        exits = self.model.exits
+        distances = self.distances
+        next_cells = self.next_cells
+        open = self.open
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        diagonal_cost = pathfind.diagonal_cost
+        while open and max_cells > 0:
+            distance, i = heappop(open)
+            if distance > distances[i]:
+                continue
+            max_cells -= 1
+            if not walkable[i]:
+                continue
+            cell_exits = exits[i]
+            for offset, exit in self.straight_moves:
+                j = i + offset
+                if cell_exits & exit and distance + 1 < distances[j]:
+                    distances[j] = distance + 1
+                    next_cells[j] = i
+                    heappush(open, (distance + 1, j))
+            for offset, exit, side1, side2 in self.diagonal_moves:
+                j = i + offset
+                if cell_exits & exit and walkable[i + side1] and walkable[i + side2] and \
+                    distance + diagonal_cost < distances[j]:
+                    distances[j] = distance + diagonal_cost
+                    next_cells[j] = i
+                    heappush(open, (distance + diagonal_cost, j))
+
+    def get_next_cell(self, i):
+        # The cell to step to from cell i towards the goal, or -1 when the
+        # goal isn't reachable from it or the field hasn't reached it yet
+        return self.next_cells[i]
+
+    def get_distance(self, i):
+        return self.distances[i]
+
+class FlowFieldCache(object):
+    def __init__(self, model, max_size=16, budget=0.002):
+        # budget is the seconds each update() may spend building fields
+        self.model = model
+        self.max_size = max_size
+        self.budget = budget
+        self.fields = collections.OrderedDict()
+
+    def get(self, goal, movement_class='all'):
+        key = (goal, movement_class)
+        field = self.fields.pop(key, None)
+        if field is None:
+            field = FlowField(self.model, goal, movement_class)
+            if len(self.fields) >= self.max_size:
+                self.fields.popitem(last=False)
+        self.fields[key] = field
+        return field
+
+    def invalidate(self, model):
+        self.model = model
+        for field in self.fields.values():
+            field.reset(model)
+
+    def update(self):
+        # Builds incomplete fields, most recently used first, in slices so the
+        # time budget is checked as it goes
+        start = timer()
+        for field in reversed(self.fields.values()):
+            while not field.complete:
+                field.build(256)
+                if timer() - start > self.budget:
+                    return
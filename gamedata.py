@@ -0,0 +1,580 @@
+# Game data tables: importing from the design spreadsheets and the binary
+# bundle (res/game_data.bin) the game loads at startup.
+#
+# The bundle stores each table as flat columns of plain values, with strings
+# interned in a shared string table and object references stored as row
+# indices into the referenced table.  No class names are written, so the data
+# survives refactoring, and each table is only decoded on first access.
+
+import hashlib
+import logging
+import marshal
+import os
+import StringIO
+import struct
+
+from combat import Effect, ItemAttack, add_attack_to_itemattack_list
+import questscript
+
+class TableRow(object):
+    pass
+
+def parse_table(table, columns, cls=TableRow, index_unique=False, index_multi=False):
+    headers = table[0]
+    column_map = []
+    column_count = 0
+    for name, header in columns.items():
+        index = headers.index(header)
+        if index != -1:
+            column_map.append((index, name))
+            column_count = max(column_count, index + 1)
+        else:
+            logging.warn('Unmapped column "%s"' % header)
+
+    if index_unique or index_multi:
+        obj_table = {}
+    else:
+        obj_table = []
+
+    for row in table[1:]:
+        if len(row) < column_count:
+            row.extend([''] * (column_count - len(row)))
+
+        if row[0] == '':
+            continue
+
+        obj_row = cls()
+        for i, name in column_map:
+            setattr(obj_row, name, row[i])
+
+        if index_multi:
+            key = row[0]
+            if key not in obj_table:
+                obj_table[key] = []
+            obj_table[key].append(obj_row)
+        elif index_unique:
+            key = row[0]
+            obj_table[key] = obj_row
+        else:
+            obj_table.append(obj_row)
+
+    return obj_table
+
+class GameData(object):
+    pass
+
+def convert_idlist_to_objlist(value, index):
+    result = []
+    for id in value.split(','):
+        id = id.strip()
+        if id:
+            result.append(index[id])
+    return result
+
+def ai_get_health_benefit(attack):
+    # Get min health benefit
+    if attack.target_type != 'AllFriendly' and attack.target_type != 'None':
+        return 0
+
+    h = max(0, -attack.base_damage_max)
+    for effect in attack.effects:
+        if effect.attribute == 'votes' and effect.function == 'add_permanent':
+            h += effect.value
+
+    return h
+
+def ai_is_revive_attack(attack):
+    for effect in attack.effects:
+        if effect.function == 'revive':
+            return True
+    return False
+
+def ai_is_summon_attack(attack):
+    for effect in attack.effects:
+        if effect.function == 'call_friends':
+            return True
+    return False
+
+def build_quest_items(data, sheets):
+    data.quest_items = parse_table(sheets['Quest.ods', 'Items'], dict(id = 'ID',
+        name = 'Name',
+        description = 'Description',), index_unique=True)
+
+def build_effects(data, sheets):
+    data.effects = parse_table(sheets['Combat.ods', 'Effects'], dict(id = 'ID',
+        abbrv = 'Abbrev',
+        apply_to_source = 'Apply To Source',
+        function = 'Function',
+        rounds_min = 'Number Rounds Base',
+        rounds_max = 'Number Rounds Max',
+        attribute = 'Attribute Effected',
+        value = 'Value',), index_unique=True, cls=Effect)
+
+def build_attacks(data, sheets):
+    data.attacks = parse_table(sheets['Combat.ods', 'Attacks'], dict(id = 'ID',
+        name = 'Attack Name',
+        description = 'Description',
+        spin_cost = 'Spin Cost',
+        target_type = 'Target Type',
+        target_count = 'Target Count',
+        underlying_stat = 'Underlying Stat',
+        effects = 'Special Effects',
+        base_damage_min = 'Base Damage',
+        base_damage_max = 'Max Base Damage',
+        crit_base_damage = 'Crit Base Damage',
+        crit_chance_min = 'Chance To Crit Base (%)',
+        crit_chance_max = 'Chance To Crit Max (%)',
+        weight = 'AI Weight',), index_unique=True)
+
+    for attack in data.attacks.values():
+        attack.target_count = int(attack.target_count)
+        attack.effects = convert_idlist_to_objlist(attack.effects, data.effects)
+        attack.spin_cost = attack.spin_cost if attack.spin_cost else 0
+        attack.weight = attack.weight if attack.weight else 1
+        attack.health_benefit = ai_get_health_benefit(attack)
+        attack.is_revive = ai_is_revive_attack(attack)
+        attack.is_summon = ai_is_summon_attack(attack)
+
+def build_standard_attacks(data, sheets):
+    data.standard_attacks = parse_table(sheets['Combat.ods', 'StandardAttacks'], dict(group = 'AttackGroup',
+        attack = 'Attack',), index_multi=True)
+
+    for attacks in data.standard_attacks.values():
+        for i, row in enumerate(attacks):
+            attacks[i] = data.attacks[row.attack]
+
+def build_characters(data, sheets):
+    data.characters = parse_table(sheets['Combat.ods', 'Characters'], dict(id = 'ID',
+        name = 'Name',
+        votes_base = 'Votes',
+        votes_lvl = 'Votes Lvl',
+        spin_base = 'SP',
+        spin_lvl = 'SP Lvl',
+        speed_base = 'Spd',
+        speed_lvl = 'Spd Lvl',
+        wit_base = 'Wit',
+        wit_lvl = 'Wit Lvl',
+        cunning_base = 'Cun',
+        cunning_lvl = 'Cun Lvl',
+        charisma_base = 'Cha',
+        charisma_lvl = 'Cha Lvl',
+        flair_base = 'Flr',
+        flair_lvl = 'Flr Lvl',
+        attack_group = 'AttackGroup',
+        immunities = 'Immunities',
+        resistance = 'Resistance',
+        weaknesses = 'Weaknesses',), index_multi=True)
+
+    # Parse characters
+    for characters in data.characters.values():
+        for character in characters:
+            character.immunities = convert_idlist_to_objlist(character.immunities, data.attacks)
+            character.resistance = convert_idlist_to_objlist(character.resistance, data.attacks)
+            character.weaknesses = convert_idlist_to_objlist(character.weaknesses, data.attacks)
+            attacks = data.standard_attacks[character.attack_group]
+            character.spin_attacks = [attack for attack in attacks if attack.spin_cost]
+            character.standard_attacks = [attack for attack in attacks if not attack.spin_cost]
+
+def build_encounters(data, sheets):
+    data.encounters = parse_table(sheets['Combat.ods', 'Encounters'], dict(id = 'ID',
+        name = 'Name',
+        monster1 = 'Monster 1',
+        monster1_lvl = 'Monster 1 Lvl',
+        monster2 = 'Monster 2',
+        monster2_lvl = 'Monster 2 Lvl',
+        monster3 = 'Monster 3',
+        monster3_lvl = 'Monster 3 Lvl',
+        monster4 = 'Monster 4',
+        monster4_lvl = 'Monster 4 Lvl',
+        item_attacks = 'Attack Items',
+        bribe_cost = 'Bribe Cost',
+        xp = 'XP',
+        money = 'Money',
+        item_attack_drops = 'Attack Drops',), index_unique=True)
+
+    for encounter in data.encounters.values():
+        encounter.item_attacks = [ItemAttack(attack, 1) for attack in convert_idlist_to_objlist(encounter.item_attacks, data.attacks)]
+        attack_drops = convert_idlist_to_objlist(encounter.item_attack_drops, data.attacks)
+        encounter.item_attack_drops = []
+        for attack in attack_drops:
+            add_attack_to_itemattack_list(encounter.item_attack_drops, attack)
+
+def build_script(data, sheets):
+    data.script = parse_table(sheets['Quest.ods', 'Script'], dict(trigger = 'Trigger',
+        action = 'Action',
+        param = 'Param',
+        dialog = 'Dialog',), index_multi=True)
+
+def build_levels(data, sheets):
+    data.levels = parse_table(sheets['Levels.ods', 'Levels'], dict(level = 'Level',
+        xp = 'XP',
+        votes = 'Votes',
+        spin = 'Spin',
+        skill_points = 'Skill Points',))
+
+def build_shops(data, sheets):
+    data.shops = parse_table(sheets['Quest.ods', 'Shops'], dict(shop_id = 'ID',
+        item_attack = 'Attack Item',
+        price = 'Price',), index_multi=True)
+    for shop in data.shops.values():
+        for ware in shop:
+            ware.item_attack = data.attacks[ware.item_attack]
+
+def build_script_code(data, sheets):
+    data.script_code = questscript.compile_script(data)
+
+# (table, builder, source sheets, tables it links to), in dependency order.
+# import_ods rebuilds a table when one of its sheets changed or when a table
+# it links to was rebuilt, and keeps the previous bundle's table otherwise.
+import_steps = [
+    ('quest_items', build_quest_items, [('Quest.ods', 'Items')], []),
+    ('effects', build_effects, [('Combat.ods', 'Effects')], []),
+    ('attacks', build_attacks, [('Combat.ods', 'Attacks')], ['effects']),
+    ('standard_attacks', build_standard_attacks, [('Combat.ods', 'StandardAttacks')], ['attacks']),
+    ('characters', build_characters, [('Combat.ods', 'Characters')], ['attacks', 'standard_attacks']),
+    ('encounters', build_encounters, [('Combat.ods', 'Encounters')], ['attacks']),
+    ('script', build_script, [('Quest.ods', 'Script')], []),
+    ('levels', build_levels, [('Levels.ods', 'Levels')], []),
+    ('shops', build_shops, [('Quest.ods', 'Shops')], ['attacks']),
+    ('script_code', build_script_code, [], ['script', 'quest_items', 'encounters', 'attacks', 'characters', 'shops']),
+]
+
+import_files = ['Combat.ods', 'Quest.ods', 'Levels.ods']
+
+# The import cache lives next to the spreadsheets and holds the manifest of
+# content hashes for every source file and sheet, along with the parsed rows
+# of each sheet so unchanged sheets never need to be parsed again, and the
+# hash of the bundle written with it.
+import_cache_name = 'import_cache.bin'
+import_cache_version = 1
+
+def load_import_cache(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        cache = marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+        return None
+    finally:
+        f.close()
+    if not isinstance(cache, dict) or cache.get('version') != import_cache_version:
+        return None
+    return cache
+
+def save_import_cache(path, cache):
+    f = open(path, 'wb')
+    try:
+        marshal.dump(cache, f, 2)
+    finally:
+        f.close()
+
+def read_sheets(ods_dir, cache):
+    # Returns the rows of every sheet and the set of (file, sheet) that changed
+    # since the cache was written.  cache is updated in place.
+    import odsimport
+    sheets = {}
+    changed = set()
+    for filename in import_files:
+        content = odsimport.read_content(os.path.join(ods_dir, filename))
+        file_hash = hashlib.sha1(content).hexdigest()
+        if filename in cache['files'] and cache['files'][filename][0] == file_hash:
+            for name in cache['files'][filename][1]:
+                sheets[filename, name] = cache['sheets'][filename, name][1]
+            continue
+
+        sources = odsimport.read_sheet_sources(content)
+        if sources is None:
+            sheet_rows = [(name, None, rows) for name, rows in odsimport.parse_content(StringIO.StringIO(content)).items()]
+        else:
+            sheet_rows = []
+            for name, xml in sources.sheets:
+                sheet_hash = hashlib.sha1(xml).hexdigest()
+                cached = cache['sheets'].get((filename, name))
+                if cached and cached[0] == sheet_hash:
+                    sheet_rows.append((name, sheet_hash, cached[1]))
+                else:
+                    sheet_rows.append((name, sheet_hash, sources.parse(xml)))
+
+        for name, sheet_hash, rows in sheet_rows:
+            cached = cache['sheets'].get((filename, name))
+            if sheet_hash is None or not cached or cached[0] != sheet_hash:
+                changed.add((filename, name))
+            cache['sheets'][filename, name] = (sheet_hash, rows)
+            sheets[filename, name] = rows
+        cache['files'][filename] = (file_hash, [name for name, sheet_hash, rows in sheet_rows])
+
+    return sheets, changed
+
+def get_file_hash(path):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+def import_ods(ods_dir, bundle_path, incremental=True, previous=None):
+    # Tables whose sheets and dependencies are unchanged since the last import
+    # are taken from previous, the game data of that import, or else from the
+    # existing bundle at bundle_path.  Writes the new bundle, then the cache,
+    # so a failed save leaves the cache describing the bundle still on disk.
+    # The cache is ignored when the bundle isn't the one it was written with,
+    # e.g. after a checkout.
+    cache_path = os.path.join(ods_dir, import_cache_name)
+    cache = load_import_cache(cache_path) if incremental else None
+    if cache is not None and cache.get('bundle_hash') != get_file_hash(bundle_path):
+        cache = None
+    if cache is None:
+        cache = dict(version=import_cache_version, files={}, sheets={})
+        previous = None
+    elif previous is None:
+        try:
+            previous = load(bundle_path)
+        except (BundleError, IOError):
+            pass
+
+    sheets, changed = read_sheets(ods_dir, cache)
+
+    data = GameData()
+    rebuilt = set()
+    for name, builder, sources, dependencies in import_steps:
+        if (previous is None or
+            any(source in changed for source in sources) or
+            any(dependency in rebuilt for dependency in dependencies)):
+            builder(data, sheets)
+            rebuilt.add(name)
+        else:
+            setattr(data, name, getattr(previous, name))
+
+    save(data, bundle_path)
+    cache['bundle_hash'] = get_file_hash(bundle_path)
+    save_import_cache(cache_path, cache)
+    print 'Imported %s' % (', '.join(name for name, builder, sources, dependencies in import_steps if name in rebuilt) or 'nothing')
+    return data
+
+bundle_magic = 'GMPD'
+bundle_version = 2
+
+# (table, layout, row class, {column: (reference kind, target table)})
+#
+# layout is 'unique' (dict of rows), 'multi' (dict of row lists), 'list',
+# 'multi_ref' (dict of lists of rows from the target table given in place of
+# the row class) or 'raw' (plain values, stored as is).
+bundle_schema = [
+    ('quest_items', 'unique', TableRow, {}),
+    ('effects', 'unique', Effect, {}),
+    ('attacks', 'unique', TableRow, {
+        'effects': ('refs', 'effects')}),
+    ('standard_attacks', 'multi_ref', 'attacks', {}),
+    ('characters', 'multi', TableRow, {
+        'immunities': ('refs', 'attacks'),
+        'resistance': ('refs', 'attacks'),
+        'weaknesses': ('refs', 'attacks'),
+        'spin_attacks': ('refs', 'attacks'),
+        'standard_attacks': ('refs', 'attacks')}),
+    ('encounters', 'unique', TableRow, {
+        'item_attacks': ('item_attacks', 'attacks'),
+        'item_attack_drops': ('item_attacks', 'attacks')}),
+    ('script', 'multi', TableRow, {}),
+    ('levels', 'list', TableRow, {}),
+    ('shops', 'multi', TableRow, {
+        'item_attack': ('ref', 'attacks')}),
+    ('script_code', 'raw', None, {}),
+]
+
+class BundleError(Exception):
+    pass
+
+def _get_table_rows(table, layout):
+    if layout == 'unique':
+        keys = sorted(table.keys())
+        return keys, [table[key] for key in keys]
+    elif layout in ('multi', 'multi_ref'):
+        keys = sorted(table.keys())
+        return keys, [row for key in keys for row in table[key]]
+    else:
+        return None, table
+
+def save(data, path):
+    strings = []
+    string_index = {}
+    def intern(value):
+        if value not in string_index:
+            string_index[value] = len(strings)
+            strings.append(value)
+        return string_index[value]
+
+    # Row index of every object, per table, for resolving references
+    row_indices = {}
+    for name, layout, cls, references in bundle_schema:
+        if layout not in ('multi_ref', 'raw'):
+            keys, rows = _get_table_rows(getattr(data, name), layout)
+            row_indices[name] = dict((id(row), i) for i, row in enumerate(rows))
+
+    sections = []
+    for name, layout, cls, references in bundle_schema:
+        table = getattr(data, name)
+        if layout == 'raw':
+            sections.append((name, marshal.dumps((layout, table), 2)))
+            continue
+        keys, rows = _get_table_rows(table, layout)
+
+        if layout == 'unique':
+            index = [intern(key) for key in keys]
+        elif layout == 'multi':
+            index = [(intern(key), len(table[key])) for key in keys]
+        elif layout == 'multi_ref':
+            target_indices = row_indices[cls]
+            index = [(intern(key), [target_indices[id(row)] for row in table[key]]) for key in keys]
+            rows = []
+        else:
+            index = None
+
+        column_names = set()
+        for row in rows:
+            column_names.update(vars(row).keys())
+
+        columns = []
+        for column in sorted(column_names):
+            values = [getattr(row, column) for row in rows]
+            if column in references:
+                kind, target = references[column]
+                target_indices = row_indices[target]
+                if kind == 'ref':
+                    values = [target_indices[id(value)] for value in values]
+                elif kind == 'refs':
+                    values = [[target_indices[id(obj)] for obj in value] for value in values]
+                elif kind == 'item_attacks':
+                    values = [[(target_indices[id(ia.attack)], ia.quantity) for ia in value] for value in values]
+            elif all(isinstance(value, str) for value in values):
+                kind = 'str'
+                target = None
+                values = [intern(value) for value in values]
+            else:
+                kind = 'value'
+                target = None
+            columns.append((column, kind, target, values))
+
+        sections.append((name, marshal.dumps((layout, index, len(rows), columns), 2)))
+
+    sections.insert(0, ('_strings', marshal.dumps(strings, 2)))
+
+    header = struct.pack('<4sHH', bundle_magic, bundle_version, len(sections))
+    directory = ''
+    offset = len(header) + sum(struct.calcsize('<B%dsII' % len(name)) for name, section in sections)
+    for name, section in sections:
+        directory += struct.pack('<B%dsII' % len(name), len(name), name, offset, len(section))
+        offset += len(section)
+
+    f = open(path, 'wb')
+    try:
+        f.write(header)
+        f.write(directory)
+        for name, section in sections:
+            f.write(section)
+    finally:
+        f.close()
+
+class BundleReader(object):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, count = struct.unpack_from('<4sHH', buffer, 0)
+        if magic != bundle_magic:
+            raise BundleError('Not a game data bundle')
+        if version != bundle_version:
+            raise BundleError('Game data bundle version %d, expected %d; re-run --import-ods' % (version, bundle_version))
+
+        self.sections = {}
+        offset = struct.calcsize('<4sHH')
+        for i in range(count):
+            length, = struct.unpack_from('<B', buffer, offset)
+            name, section_offset, section_length = struct.unpack_from('<%dsII' % length, buffer, offset + 1)
+            self.sections[name] = (section_offset, section_length)
+            offset += 1 + struct.calcsize('<%dsII' % length)
+
+        self.schema = dict((entry[0], entry) for entry in bundle_schema)
+        self.strings = self.read_section('_strings')
+        self.rows = {}
+        self.tables = {}
+
+    def read_section(self, name):
+        offset, length = self.sections[name]
+        return marshal.loads(self.buffer[offset:offset + length])
+
+    def get_rows(self, name):
+        if name not in self.rows:
+            self.load_table(name)
+        return self.rows[name]
+
+    def load_table(self, name):
+        if name in self.tables:
+            return self.tables[name]
+
+        name, layout, cls, references = self.schema[name]
+        section = self.read_section(name)
+        if layout == 'raw':
+            table = self.tables[name] = section[1]
+            return table
+
+        layout, index, row_count, columns = section
+        strings = self.strings
+
+        if layout == 'multi_ref':
+            target_rows = self.get_rows(cls)
+            table = dict((strings[key], [target_rows[i] for i in row_indices]) for key, row_indices in index)
+            self.tables[name] = table
+            return table
+
+        rows = [cls.__new__(cls) for i in range(row_count)]
+        for column, kind, target, values in columns:
+            if kind == 'str':
+                values = [strings[value] for value in values]
+            elif kind == 'ref':
+                target_rows = self.get_rows(target)
+                values = [target_rows[value] for value in values]
+            elif kind == 'refs':
+                target_rows = self.get_rows(target)
+                values = [[target_rows[i] for i in value] for value in values]
+            elif kind == 'item_attacks':
+                target_rows = self.get_rows(target)
+                values = [[ItemAttack(target_rows[i], quantity) for i, quantity in value] for value in values]
+            for row, value in zip(rows, values):
+                row.__dict__[column] = value
+        self.rows[name] = rows
+
+        if layout == 'unique':
+            table = dict((strings[key], row) for key, row in zip(index, rows))
+        elif layout == 'multi':
+            table = {}
+            i = 0
+            for key, count in index:
+                table[strings[key]] = rows[i:i + count]
+                i += count
+        else:
+            table = rows
+        self.tables[name] = table
+        return table
+
+class BundleGameData(GameData):
+    # Decodes each table from the bundle on first access
+    def __init__(self, reader):
+        self._reader = reader
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._reader.schema:
+            raise AttributeError(name)
+        table = self._reader.load_table(name)
+        setattr(self, name, table)
+        return table
+
+def load(path):
+    f = open(path, 'rb')
+    try:
+        buffer = f.read()
+    finally:
+        f.close()
+    return BundleGameData(BundleReader(buffer))
@@ -0,0 +1,460 @@
+# Headless stand-in for bacon, so the game can be run and timed without a
+# display, e.g. on CI:
+#
+#   python headless.py --ticks 3600 -- --replay act1.rec
+#
+# install() registers this module as bacon before the game is imported.  It
+# implements the parts of the bacon API the game uses; nothing is drawn or
+# played, but every call is counted along with a simulated cost, weighted
+# towards what is slow on a real renderer (draw calls, texture switches and
+# render target changes), so a change in rendering work shows up in the
+# stats even though the frame takes no GPU time.
+#
+# Arguments after -- are passed to the game.
+
+import collections
+import optparse
+import os
+import struct
+import sys
+import time
+
+class Keys(object):
+    # Same values as bacon.Keys, so recordings replay under either
+    none = 0
+    space = ord(' ')
+    minus = ord('-')
+    plus = ord('+')
+    equals = ord('=')
+    left = 0x100
+    right = 0x100 + 1
+    up = 0x100 + 2
+    down = 0x100 + 3
+    enter = 0x100 + 4
+    ctrl = 0x100 + 5
+    shift = 0x100 + 6
+    alt = 0x100 + 7
+    command = 0x100 + 8
+    tab = 0x100 + 9
+    insert = 0x100 + 10
+    delete = 0x100 + 11
+    backspace = 0x100 + 12
+    home = 0x100 + 13
+    end = 0x100 + 14
+    pageup = 0x100 + 15
+    pagedown = 0x100 + 16
+    escape = 0x100 + 17
+    numpad_sub = 0x100 + 42
+    numpad_add = 0x100 + 43
+    numpad_enter = 0x100 + 44
+
+for i in range(26):
+    setattr(Keys, chr(ord('a') + i), ord('a') + i)
+for i in range(10):
+    setattr(Keys, 'digit%d' % i, ord('0') + i)
+    setattr(Keys, 'numpad%d' % i, 0x100 + 30 + i)
+for i in range(1, 13):
+    setattr(Keys, 'f%d' % i, 0x100 + 17 + i)
+
+class Alignment(object):
+    left = 0
+    center = 1
+    right = 2
+
+class VerticalAlignment(object):
+    baseline = 0
+    top = 1
+    center = 2
+    bottom = 3
+
+class Overflow(object):
+    none = 0
+    wrap = 1
+
+# Simulated cost of each call; anything not listed costs default_call_cost
+call_costs = {
+    'draw_image': 1.0,
+    'draw_glyph': 1.0,
+    'draw_rect': 1.0,
+    'fill_rect': 1.0,
+    'clear': 4.0,
+    'texture_switch': 8.0,
+    'push_target': 50.0,
+    'create_image': 20.0,
+    'load_image': 200.0,
+    'load_sound': 200.0,
+}
+default_call_cost = 0.1
+
+class Stats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.cost = 0.0
+        self.ticks = 0
+        self.texture = None
+
+    def record(self, name, count=1):
+        self.calls[name] += count
+        self.cost += call_costs.get(name, default_call_cost) * count
+
+    def use_texture(self, texture):
+        if texture is not self.texture:
+            self.texture = texture
+            self.record('texture_switch')
+
+    def print_report(self, duration=None):
+        print 'Ticks: %d' % self.ticks
+        if duration is not None:
+            print 'Time: %.2fs (%.1f ticks/s)' % (duration, self.ticks / max(duration, 0.001))
+        print 'Simulated cost: %.1f (%.1f per tick)' % (self.cost, self.cost / max(self.ticks, 1))
+        for name, count in sorted(self.calls.items(), key=lambda item: -item[1]):
+            print '  %-16s %10d %10.1f per tick' % (name, count, float(count) / max(self.ticks, 1))
+
+stats = Stats()
+
+# Window and input
+
+class Window(object):
+    def __init__(self):
+        self.width = 640
+        self.height = 480
+        self.title = ''
+        self.resizable = False
+        self.fullscreen = False
+        self.content_scale = 1.0
+        self.target = None
+
+window = Window()
+keys = set()
+timestep = 0.0
+
+resource_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
+
+def get_resource_path(filename):
+    return os.path.join(resource_dir, filename)
+
+# Images
+
+def get_image_size(path):
+    f = open(path, 'rb')
+    try:
+        header = f.read(24)
+    finally:
+        f.close()
+    if header[:8] != '\x89PNG\r\n\x1a\n':
+        return 0, 0
+    return struct.unpack('>II', header[16:24])
+
+class Image(object):
+    def __init__(self, file=None, premultiply_alpha=True, discard_bitmap_data=False, sample_nearest=False, wrap=False, atlas=1, width=None, height=None, content_scale=None):
+        if file:
+            stats.record('load_image')
+            width, height = get_image_size(get_resource_path(file))
+        else:
+            stats.record('create_image')
+        self.width = width
+        self.height = height
+        self.texture = self
+
+    def get_region(self, x1, y1, x2, y2):
+        region = Image.__new__(Image)
+        region.width = x2 - x1
+        region.height = y2 - y1
+        region.texture = self.texture
+        return region
+
+# Graphics state
+
+target_stack = [None]
+transform_depth = 0
+color_depth = 0
+
+def clear(r, g, b, a):
+    stats.record('clear')
+
+def push_target(image):
+    stats.record('push_target')
+    target_stack.append(image)
+
+def pop_target():
+    stats.record('pop_target')
+    target_stack.pop()
+
+def push_transform():
+    global transform_depth
+    stats.record('push_transform')
+    transform_depth += 1
+
+def pop_transform():
+    global transform_depth
+    stats.record('pop_transform')
+    assert transform_depth > 0, 'pop_transform without push_transform'
+    transform_depth -= 1
+
+def translate(x, y):
+    stats.record('translate')
+
+def scale(sx, sy):
+    stats.record('scale')
+
+def rotate(radians):
+    stats.record('rotate')
+
+def set_transform(matrix):
+    stats.record('set_transform')
+
+def push_color():
+    global color_depth
+    stats.record('push_color')
+    color_depth += 1
+
+def pop_color():
+    global color_depth
+    stats.record('pop_color')
+    assert color_depth > 0, 'pop_color without push_color'
+    color_depth -= 1
+
+def set_color(r, g, b, a):
+    stats.record('set_color')
+
+def multiply_color(r, g, b, a):
+    stats.record('multiply_color')
+
+def set_blending(src_blend, dest_blend):
+    stats.record('set_blending')
+
+def draw_image(image, x1, y1, x2=None, y2=None):
+    stats.use_texture(image.texture)
+    stats.record('draw_image')
+
+def draw_image_region(image, x1, y1, x2, y2, ix1, iy1, ix2, iy2):
+    stats.use_texture(image.texture)
+    stats.record('draw_image')
+
+def draw_rect(x1, y1, x2, y2):
+    stats.record('draw_rect')
+
+def fill_rect(x1, y1, x2, y2):
+    stats.record('fill_rect')
+
+# Text, laid out with a fixed advance per character
+
+class Font(object):
+    def __init__(self, file, size, light_hinting=False, content_scale=None):
+        stats.record('load_font')
+        self.size = size
+        self.ascent = -int(size * 3 / 4)
+        self.descent = int(size) / 4
+        self.height = self.descent - self.ascent
+        self.advance = max(1, int(size) / 2)
+        self.texture = self
+
+    def measure_string(self, str):
+        return len(str) * self.advance
+
+class Style(object):
+    def __init__(self, font, color=None, background_color=None):
+        self.font = font
+        self.color = color
+        self.background_color = background_color
+
+class GlyphRun(object):
+    def __init__(self, style, text, glyphs=None):
+        self.style = style
+        self.text = text
+        self.advance = style.font.measure_string(text)
+
+class GlyphLine(object):
+    def __init__(self, runs):
+        self.runs = runs
+        self.content_width = sum(run.advance for run in runs)
+        self.ascent = min(run.style.font.ascent for run in runs)
+        self.descent = max(run.style.font.descent for run in runs)
+        self.x = 0
+        self.y = 0
+
+class GlyphLayout(object):
+    def __init__(self, runs, x, y, width=None, height=None, align=Alignment.left, vertical_align=VerticalAlignment.baseline, overflow=Overflow.wrap):
+        self.runs = runs
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.align = align
+        self.vertical_align = vertical_align
+        self.overflow = overflow
+
+    def __setattr__(self, name, value):
+        # Any change lays the text out again, like bacon
+        object.__setattr__(self, name, value)
+        if name != '_lines':
+            object.__setattr__(self, '_lines', None)
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = self.layout()
+        return self._lines
+
+    @property
+    def content_width(self):
+        return max(line.content_width for line in self.lines)
+
+    @property
+    def content_height(self):
+        return sum(line.descent - line.ascent for line in self.lines)
+
+    def layout(self):
+        stats.record('layout')
+        lines = []
+        for run in self.runs:
+            font = run.style.font
+            words = run.text.split(' ')
+            text = words[0]
+            for word in words[1:]:
+                if self.width is not None and self.overflow == Overflow.wrap and \
+                    font.measure_string(text + ' ' + word) > self.width:
+                    lines.append(GlyphLine([GlyphRun(run.style, text)]))
+                    text = word
+                else:
+                    text += ' ' + word
+            lines.append(GlyphLine([GlyphRun(run.style, text)]))
+
+        x = self.x
+        y = self.y
+        if self.width is not None:
+            if self.align == Alignment.center:
+                x += self.width / 2
+            elif self.align == Alignment.right:
+                x += self.width
+        height = sum(line.descent - line.ascent for line in lines)
+        if self.vertical_align == VerticalAlignment.center:
+            y -= height / 2
+        elif self.vertical_align == VerticalAlignment.bottom:
+            y -= height
+        elif self.vertical_align == VerticalAlignment.baseline:
+            y += lines[0].ascent
+
+        for line in lines:
+            line.x = int(x)
+            if self.align == Alignment.center:
+                line.x -= int(line.content_width / 2)
+            elif self.align == Alignment.right:
+                line.x -= line.content_width
+            y -= line.ascent
+            line.y = int(y)
+            y += line.descent
+        return lines
+
+def draw_glyph_layout(glyph_layout):
+    for line in glyph_layout.lines:
+        for run in line.runs:
+            glyph_count = len(run.text) - run.text.count(' ')
+            if glyph_count:
+                stats.use_texture(run.style.font.texture)
+                stats.record('draw_glyph', glyph_count)
+
+def draw_string(font, text, x, y, width=None, height=None, align=Alignment.left, vertical_align=VerticalAlignment.baseline):
+    draw_glyph_layout(GlyphLayout([GlyphRun(Style(font), text)], x, y, width, height, align, vertical_align))
+
+# Sound
+
+class Sound(object):
+    def __init__(self, file, stream=False):
+        stats.record('load_sound')
+        self.file = file
+
+    def play(self, gain=None, pan=None, pitch=None):
+        stats.record('play_sound')
+
+class Voice(object):
+    def __init__(self, sound, loop=False):
+        self.sound = sound
+        self.loop = loop
+        self.gain = 1.0
+        self.pitch = 1.0
+        self.pan = 0.0
+        self.playing = False
+
+    def play(self):
+        stats.record('play_sound')
+        self.playing = True
+
+    def stop(self):
+        self.playing = False
+
+    def destroy(self):
+        self.playing = False
+
+# Game loop
+
+class Game(object):
+    def on_init(self):
+        pass
+
+    def on_tick(self):
+        pass
+
+    def on_key(self, key, value):
+        pass
+
+    def on_mouse_button(self, button, pressed):
+        pass
+
+    def on_mouse_scroll(self, dx, dy):
+        pass
+
+default_timestep = 1.0 / 60
+max_ticks = None
+running = False
+current_game = None
+
+def run(game):
+    # Ticks the game on a fixed timestep as fast as possible, until quit() or
+    # max_ticks
+    global running, timestep, current_game
+    running = True
+    current_game = game
+    game.on_init()
+    while running and (max_ticks is None or stats.ticks < max_ticks):
+        timestep = default_timestep
+        target_stack[:] = [None]
+        game.on_tick()
+        assert transform_depth == 0 and color_depth == 0, 'unbalanced transform or color stack'
+        stats.ticks += 1
+    running = False
+
+def quit():
+    global running
+    running = False
+
+def send_key(key, pressed):
+    # As bacon does when a key event arrives
+    if pressed:
+        keys.add(key)
+    else:
+        keys.discard(key)
+    current_game.on_key(key, pressed)
+
+def install():
+    # Must be called before anything imports bacon
+    sys.modules['bacon'] = sys.modules[__name__]
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [--ticks N] [-- game options]')
+    parser.disable_interspersed_args()
+    parser.add_option('--ticks', type='int', help='stop after this many ticks (default until the game quits)')
+    options, args = parser.parse_args()
+
+    import headless
+    headless.install()
+    headless.max_ticks = options.ticks
+    sys.argv[1:] = args
+
+    start = time.time()
+    import GoodnightMrPresident
+    GoodnightMrPresident.run()
+    headless.stats.print_report(time.time() - start)
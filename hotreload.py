@@ -0,0 +1,95 @@
+# Watch mode: polls the design spreadsheets and maps for changes while the game
+# is running and swaps the new data into the live session.
+#
+# After a reload, objects still holding rows of the old game data are rebound
+# to the row with the same id in the new data.  Rows that no longer exist stay
+# bound to the old objects, so a half-finished edit never crashes the session.
+# Active effects keep the effect they were applied with, so unapplying them
+# restores exactly what was added.
+
+import os
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class FileWatcher(object):
+    # Stat based, so it costs a few syscalls per poll and needs no platform
+    # specific notification API
+    def __init__(self, paths=(), interval=0.5):
+        self.interval = interval
+        self.timeout = interval
+        self.mtimes = {}
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        if path not in self.mtimes:
+            self.mtimes[path] = get_mtime(path)
+
+    def update(self, timestep):
+        # Returns the paths changed since the last poll, polling at most once
+        # per interval
+        self.timeout -= timestep
+        if self.timeout > 0:
+            return []
+        self.timeout = self.interval
+        return self.poll()
+
+    def poll(self):
+        changed = []
+        for path, mtime in self.mtimes.items():
+            new_mtime = get_mtime(path)
+            if new_mtime != mtime:
+                self.mtimes[path] = new_mtime
+                changed.append(path)
+        return changed
+
+def rebind_attacks(attacks, data):
+    return [data.attacks.get(attack.id, attack) for attack in attacks]
+
+def rebind_item_attacks(item_attacks, data):
+    # In place, as party members share the player's list
+    for ia in item_attacks:
+        ia.attack = data.attacks.get(ia.attack.id, ia.attack)
+
+def rebind_character(character, old_data, data):
+    rows = data.characters.get(character.id)
+    if rows:
+        # Monsters pick one of several rows at random; keep the same pick
+        old_rows = old_data.characters.get(character.id, [])
+        index = 0
+        for i, row in enumerate(old_rows):
+            if row is character.data:
+                index = i
+        character.data = rows[min(index, len(rows) - 1)]
+
+    if character.ai:
+        character.spin_attacks = character.data.spin_attacks
+        character.standard_attacks = character.data.standard_attacks
+    else:
+        # Players keep the attacks learnt during the game
+        character.spin_attacks = rebind_attacks(character.spin_attacks, data)
+        character.standard_attacks = rebind_attacks(character.standard_attacks, data)
+    rebind_item_attacks(character.item_attacks, data)
+
+def rebind_party(party, old_data, data):
+    for ally in party.allies:
+        rebind_character(ally, old_data, data)
+    party.quest_items[:] = [data.quest_items.get(item.id, item) for item in party.quest_items]
+
+def rebind_combat(combat, old_data, data):
+    combat.data = data
+    combat.encounter = data.encounters.get(combat.encounter.id, combat.encounter)
+    rebind_item_attacks(combat.ai_item_attacks, data)
+    for character in combat.characters:
+        if character.ai:
+            rebind_character(character, old_data, data)
+
+def rebind_script(world, data):
+    # The running script continues from the same row of the new script
+    if world.active_script and world.active_script_trigger in data.script_code:
+        world.active_script = data.script_code[world.active_script_trigger]
@@ -0,0 +1,290 @@
+# Compiled map format, written offline from the Tiled .tmx maps so loading a
+# world never parses XML at runtime:
+#
+#   python mapfile.py res/*.tmx
+#
+# writes res/<map>.tmxb next to each map.  Every layer cell holds an index into
+# the map's table of used tiles, each already resolved to (tileset, tile), so
+# no gid lookup is needed, and the per-cell collision masks are precomputed.
+# tiled.parse loads the compiled map instead of the .tmx while every file it
+# was compiled from still has the content hash recorded in it.  Hashes rather
+# than modification times are compared, as a checkout gives the committed
+# .tmxb files and their sources arbitrary times.
+#
+# This module does not import bacon, so maps can be compiled without the game
+# runtime.
+
+import array
+import base64
+import hashlib
+import marshal
+import os
+import struct
+import xml.etree.cElementTree as ET
+import zlib
+
+map_magic = 'GMPT'
+map_version = 2
+compiled_extension = '.tmxb'
+
+# Directional collision flags of a tile, from the 'c' tile property
+collide_up = 1
+collide_down = 2
+collide_left = 4
+collide_right = 8
+
+# Walkability flags from the Collision and Water layers
+unwalkable = 16
+unwalkable_animal = 32
+unwalkable_villager = 64
+unwalkable_entrance = 128
+
+collision_directions = {
+    'u': collide_up,
+    'd': collide_down,
+    'l': collide_left,
+    'r': collide_right,
+}
+
+walkable_flags = {
+    'All': unwalkable,
+    'Animal': unwalkable_animal,
+    'Villager': unwalkable_villager,
+    'Entrance': unwalkable_entrance,
+}
+
+# Layers that are not drawn as tiles and so never block movement
+non_collision_layers = ('Sprites', 'Collision')
+
+def get_compiled_path(tmx_file):
+    return os.path.splitext(tmx_file)[0] + compiled_extension
+
+def get_collision_mask(properties):
+    if not properties or 'c' not in properties:
+        return 0
+    mask = 0
+    for direction in properties['c'] or 'udlr':
+        mask |= collision_directions.get(direction, 0)
+    return mask
+
+def get_png_size(path):
+    f = open(path, 'rb')
+    try:
+        header = f.read(24)
+    finally:
+        f.close()
+    return struct.unpack('>II', header[16:24])
+
+def decode_layer_data(elem):
+    encoding = elem.get('encoding')
+    if encoding == 'base64':
+        data = base64.b64decode(elem.text)
+        compression = elem.get('compression')
+        if compression == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif compression == 'zlib':
+            data = zlib.decompress(data)
+        return struct.unpack('<%dI' % (len(data) / 4), data)
+    else:
+        return [int(tile.get('gid')) for tile in elem if tile.tag == 'tile']
+
+def parse_properties(elem):
+    properties = {}
+    for child in elem:
+        if child.tag == 'properties':
+            for prop in child:
+                if prop.tag == 'property':
+                    properties[prop.get('name')] = prop.get('value')
+    return properties
+
+class MapCompiler(object):
+    def __init__(self, tmx_file):
+        self.tmx_file = tmx_file
+        self.base_dir = os.path.dirname(tmx_file)
+        self.source_files = [tmx_file]
+        self.tilesets = []
+        self.gid_tilesets = []
+        self.tiles = [None]
+        self.tile_indices = {}
+
+    def add_tileset(self, elem):
+        firstgid = int(elem.get('firstgid'))
+        source = elem.get('source')
+        if source:
+            source = os.path.join(self.base_dir, source)
+            self.source_files.append(source)
+            elem = ET.parse(source).getroot()
+
+        spacing = int(elem.get('spacing') or 0)
+        margin = int(elem.get('margin') or 0)
+        tile_width = int(elem.get('tilewidth'))
+        tile_height = int(elem.get('tileheight'))
+        image_path = None
+        tile_properties = {}
+        for child in elem:
+            if child.tag == 'image':
+                image_path = os.path.join(self.base_dir, child.get('source'))
+                if child.get('width') and child.get('height'):
+                    image_width = int(child.get('width'))
+                    image_height = int(child.get('height'))
+                else:
+                    image_width, image_height = get_png_size(image_path)
+            elif child.tag == 'tile':
+                tile_properties[int(child.get('id'))] = parse_properties(child)
+        self.source_files.append(image_path)
+
+        # Same tile order as tiled.parse_tileset_images
+        regions = []
+        for y in range(margin, image_height - margin, spacing + tile_height):
+            for x in range(margin, image_width - margin, spacing + tile_width):
+                regions.append((x, y, x + tile_width, y + tile_height))
+
+        tileset_index = len(self.tilesets)
+        self.tilesets.append(os.path.relpath(image_path, self.base_dir))
+        self.gid_tilesets.append((firstgid, tileset_index, regions, tile_properties))
+
+    def get_tile_index(self, gid):
+        # Index into the used tile table, 0 for an empty cell
+        if gid in self.tile_indices:
+            return self.tile_indices[gid]
+
+        match = None
+        for tileset in self.gid_tilesets:
+            if gid < tileset[0]:
+                break
+            match = tileset
+        if match is None:
+            index = 0
+        else:
+            firstgid, tileset_index, regions, tile_properties = match
+            local_index = gid - firstgid
+            index = len(self.tiles)
+            self.tiles.append((tileset_index, regions[local_index], tile_properties.get(local_index)))
+        self.tile_indices[gid] = index
+        return index
+
+    def get_tile_properties(self, index):
+        if index:
+            return self.tiles[index][2]
+
+    def compile(self):
+        root = ET.parse(self.tmx_file).getroot()
+        cols = int(root.get('width'))
+        rows = int(root.get('height'))
+        tile_width = int(root.get('tilewidth'))
+        tile_height = int(root.get('tileheight'))
+
+        layers = []
+        object_layers = []
+        collision = array.array('B', [0] * (cols * rows))
+        entrances = {}
+        for child in root:
+            if child.tag == 'tileset':
+                self.add_tileset(child)
+            elif child.tag == 'layer':
+                name = child.get('name')
+                properties = parse_properties(child)
+                offset_y = 0
+                start = 0
+                if 'Y' in properties:
+                    offset_y = -tile_height * int(properties['Y'])
+                    start = int(properties['Y']) * cols
+
+                cells = array.array('H', [0] * (cols * rows))
+                for i, gid in enumerate(decode_layer_data(child.find('data'))):
+                    if start + i < len(cells):
+                        cells[start + i] = self.get_tile_index(gid)
+
+                for i, index in enumerate(cells):
+                    if not index:
+                        continue
+                    tile_properties = self.get_tile_properties(index)
+                    if name not in non_collision_layers:
+                        collision[i] |= get_collision_mask(tile_properties)
+                    if name in ('Collision', 'Water') and tile_properties and 'Collision' in tile_properties:
+                        collision[i] |= walkable_flags.get(tile_properties['Collision'], 0)
+                        if tile_properties['Collision'] == 'Entrance' and 'Entrance' in tile_properties:
+                            entrances[i] = tile_properties['Entrance']
+
+                if name != 'Collision':
+                    layers.append((name, properties, offset_y, cells.tostring()))
+            elif child.tag == 'objectgroup':
+                objects = []
+                for obj in child:
+                    if obj.tag != 'object':
+                        continue
+                    gid = int(obj.get('gid', -1))
+                    objects.append((obj.get('name'), obj.get('type'),
+                        int(obj.get('x')), int(obj.get('y')),
+                        int(obj.get('width', 0)), int(obj.get('height', 0)),
+                        self.get_tile_index(gid) if gid != -1 else -1,
+                        parse_properties(obj)))
+                object_layers.append((child.get('name'), objects))
+
+        source_files = [os.path.relpath(path, self.base_dir) for path in self.source_files]
+        return dict(cols=cols,
+            rows=rows,
+            tile_width=tile_width,
+            tile_height=tile_height,
+            source_files=source_files,
+            source_hashes=[get_file_hash(path) for path in self.source_files],
+            tilesets=self.tilesets,
+            tiles=self.tiles[1:],
+            layers=layers,
+            object_layers=object_layers,
+            collision=collision.tostring(),
+            entrances=entrances)
+
+def compile_map(tmx_file, path=None):
+    path = path or get_compiled_path(tmx_file)
+    compiled = MapCompiler(tmx_file).compile()
+    f = open(path, 'wb')
+    try:
+        f.write(struct.pack('<4sH', map_magic, map_version))
+        marshal.dump(compiled, f, 2)
+    finally:
+        f.close()
+    return path
+
+def read_map(path):
+    # Returns the compiled map, or None if it is missing or from another
+    # version of the format
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        magic, version = struct.unpack('<4sH', f.read(struct.calcsize('<4sH')))
+        if magic != map_magic or version != map_version:
+            return None
+        return marshal.load(f)
+    finally:
+        f.close()
+
+# SHA1 of files by (path, modification time, size), so a tileset image shared
+# by several maps is only read once
+file_hashes = {}
+
+def get_file_hash(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if key not in file_hashes:
+        f = open(path, 'rb')
+        try:
+            file_hashes[key] = hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    return file_hashes[key]
+
+def is_up_to_date(path, compiled):
+    base_dir = os.path.dirname(path)
+    for source, source_hash in zip(compiled['source_files'], compiled['source_hashes']):
+        source = os.path.join(base_dir, source)
+        if os.path.exists(source) and get_file_hash(source) != source_hash:
+            return False
+    return True
+
+if __name__ == '__main__':
+    import sys
+    for tmx_file in sys.argv[1:]:
+        print 'Compiled %s' % compile_map(tmx_file)
@@ -1,40 +1,144 @@
-from odf.opendocument import load
-from odf.table import Table, TableRow, TableCell
-from odf.namespaces import TABLENS
+# Reads the tables of an OpenDocument spreadsheet into lists of rows.
+#
+# content.xml is streamed with iterparse and each row is discarded once read,
+# instead of building the full odf DOM.  Repeated rows and columns are only
+# expanded when something non-empty follows them, so the million-row padding
+# spreadsheet editors write at the end of a sheet costs nothing.
+#
+# read_sheet_sources splits content.xml into the raw XML of each sheet without
+# parsing it, so the incremental importer can hash sheets and only parse the
+# ones that changed.
 
-from odf.text import P
+import re
+import StringIO
+import xml.etree.cElementTree as ET
+from xml.sax.saxutils import unescape
+import zipfile
 
-def import_ods(path):
-    doc = load(path)
+TABLENS = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+TEXTNS = 'urn:oasis:names:tc:opendocument:xmlns:text:1.0'
 
-    db = {}
+table_tag = '{%s}table' % TABLENS
+row_tag = '{%s}table-row' % TABLENS
+cell_tag = '{%s}table-cell' % TABLENS
+p_tag = '{%s}p' % TEXTNS
+name_attr = '{%s}name' % TABLENS
+rows_repeated_attr = '{%s}number-rows-repeated' % TABLENS
+columns_repeated_attr = '{%s}number-columns-repeated' % TABLENS
+
+def parse_cell_value(cell):
+    db_value = u'\n'.join(u''.join(p.itertext()) for p in cell.iter(p_tag))
+    db_value = db_value.strip()
+    try:
+        return float(db_value)
+    except (ValueError, UnicodeEncodeError):
+        db_value = db_value.replace(u'\u2026', '...')
+        db_value = db_value.replace(u'\u200b', '')
+        return db_value.encode('utf-8')
+
+def parse_row(row):
+    # Trailing empty cells are dropped; parse_table pads short rows
+    db_row = []
+    empty_count = 0
+    cells = list(row)
+    for i, cell in enumerate(cells):
+        if cell.tag != cell_tag:
+            continue
 
-    tables = doc.spreadsheet.getElementsByType(Table)
-    for table in tables:
-        db_table = []
-        db[table.getAttribute('name')] = db_table
-        for row in table.getElementsByType(TableRow):
-            db_row = []
-            db_table.append(db_row)
-            for cell in row.getElementsByType(TableCell):
-                db_value = '\n'.join(map(str, cell.getElementsByType(P))).decode('utf-8')
-                db_value = db_value.strip()
-                try:
-                    db_value = float(db_value)
-                except:
-                    db_value = db_value.replace(u'\u2026', '...')
-                    db_value = db_value.replace(u'\u200b', '')
-                    db_value = db_value.encode('utf-8')
-                
-                try:
-                    repeat_count = int(cell.getAttribute('numbercolumnsrepeated'))
-                except:
-                    repeat_count = 1
-
-                if not cell.nextSibling:
-                    repeat_count = 1
-                for i in range(repeat_count):
-                    db_row.append(db_value)
+        # The last cell of a row is padding to the edge of the sheet
+        if i == len(cells) - 1:
+            repeat_count = 1
+        else:
+            repeat_count = int(cell.get(columns_repeated_attr, 1))
 
+        db_value = parse_cell_value(cell)
+        if db_value == '':
+            empty_count += repeat_count
+        else:
+            db_row.extend([''] * empty_count)
+            empty_count = 0
+            db_row.extend([db_value] * repeat_count)
+    return db_row
+
+def parse_content(content):
+    db = {}
+    db_table = None
+    empty_row_count = 0
+    for event, elem in ET.iterparse(content, ('start', 'end')):
+        if event == 'start':
+            if elem.tag == table_tag:
+                db_table = []
+                db[unicode(elem.get(name_attr))] = db_table
+                empty_row_count = 0
+        elif elem.tag == row_tag:
+            repeat_count = int(elem.get(rows_repeated_attr, 1))
+            db_row = parse_row(elem)
+            elem.clear()
+            if db_row:
+                db_table.extend([] for i in range(empty_row_count))
+                empty_row_count = 0
+                db_table.extend(list(db_row) for i in range(repeat_count))
+            else:
+                empty_row_count += repeat_count
+        elif elem.tag == table_tag:
+            elem.clear()
     return db
-         
\ No newline at end of file
+
+def read_content(path):
+    ods = zipfile.ZipFile(path)
+    try:
+        return ods.read('content.xml')
+    finally:
+        ods.close()
+
+def import_ods(path):
+    ods = zipfile.ZipFile(path)
+    try:
+        return parse_content(ods.open('content.xml'))
+    finally:
+        ods.close()
+
+table_start_re = re.compile(r'<table:table[\s>]')
+table_end = '</table:table>'
+table_name_re = re.compile(r'\stable:name="([^"]*)"')
+root_start_re = re.compile(r'<office:document-content[^>]*>')
+
+class SheetSources(object):
+    # Raw XML of each sheet of a content.xml, in document order
+    def __init__(self, prefix, sheets):
+        self.prefix = prefix
+        self.sheets = sheets
+
+    def parse(self, xml):
+        # The root element is kept around the sheet for its namespace declarations
+        db = parse_content(StringIO.StringIO(self.prefix + xml + '</office:document-content>'))
+        return db.values()[0]
+
+def read_sheet_sources(content):
+    # Returns None if the sheets can't be split out, e.g. when the document
+    # uses unexpected namespace prefixes or no sheets are found; callers fall
+    # back to parse_content.
+    root = root_start_re.search(content)
+    if not root:
+        return None
+
+    sheets = []
+    start = table_start_re.search(content)
+    while start:
+        end = content.find(table_end, start.start())
+        if end == -1:
+            return None
+        end += len(table_end)
+        xml = content[start.start():end]
+        if table_start_re.search(xml, 1):
+            return None
+        name = table_name_re.search(xml[:xml.index('>') + 1])
+        if not name:
+            return None
+        name = unescape(name.group(1).decode('utf-8'), {'&quot;': '"', '&apos;': "'"})
+        sheets.append((name, xml))
+        start = table_start_re.search(content, end)
+
+    if not sheets:
+        return None
+    return SheetSources(content[:root.end()], sheets)
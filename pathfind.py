@@ -0,0 +1,466 @@
+# A* search over a grid of cells, given as flat row-major arrays from a
+# collision model: one non-zero where a cell can be walked on, and the exits
+# each cell can be left by.
+#
+# The per-search state (cost so far and parent of every cell) lives in arrays
+# allocated once per grid and reused by every search.  Each search takes a new
+# generation number and a cell's state only counts when it was written in the
+# current generation, so nothing needs clearing between searches.
+#
+# Moves are to the 8 neighbours; straight moves cost 1 and diagonal moves
+# sqrt(2).  A diagonal move is only allowed when both cells it passes between
+# are walkable, so paths never cut the corner of a wall, and walls between
+# cells block moves as they do the player; see collision.py.  Cells whose cost
+# improves after they were expanded are reopened, so heuristics that never
+# overestimate but aren't consistent still find the shortest path.
+
+import array
+import heapq
+import math
+
+import collision
+
+diagonal_cost = math.sqrt(2)
+
+def get_straight_moves(cols):
+    # Neighbour offsets in the flat array with their collision exit bits
+    return [(-cols, collision.exit_up),
+            (cols, collision.exit_down),
+            (-1, collision.exit_left),
+            (1, collision.exit_right)]
+
+def get_diagonal_moves(cols):
+    # As get_straight_moves, with the offsets of the two cells passed between
+    return [(-cols - 1, collision.exit_up_left, -1, -cols),
+            (-cols + 1, collision.exit_up_right, 1, -cols),
+            (cols - 1, collision.exit_down_left, -1, cols),
+            (cols + 1, collision.exit_down_right, 1, cols)]
+
+def get_octile_distance(cols, a, b):
+    # Cost of the shortest path between cells a and b on an open grid
+    dx = abs(a % cols - b % cols)
+    dy = abs(a / cols - b / cols)
+    if dx < dy:
+        return dy + (diagonal_cost - 1) * dx
+    return dx + (diagonal_cost - 1) * dy
+
+class PathFinder(object):
+    def __init__(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+        size = cols * rows
+        self.costs = array.array('d', [0.0]) * size
+        self.parents = array.array('i', [-1]) * size
+        self.generations = array.array('I', [0]) * size
+        self.generation = 0
+        self.expanded_count = 0
+        self.straight_moves = get_straight_moves(cols)
+        self.diagonal_moves = get_diagonal_moves(cols)
+
+    def next_generation(self):
+        self.generation += 1
+        if self.generation >= 0xffffffff:
+            for i in range(self.cols * self.rows):
+                self.generations[i] = 0
+            self.generation = 1
+        return self.generation
+
+    def find(self, walkable, exits, start, is_goal, heuristic, max_size):
+        # Returns the cell indices from start to the first cell is_goal(i)
+        # accepts, or [] when none is reached within max_size expansions.
+        # heuristic(i) estimates the remaining cost from cell i, and exits are
+        # the collision model's, which also keep moves inside the map.
+        cols = self.cols
+        size = cols * self.rows
+        costs = self.costs
+        parents = self.parents
+        generations = self.generations
+        straight_moves = self.straight_moves
+        diagonal_moves = self.diagonal_moves
+        generation = self.next_generation()
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+
+        if start < 0 or start >= size:
+            return []
+        costs[start] = 0.0
+        parents[start] = -1
+        generations[start] = generation
+        open = [(heuristic(start), 0.0, start)]
+        expanded_count = 0
+        while open and expanded_count <= max_size:
+            f, cost, i = heappop(open)
+            if cost > costs[i]:
+                # Superseded by a cheaper entry for the same cell
+                continue
+            if is_goal(i):
+                self.expanded_count = expanded_count
+                return self.retrace(i)
+            expanded_count += 1
+
+            cell_exits = exits[i]
+            for offset, exit in straight_moves:
+                j = i + offset
+                if not cell_exits & exit or not walkable[j]:
+                    continue
+                new_cost = cost + 1
+                if generations[j] != generation or new_cost < costs[j]:
+                    generations[j] = generation
+                    costs[j] = new_cost
+                    parents[j] = i
+                    heappush(open, (new_cost + heuristic(j), new_cost, j))
+
+            for offset, exit, side1, side2 in diagonal_moves:
+                j = i + offset
+                if not cell_exits & exit or not walkable[j] or \
+                    not walkable[i + side1] or not walkable[i + side2]:
+                    continue
+                new_cost = cost + diagonal_cost
+                if generations[j] != generation or new_cost < costs[j]:
+                    generations[j] = generation
+                    costs[j] = new_cost
+                    parents[j] = i
+                    heappush(open, (new_cost + heuristic(j), new_cost, j))
+
+        self.expanded_count = expanded_count
+        return []
+
+    def find_to(self, walkable, exits, start, goal, max_size):
+        # Path from start to the cell goal, with the octile distance heuristic
+        cols = self.cols
+        goal_col = goal % cols
+        goal_row = goal / cols
+        def heuristic(i):
+            dx = abs(i % cols - goal_col)
+            dy = abs(i / cols - goal_row)
+            if dx < dy:
+                return dy + (diagonal_cost - 1) * dx
+            return dx + (diagonal_cost - 1) * dy
+        return self.find(walkable, exits, start, lambda i: i == goal, heuristic, max_size)
+
+    def retrace(self, i):
+        parents = self.parents
+        path = [i]
+        while parents[i] != -1:
+            i = parents[i]
+            path.append(i)
+        path.reverse()
+        return path
+
+class RegionGraph(object):
+    # Hierarchical search over a map divided into square clusters.  Wherever
+    # movers can cross the border between two clusters there is an entrance:
+    # one or two pairs of transition cells facing each other across it.  The
+    # transition cells of each cluster are joined by the cost of the shortest
+    # path between them that stays inside the cluster.  A long path is found
+    # by searching this graph, which has a few nodes per cluster, and then
+    # filling in each step of it with a search inside a single cluster.
+    #
+    # Changing the walkability of a cell marks its cluster dirty; the
+    # entrances on its borders and the edges of it and its neighbours are
+    # rebuilt before the next search.
+
+    def __init__(self, model, movement_class='all', cluster_size=8):
+        self.model = model
+        self.movement_class = movement_class
+        self.cluster_size = cluster_size
+        self.cols = model.cols
+        self.rows = model.rows
+        self.cluster_cols = (self.cols + cluster_size - 1) / cluster_size
+        self.cluster_rows = (self.rows + cluster_size - 1) / cluster_size
+        self.straight_moves = get_straight_moves(self.cols)
+        self.diagonal_moves = get_diagonal_moves(self.cols)
+        self.cell_clusters = array.array('i', [self.get_cluster(i) for i in range(self.cols * self.rows)])
+
+        # Transition cell pairs by border, as (cluster, cluster to the right
+        # or below)
+        self.entrances = {}
+        # Transition cells of each cluster, the cells across the border from
+        # each transition cell, the edges within each cluster, and both kinds
+        # of edge of each transition cell with their costs
+        self.cluster_nodes = {}
+        self.crossings = {}
+        self.cluster_edges = {}
+        self.node_edges = {}
+
+        self.dirty = set(range(self.cluster_cols * self.cluster_rows))
+        self.expanded_count = 0
+
+    def get_cluster(self, i):
+        size = self.cluster_size
+        return (i / self.cols) / size * self.cluster_cols + (i % self.cols) / size
+
+    def get_cluster_rect(self, cluster):
+        # Cell columns and rows of the cluster, as x1, y1, x2, y2
+        size = self.cluster_size
+        x1 = cluster % self.cluster_cols * size
+        y1 = cluster / self.cluster_cols * size
+        return x1, y1, min(x1 + size, self.cols), min(y1 + size, self.rows)
+
+    def get_neighbour_clusters(self, cluster):
+        cx = cluster % self.cluster_cols
+        cy = cluster / self.cluster_cols
+        neighbours = []
+        if cx > 0:
+            neighbours.append(cluster - 1)
+        if cx < self.cluster_cols - 1:
+            neighbours.append(cluster + 1)
+        if cy > 0:
+            neighbours.append(cluster - self.cluster_cols)
+        if cy < self.cluster_rows - 1:
+            neighbours.append(cluster + self.cluster_cols)
+        return neighbours
+
+    def invalidate(self, i):
+        # Called when the walkability of cell i changes
+        self.dirty.add(self.get_cluster(i))
+
+    def update(self):
+        if not self.dirty:
+            return
+        rebuild = set(self.dirty)
+        borders = set()
+        for cluster in self.dirty:
+            for neighbour in self.get_neighbour_clusters(cluster):
+                borders.add((min(cluster, neighbour), max(cluster, neighbour)))
+                rebuild.add(neighbour)
+        # Only the changed borders' transitions, and the nodes and edges of
+        # the clusters on either side of them, are replaced
+        crossings = self.crossings
+        for border in borders:
+            for a, b in self.entrances.get(border, ()):
+                for node, other in ((a, b), (b, a)):
+                    crossings[node].remove(other)
+                    if not crossings[node]:
+                        del crossings[node]
+            transitions = self.entrances[border] = self.get_entrances(*border)
+            for a, b in transitions:
+                crossings.setdefault(a, []).append(b)
+                crossings.setdefault(b, []).append(a)
+
+        for cluster in rebuild:
+            for node in self.cluster_edges.get(cluster, ()):
+                del self.node_edges[node]
+            self.cluster_nodes[cluster] = self.get_cluster_nodes(cluster)
+        for cluster in rebuild:
+            edges = self.cluster_edges[cluster] = self.get_cluster_edges(cluster)
+            for node, node_edges in edges.items():
+                self.node_edges[node] = node_edges + [(other, 1) for other in crossings.get(node, ())]
+        self.dirty.clear()
+
+    def get_cluster_nodes(self, cluster):
+        # Transition cells of the cluster, from the entrances on its borders
+        nodes = set()
+        for neighbour in self.get_neighbour_clusters(cluster):
+            for a, b in self.entrances.get((min(cluster, neighbour), max(cluster, neighbour)), ()):
+                nodes.add(a if cluster < neighbour else b)
+        return nodes
+
+    def get_entrances(self, cluster1, cluster2):
+        # Transition pairs across the border of cluster1 with cluster2, which
+        # is to its right or below it.  The border is split into runs of
+        # crossings that are connected along both sides of it; a run gets a
+        # transition in its middle, or at both ends when it is long.
+        walkable = self.model.walkable[self.movement_class]
+        exits = self.model.exits
+        cols = self.cols
+        x1, y1, x2, y2 = self.get_cluster_rect(cluster1)
+        if cluster2 / self.cluster_cols == cluster1 / self.cluster_cols:
+            cells = [y * cols + x2 - 1 for y in range(y1, y2)]
+            offset = 1
+            cross_exit = collision.exit_right
+            along_exit = collision.exit_down
+        else:
+            cells = [(y2 - 1) * cols + x for x in range(x1, x2)]
+            offset = cols
+            cross_exit = collision.exit_down
+            along_exit = collision.exit_right
+
+        runs = []
+        run = []
+        for a in cells:
+            b = a + offset
+            if walkable[a] and walkable[b] and exits[a] & cross_exit:
+                if run and not (exits[run[-1]] & along_exit and exits[run[-1] + offset] & along_exit):
+                    runs.append(run)
+                    run = []
+                run.append(a)
+            elif run:
+                runs.append(run)
+                run = []
+        if run:
+            runs.append(run)
+
+        transitions = []
+        for run in runs:
+            if len(run) >= 6:
+                transitions.append((run[0], run[0] + offset))
+                transitions.append((run[-1], run[-1] + offset))
+            else:
+                a = run[len(run) / 2]
+                transitions.append((a, a + offset))
+        return transitions
+
+    def get_cluster_edges(self, cluster):
+        nodes = self.cluster_nodes.get(cluster, set())
+        edges = {}
+        for node in nodes:
+            costs, parents = self.search_cluster(node, nodes, cluster)
+            edges[node] = [(other, costs[other]) for other in nodes if other != node and other in costs]
+        return edges
+
+    def search_cluster(self, start, targets, cluster):
+        # Dijkstra from start without leaving the cluster, until every target
+        # is reached; returns the costs and parents of the cells reached
+        walkable = self.model.walkable[self.movement_class]
+        exits = self.model.exits
+        cell_clusters = self.cell_clusters
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        remaining = set(targets)
+        remaining.discard(start)
+        costs = {start: 0.0}
+        parents = {start: -1}
+        open = [(0.0, start)]
+        while open and remaining:
+            cost, i = heappop(open)
+            if cost > costs[i]:
+                continue
+            remaining.discard(i)
+            cell_exits = exits[i]
+            for offset, exit in self.straight_moves:
+                j = i + offset
+                if not cell_exits & exit or cell_clusters[j] != cluster or not walkable[j]:
+                    continue
+                new_cost = cost + 1
+                if new_cost < costs.get(j, new_cost + 1):
+                    costs[j] = new_cost
+                    parents[j] = i
+                    heappush(open, (new_cost, j))
+            for offset, exit, side1, side2 in self.diagonal_moves:
+                j = i + offset
+                if not cell_exits & exit or cell_clusters[j] != cluster or not walkable[j] or \
+                    not walkable[i + side1] or not walkable[i + side2]:
+                    continue
+                new_cost = cost + diagonal_cost
+                if new_cost < costs.get(j, new_cost + 1):
+                    costs[j] = new_cost
+                    parents[j] = i
+                    heappush(open, (new_cost, j))
+        return costs, parents
+
+    def get_steps(self, i):
+        # Cells one move from cell i, with the cost of the move
+        walkable = self.model.walkable[self.movement_class]
+        cell_exits = self.model.exits[i]
+        steps = []
+        for offset, exit in self.straight_moves:
+            if cell_exits & exit and walkable[i + offset]:
+                steps.append((i + offset, 1))
+        for offset, exit, side1, side2 in self.diagonal_moves:
+            if cell_exits & exit and walkable[i + offset] and walkable[i + side1] and walkable[i + side2]:
+                steps.append((i + offset, diagonal_cost))
+        return steps
+
+    def find(self, start, goal, max_size):
+        # Cell indices from start to goal, or [] when there is no path or the
+        # graph search expands more than max_size nodes
+        self.update()
+        size = self.cols * self.rows
+        walkable = self.model.walkable[self.movement_class]
+        if start < 0 or start >= size or goal < 0 or goal >= size:
+            return []
+        if start == goal:
+            return [start]
+        if not walkable[goal]:
+            return []
+
+        # Join start and goal to the transition cells of their clusters.  A
+        # start cell that can't be walked on, as when something was put under
+        # the mover, is left by its first move, which may be into another
+        # cluster; first_cells has the cell each start edge leaves by.
+        goal_cluster = self.get_cluster(goal)
+        if walkable[start]:
+            first_steps = [(start, 0)]
+        else:
+            first_steps = self.get_steps(start)
+        start_edges = {}
+        first_cells = {}
+        for first_cell, first_cost in first_steps:
+            cluster = self.get_cluster(first_cell)
+            nodes = set(self.cluster_nodes.get(cluster, ()))
+            if cluster == goal_cluster:
+                nodes.add(goal)
+            cluster_costs, cluster_parents = self.search_cluster(first_cell, nodes, cluster)
+            for node in nodes:
+                if node in cluster_costs and first_cost + cluster_costs[node] < start_edges.get(node, float('inf')):
+                    start_edges[node] = first_cost + cluster_costs[node]
+                    first_cells[node] = first_cell
+        goal_costs, goal_parents = self.search_cluster(goal, self.cluster_nodes.get(goal_cluster, ()), goal_cluster)
+
+        cols = self.cols
+        goal_col = goal % cols
+        goal_row = goal / cols
+        diagonal_step = diagonal_cost - 1
+        crossings = self.crossings
+        node_edges = self.node_edges
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        costs = {start: 0.0}
+        parents = {start: -1}
+        open = [(get_octile_distance(cols, start, goal), 0.0, start)]
+        expanded_count = 0
+        while open and expanded_count <= max_size:
+            f, cost, node = heappop(open)
+            if cost > costs[node]:
+                continue
+            if node == goal:
+                self.expanded_count = expanded_count
+                nodes = self.retrace(parents, goal)
+                return self.refine(nodes, first_cells.get(nodes[1], start))
+            expanded_count += 1
+
+            if node == start:
+                edges = start_edges.items() + [(other, 1) for other in crossings.get(node, ())]
+            elif node in goal_costs:
+                edges = node_edges[node] + [(goal, goal_costs[node])]
+            else:
+                edges = node_edges[node]
+
+            for other, edge_cost in edges:
+                new_cost = cost + edge_cost
+                if new_cost < costs.get(other, new_cost + 1):
+                    costs[other] = new_cost
+                    parents[other] = node
+                    dx = abs(other % cols - goal_col)
+                    dy = abs(other / cols - goal_row)
+                    if dx < dy:
+                        heappush(open, (new_cost + dy + diagonal_step * dx, new_cost, other))
+                    else:
+                        heappush(open, (new_cost + dx + diagonal_step * dy, new_cost, other))
+
+        self.expanded_count = expanded_count
+        return []
+
+    def retrace(self, parents, i):
+        path = [i]
+        while parents[i] != -1:
+            i = parents[i]
+            path.append(i)
+        path.reverse()
+        return path
+
+    def refine(self, nodes, first_cell):
+        # Fills in the cells between each pair of graph nodes, the first pair
+        # leaving the start by first_cell
+        path = [nodes[0]]
+        if first_cell != nodes[0]:
+            path.append(first_cell)
+        for a, b in zip([first_cell] + nodes[1:-1], nodes[1:]):
+            cluster = self.get_cluster(a)
+            if cluster != self.get_cluster(b):
+                path.append(b)
+            elif a != b:
+                costs, parents = self.search_cluster(a, [b], cluster)
+                path.extend(self.retrace(parents, b)[1:])
+        return path
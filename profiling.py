@@ -0,0 +1,128 @@
+# Frame profiler for the debug overlay.  While enabled, records the time spent
+# in named sections of each frame and per-frame counters over a rolling
+# window, which the overlay shows as percentiles and export_trace writes as a
+# Chrome trace (load it in chrome://tracing).
+#
+# Sections are timed with the timed decorator or begin/end; nested sections
+# are recorded separately, so e.g. Tilemap.draw is also part of draw_world.
+
+import collections
+import functools
+import gc
+import json
+import timeit
+
+timer = timeit.default_timer
+
+class FrameProfiler(object):
+    def __init__(self, history=240):
+        self.enabled = False
+        self.history = history
+        self.times = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.frames = collections.deque(maxlen=history)
+        self.frame = None
+
+    def reset(self):
+        self.times.clear()
+        self.counters.clear()
+        self.frames.clear()
+        self.frame = None
+
+    def begin_frame(self):
+        if not self.enabled:
+            self.frame = None
+            return
+        self.frame = dict(start=timer(), events=[], counters={}, gc_count=gc.get_count()[0])
+
+    def end_frame(self):
+        frame = self.frame
+        if frame is None:
+            return
+        self.frame = None
+        end = timer()
+        self.add_event(frame, 'frame', frame['start'], end)
+
+        # Net number of objects tracked by the garbage collector allocated in
+        # the frame; a collection resets the count part way through
+        gc_count = gc.get_count()[0]
+        if gc_count < frame['gc_count']:
+            gc_count += gc.get_threshold()[0]
+        self.count('allocations', gc_count - frame['gc_count'], frame)
+
+        for name, value in frame['counters'].items():
+            self.get_samples(self.counters, name).append(value)
+        self.frames.append(frame)
+
+    def begin(self):
+        if self.frame is not None:
+            return timer()
+
+    def end(self, name, start):
+        if self.frame is not None and start is not None:
+            self.add_event(self.frame, name, start, timer())
+
+    def add_event(self, frame, name, start, end):
+        duration = (end - start) * 1000
+        frame['events'].append((name, start, duration))
+        self.get_samples(self.times, name).append(duration)
+
+    def count(self, name, value, frame=None):
+        frame = frame or self.frame
+        if frame is not None:
+            frame['counters'][name] = frame['counters'].get(name, 0) + value
+
+    def get_samples(self, samples, name):
+        if name not in samples:
+            samples[name] = collections.deque(maxlen=self.history)
+        return samples[name]
+
+    def timed(self, name):
+        # Decorator recording each call of the function as section name
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if self.frame is None:
+                    return func(*args, **kwargs)
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add_event(self.frame, name, start, timer())
+            return wrapper
+        return decorator
+
+    def get_summary(self):
+        # (name, last, p50, p95, p99) for each section in ms, then for each
+        # counter
+        return ([get_percentiles(name, samples) for name, samples in self.times.items()],
+                [get_percentiles(name, samples) for name, samples in self.counters.items()])
+
+    def export_trace(self, path):
+        if not self.frames:
+            return False
+        origin = self.frames[0]['start']
+        events = []
+        for frame in self.frames:
+            for name, start, duration in frame['events']:
+                events.append(dict(name=name, ph='X', pid=0, tid=0,
+                                   ts=(start - origin) * 1000000,
+                                   dur=duration * 1000))
+            events.append(dict(name='counters', ph='C', pid=0, tid=0,
+                               ts=(frame['start'] - origin) * 1000000,
+                               args=frame['counters']))
+        f = open(path, 'w')
+        try:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+        finally:
+            f.close()
+        return True
+
+def get_percentiles(name, samples):
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+    return (name, samples[-1], percentile(0.5), percentile(0.95), percentile(0.99))
+
+profiler = FrameProfiler()
+timed = profiler.timed
@@ -0,0 +1,192 @@
+# Compiles the Quest.ods Script table into opcode tuples at import time.
+#
+# Each trigger becomes a list of (opcode, args...) tuples, one per script row,
+# with params parsed and Jump/Reset labels resolved to row offsets.  World
+# dispatches on the opcode through World.script_ops, which holds one
+# World.script_<name> method per entry in opcode_names.
+
+opcode_names = [
+    'nop',
+    'say',
+    'player_say',
+    'message',
+    'quest_name',
+    'encounter',
+    'destroy',
+    'give_item',
+    'give_votes',
+    'give_spin',
+    'restore_votes',
+    'restore_spin',
+    'give_money',
+    'require_item',
+    'require_flag',
+    'set_flag',
+    'unset_flag',
+    'increment',
+    'require_count',
+    'learn_attack',
+    'add_ally',
+    'remove_ally',
+    'goto_map',
+    'begin_combat',
+    'shop',
+    'jump',
+    'save',
+    'play_sound',
+    'cheat_xp',
+    'cheat_stat',
+]
+
+opcodes = dict((name, i) for i, name in enumerate(opcode_names))
+
+# Who speaks the dialog of a failed Require* row
+speaker_sprite = 0
+speaker_player = 1
+speaker_none = 2
+
+cheat_stats = {
+    'CheatCunning': 'cunning',
+    'CheatWit': 'wit',
+    'CheatFlair': 'flair',
+    'CheatSpeed': 'speed',
+    'CheatCharisma': 'charisma',
+}
+
+class ScriptError(Exception):
+    def __init__(self, trigger, index, message):
+        super(ScriptError, self).__init__('Script "%s" row %d: %s' % (trigger, index + 1, message))
+        self.trigger = trigger
+        self.index = index
+
+def parse_int(value):
+    # Spreadsheet numbers arrive as floats, text params as strings
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('expected a number, got "%s"' % value)
+
+def split_param(param, count=2):
+    parts = [part.strip() for part in str(param).split(':')]
+    if len(parts) != count:
+        raise ValueError('expected %d ":" separated values, got "%s"' % (count, param))
+    return parts
+
+def split_optional_character(param):
+    # "attack" or "character:attack"
+    if ':' in str(param):
+        return split_param(param)
+    return None, str(param).strip()
+
+def require_key(table, key, kind):
+    if key not in table:
+        raise ValueError('unknown %s "%s"' % (kind, key))
+    return key
+
+def compile_row(data, row, labels):
+    action = row.action
+    param = row.param
+    dialog = row.dialog
+
+    if action.startswith('_') or action == 'Label':
+        return (opcodes['nop'],)
+    elif action == 'Say':
+        return (opcodes['say'], param or None, dialog)
+    elif action == 'PlayerSay':
+        return (opcodes['player_say'], dialog)
+    elif action == 'Message':
+        return (opcodes['message'], dialog)
+    elif action == 'QuestName':
+        return (opcodes['quest_name'], dialog)
+    elif action == 'Encounter':
+        return (opcodes['encounter'], require_key(data.encounters, param, 'encounter'))
+    elif action == 'Destroy':
+        return (opcodes['destroy'],)
+    elif action == 'GiveItem':
+        return (opcodes['give_item'], require_key(data.quest_items, param, 'quest item'), dialog)
+    elif action == 'GiveVotes':
+        return (opcodes['give_votes'], parse_int(param), dialog)
+    elif action == 'GiveSpin':
+        return (opcodes['give_spin'], parse_int(param), dialog)
+    elif action == 'RestoreVotes':
+        return (opcodes['restore_votes'], dialog)
+    elif action == 'RestoreSpin':
+        return (opcodes['restore_spin'], dialog)
+    elif action == 'GiveMoney':
+        return (opcodes['give_money'], parse_int(param), dialog)
+    elif action in ('RequireItem', 'RequireItemMessage', 'RequireItemPlayerSay'):
+        if action == 'RequireItemMessage':
+            speaker = speaker_none
+        elif action == 'RequireItemPlayerSay':
+            speaker = speaker_player
+        else:
+            speaker = speaker_sprite
+        return (opcodes['require_item'], require_key(data.quest_items, param, 'quest item'), speaker, dialog)
+    elif action in ('RequireFlag', 'RequireFlagPlayerSay'):
+        speaker = speaker_sprite if action == 'RequireFlag' else speaker_player
+        return (opcodes['require_flag'], param, speaker, dialog)
+    elif action == 'SetFlag':
+        return (opcodes['set_flag'], param)
+    elif action == 'UnsetFlag':
+        return (opcodes['unset_flag'], param)
+    elif action == 'Increment':
+        return (opcodes['increment'], param)
+    elif action == 'RequireCount':
+        name, required_value = split_param(param)
+        return (opcodes['require_count'], name, parse_int(required_value), dialog)
+    elif action == 'LearnAttack':
+        character_id, attack_id = split_optional_character(param)
+        if character_id is not None:
+            require_key(data.characters, character_id, 'character')
+        return (opcodes['learn_attack'], character_id, require_key(data.attacks, attack_id, 'attack'), dialog)
+    elif action == 'AddAlly':
+        character_id, level = split_param(param)
+        return (opcodes['add_ally'], require_key(data.characters, character_id, 'character'), parse_int(level), dialog)
+    elif action == 'RemoveAlly':
+        return (opcodes['remove_ally'], param, dialog)
+    elif action == 'GotoMap':
+        return (opcodes['goto_map'], param)
+    elif action == 'BeginCombat':
+        return (opcodes['begin_combat'],)
+    elif action == 'Shop':
+        return (opcodes['shop'], require_key(data.shops, param, 'shop'))
+    elif action in ('Jump', 'Reset'):
+        if param not in labels:
+            raise ValueError('unknown label "%s"' % param)
+        return (opcodes['jump'], labels[param], action == 'Reset')
+    elif action == 'Save':
+        return (opcodes['save'], param)
+    elif action == 'PlaySound':
+        return (opcodes['play_sound'], param)
+    elif action == 'CheatXP' or action in cheat_stats:
+        character_id, value = split_optional_character(param)
+        if character_id is not None:
+            require_key(data.characters, character_id, 'character')
+        if action == 'CheatXP':
+            return (opcodes['cheat_xp'], character_id, parse_int(value))
+        return (opcodes['cheat_stat'], character_id, cheat_stats[action], parse_int(value))
+    else:
+        raise ValueError('unsupported action "%s"' % action)
+
+def compile_trigger(data, trigger, rows):
+    labels = {}
+    for i, row in enumerate(rows):
+        if row.action == 'Label':
+            labels.setdefault(row.param, i)
+
+    code = []
+    for i, row in enumerate(rows):
+        try:
+            code.append(compile_row(data, row, labels))
+        except ValueError as e:
+            raise ScriptError(trigger, i, str(e))
+    return code
+
+def compile_script(data):
+    # Triggers starting with '#' are section comments in the spreadsheet
+    script_code = {}
+    for trigger, rows in data.script.items():
+        if trigger.startswith('#'):
+            continue
+        script_code[trigger] = compile_trigger(data, trigger, rows)
+    return script_code
@@ -0,0 +1,74 @@
+# Input recording and replay.  A recording logs every key event with the tick
+# it arrived before, along with the random seed, the fixed timestep and the
+# start scripts of the session.  Replaying feeds the same events to the game at
+# the same ticks, so a session plays out identically as long as it starts from
+# the same game data (and doesn't load a savegame).
+#
+# The file is plain text:
+#
+#   seed 1234
+#   timestep 0.0166666666667
+#   args ["START"]
+#   <tick> <key> <pressed>
+#   ...
+
+import collections
+import json
+
+default_timestep = 1.0 / 60
+
+class InputRecorder(object):
+    def __init__(self, path, seed, timestep, args):
+        self.timestep = timestep
+        self.file = open(path, 'w')
+        self.file.write('seed %d\n' % seed)
+        self.file.write('timestep %r\n' % timestep)
+        self.file.write('args %s\n' % json.dumps(list(args)))
+        self.file.flush()
+
+    def record(self, tick, key, pressed):
+        # Flushed each event so a crash still leaves the recording to replay
+        self.file.write('%d %d %d\n' % (tick, key, 1 if pressed else 0))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class InputReplay(object):
+    def __init__(self, path):
+        self.seed = 0
+        self.timestep = default_timestep
+        self.args = []
+        self.events = collections.deque()
+        self.last_tick = 0
+
+        f = open(path, 'r')
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                name, value = line.split(' ', 1)
+                if name == 'seed':
+                    self.seed = int(value)
+                elif name == 'timestep':
+                    self.timestep = float(value)
+                elif name == 'args':
+                    self.args = [str(arg) for arg in json.loads(value)]
+                else:
+                    tick, key, pressed = [int(part) for part in line.split()]
+                    self.events.append((tick, key, bool(pressed)))
+                    self.last_tick = tick
+        finally:
+            f.close()
+
+    @property
+    def done(self):
+        return not self.events
+
+    def get_events(self, tick):
+        # Events that arrived before the given tick
+        events = []
+        while self.events and self.events[0][0] <= tick:
+            events.append(self.events.popleft()[1:])
+        return events
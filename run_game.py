@@ -1 +1,2 @@
 import GoodnightMrPresident
+GoodnightMrPresident.run()
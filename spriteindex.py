@@ -0,0 +1,106 @@
+# The sprites of a world, bucketed by tile and by name so collision and script
+# lookups don't scan every sprite and only the sprites in the viewport are
+# drawn.
+#
+# Iterating the index gives the sprites in the order they were added, which
+# is also the order they are drawn in.  Sprite positions must be changed with
+# move() so the index stays in sync.
+
+class SpriteIndex(object):
+    def __init__(self, tile_size):
+        self.tile_size = tile_size
+        self.sprites = []
+        self.serials = {}
+        self.next_serial = 0
+        self.cells = {}
+        self.names = {}
+
+        # Tiles a sprite image may extend past its own cell, including when
+        # drawn rotated
+        self.margin = 0
+
+    def __iter__(self):
+        return iter(self.sprites)
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def __contains__(self, sprite):
+        return sprite in self.serials
+
+    def append(self, sprite):
+        self.serials[sprite] = self.next_serial
+        self.next_serial += 1
+        self.sprites.append(sprite)
+        self.add_to(self.cells, (sprite.x, sprite.y), sprite)
+        self.add_to(self.names, sprite.name, sprite)
+        if sprite.image:
+            size = max(sprite.image.width, sprite.image.height)
+            self.margin = max(self.margin, (size + self.tile_size - 1) / self.tile_size)
+
+    def remove(self, sprite):
+        self.remove_from(self.cells, (sprite.x, sprite.y), sprite)
+        self.remove_from(self.names, sprite.name, sprite)
+        self.sprites.remove(sprite)
+        del self.serials[sprite]
+
+    def clear(self):
+        del self.sprites[:]
+        self.serials.clear()
+        self.cells.clear()
+        self.names.clear()
+
+    def move(self, sprite, x, y):
+        self.remove_from(self.cells, (sprite.x, sprite.y), sprite)
+        sprite.x = x
+        sprite.y = y
+        self.add_to(self.cells, (x, y), sprite)
+
+    def add_to(self, buckets, key, sprite):
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [sprite]
+        else:
+            bucket.append(sprite)
+            if self.serials[bucket[-2]] > self.serials[sprite]:
+                bucket.sort(key=self.serials.get)
+
+    def remove_from(self, buckets, key, sprite):
+        bucket = buckets[key]
+        bucket.remove(sprite)
+        if not bucket:
+            del buckets[key]
+
+    def get_at(self, x, y):
+        bucket = self.cells.get((x, y))
+        if bucket:
+            return bucket[0]
+        return None
+
+    def get_named(self, name):
+        bucket = self.names.get(name)
+        if bucket:
+            return bucket[0]
+        return None
+
+    def get_visible(self, x1, y1, x2, y2):
+        # Sprites that may be drawn in the tile rectangle x1 <= x <= x2,
+        # y1 <= y <= y2, in draw order
+        margin = self.margin
+        x1 -= margin
+        y1 -= margin
+        x2 += margin
+        y2 += margin
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > len(self.sprites):
+            return [sprite for sprite in self.sprites
+                    if x1 <= sprite.x <= x2 and y1 <= sprite.y <= y2]
+
+        visible = []
+        cells = self.cells
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                bucket = cells.get((x, y))
+                if bucket:
+                    visible.extend(bucket)
+        visible.sort(key=self.serials.get)
+        return visible
@@ -0,0 +1,52 @@
+# Cached text layout.  Laying out a string builds a style, glyph run and glyph
+# layout and breaks it into lines, which is much slower than drawing it, and
+# most text on screen is the same from one frame to the next.
+#
+# Layouts are cached by font, text, box size and alignment, positioned at the
+# origin; they are drawn at their position with a translation so moving text
+# doesn't lay it out again.  The least recently used layouts are evicted once
+# more than max_size are cached.
+
+import collections
+
+import bacon
+
+class TextLayoutCache(object):
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.layouts = collections.OrderedDict()
+
+    def get(self, font, text, width=None, height=None, align=bacon.Alignment.left, vertical_align=bacon.VerticalAlignment.baseline):
+        key = (font, text, width, height, align, vertical_align)
+        glyph_layout = self.layouts.pop(key, None)
+        if glyph_layout is None:
+            run = bacon.GlyphRun(bacon.Style(font), text)
+            glyph_layout = bacon.GlyphLayout([run], 0, 0, width, height, align, vertical_align)
+            # Lay out now, so a cached layout is never laid out again
+            glyph_layout.lines
+            if len(self.layouts) >= self.max_size:
+                self.layouts.popitem(last=False)
+        self.layouts[key] = glyph_layout
+        return glyph_layout
+
+    def clear(self):
+        self.layouts.clear()
+
+text_cache = TextLayoutCache()
+
+def get_layout(font, text, width=None, height=None, align=bacon.Alignment.left, vertical_align=bacon.VerticalAlignment.baseline):
+    return text_cache.get(font, text, width, height, align, vertical_align)
+
+def measure_string(font, text):
+    return text_cache.get(font, text).content_width
+
+def draw_layout(glyph_layout, x, y):
+    # Snapped to whole pixels, as bacon does when laying out at a position
+    bacon.push_transform()
+    bacon.translate(int(x), int(y))
+    bacon.draw_glyph_layout(glyph_layout)
+    bacon.pop_transform()
+
+def draw_string(font, text, x, y, width=None, height=None, align=bacon.Alignment.left, vertical_align=bacon.VerticalAlignment.baseline):
+    # Same arguments as bacon.draw_string
+    draw_layout(text_cache.get(font, text, width, height, align, vertical_align), x, y)
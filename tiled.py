@@ -1,17 +1,18 @@
 import os.path
-import base64
-import gzip
-import struct
+import array
+import collections
 import xml.etree.cElementTree as ET
-import zlib
 
 import bacon
+import drawbatch
+import mapfile
 import tilemap
 
 class Tileset(object):
     def __init__(self, firstgid, images):
         self.firstgid = firstgid
         self.images = images
+        self.source_files = []
 
     @classmethod
     def get_cached_image(cls, path):
@@ -38,7 +39,7 @@ def parse_tileset_images(elem, base_dir):
     images = []
     for y in range(margin, image.height - margin, spacing + tile_height):
         for x in range(margin, image.width - margin, spacing + tile_width):
-            images.append(image.get_region(x, y, x + tile_width, y + tile_height))
+            images.append(drawbatch.set_atlas(image.get_region(x, y, x + tile_width, y + tile_height), image))
 
     return images
 
@@ -68,7 +69,10 @@ def parse_tileset_ref(elem, base_dir):
         tree = ET.parse(os.path.join(base_dir, source))
         elem = tree.getroot()
 
-    return parse_tileset_elem(firstgid, elem, base_dir)
+    tileset = parse_tileset_elem(firstgid, elem, base_dir)
+    if source:
+        tileset.source_files.append(os.path.join(base_dir, source))
+    return tileset
     
 def parse_tileset_elem(firstgid, elem, base_dir):
     images = parse_tileset_images(elem, base_dir)
@@ -77,32 +81,30 @@ def parse_tileset_elem(firstgid, elem, base_dir):
             id = int(child.get('id'))
             parse_tile(images[id], child)
 
-    return Tileset(firstgid, images)
+    tileset = Tileset(firstgid, images)
+    for child in elem:
+        if child.tag == 'image':
+            tileset.source_files.append(os.path.join(base_dir, child.get('source')))
+    return tileset
 
-def get_tileset_image(tilesets, gid):
-    matching_tileset = None
+def get_gid_images(tilesets):
+    # Dense gid -> image table, built once per map so resolving a gid is a
+    # list index.  Tilesets are in firstgid order; gid 0 and gaps are None.
+    gid_images = [None]
     for tileset in tilesets:
-        if gid < tileset.firstgid:
-            break
-        matching_tileset = tileset
+        if len(gid_images) < tileset.firstgid:
+            gid_images.extend([None] * (tileset.firstgid - len(gid_images)))
+        gid_images[tileset.firstgid:] = tileset.images
+    return gid_images
 
-    if matching_tileset:
-        return matching_tileset.images[gid - matching_tileset.firstgid]
-
-def parse_layer(tm, elem, tilesets):
+def parse_layer(tm, elem, gid_images):
     name = elem.get('name')
     cols = int(elem.get('width'))
     rows = int(elem.get('height'))
     layer = tilemap.TilemapLayer(name, cols, rows)
     tm.layers.append(layer)
 
-    tx = 0
     ty = 0
-    tiles = []
-    
-    def add_tile(gid):
-        image = get_tileset_image(tilesets, gid)
-        layer.images[ty * tm.cols + tx] = image
 
     for child in elem:
         if child.tag == 'properties':
@@ -115,28 +117,17 @@ def parse_layer(tm, elem, tilesets):
                         layer.offset_y = -tm.tile_height * int(value)
                         ty += int(value)
         elif child.tag == 'data':
-            encoding = child.get('encoding')
-            if encoding == 'base64':
-                data = base64.b64decode(child.text)
-                compression = child.get('compression')
-                if compression == 'gzip':
-                    data = gzip.decompress(data)
-                elif compression == 'zlib':
-                    data = zlib.decompress(data)
-                for gid in struct.unpack('%dI' % (len(data) / 4), data):
-                    add_tile(gid)
-                    tx += 1
-                    if tx >= cols:
-                        tx = 0
-                        ty += 1
-            else:
-                for tile in child:
-                    if tile.tag == 'tile':
-                        add_tile(int(tile.get('gid')))
-                        tx += 1
-                        if tx >= cols:
-                            tx = 0
-                            ty += 1
+            # Resolve the whole gid array in one pass, then copy it in by row.
+            # Rows a 'Y' offset pushes past the bottom of the map are dropped,
+            # as mapfile does.
+            images = [gid_images[gid] for gid in mapfile.decode_layer_data(child)]
+            size = len(layer.images)
+            for i in range(0, len(images), cols):
+                start = (ty + i / cols) * tm.cols
+                if start >= size:
+                    break
+                end = min(start + cols, size)
+                layer.images[start:end] = images[i:i + end - start]
 
     if layer.name == 'Collision' or layer.name == 'Water':
         if layer.name == 'Collision':
@@ -145,15 +136,9 @@ def parse_layer(tm, elem, tilesets):
             if layer.images[i]:
                 try:
                     collision_type = layer.images[i].properties['Collision']
-                    if collision_type == 'All':
-                        tm.tiles[i].walkable = False
-                    elif collision_type == 'Animal':
-                        tm.tiles[i].walkable_animal = False
-                    elif collision_type == 'Villager':
-                        tm.tiles[i].walkable_villager = False
-                    elif collision_type == 'Entrance':
-                        tm.tiles[i].walkable_entrance = False
-                        tm.tiles[i].entrance_owner = layer.images[i].properties['Entrance']
+                    tm.collision[i] |= mapfile.walkable_flags.get(collision_type, 0)
+                    if collision_type == 'Entrance':
+                        tm.entrances[i] = layer.images[i].properties['Entrance']
                 except KeyError:
                     pass
                 except AttributeError:
@@ -173,7 +158,7 @@ def parse_object_group(tm, elem):
             tilemap_object = tilemap.TilemapObject(name, type, x, y, width, height)
             gid = int(object.get('gid', -1))
             if gid != -1:
-                tilemap_object.image = get_tileset_image(tm.tilesets, gid)
+                tilemap_object.image = tm.gid_images[gid]
             layer.objects.append(tilemap_object)
             for child in object:
                 if child.tag == 'properties':
@@ -183,9 +168,86 @@ def parse_object_group(tm, elem):
                             value = property.get('value')
                             tilemap_object.properties[name] = value
 
+def get_map_size(tm):
+    # Rough estimate of the memory held by a parsed map, in bytes
+    cells = tm.cols * tm.rows
+    objects = sum(len(layer.objects) for layer in tm.object_layers)
+    return cells * (len(tm.layers) * 8 + 1) + objects * 512
+
+class MapCache(object):
+    # Parsed maps by path.  The least recently used maps are evicted once the
+    # estimated size of all cached maps is over max_size bytes.
+    def __init__(self, max_size=4 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.maps = collections.OrderedDict()
+
+    def get(self, path):
+        tm = self.maps.pop(path, None)
+        if tm is not None:
+            self.maps[path] = tm
+        return tm
+
+    def add(self, path, tm):
+        self.discard(path)
+        self.maps[path] = tm
+        self.size += get_map_size(tm)
+        while self.size > self.max_size and len(self.maps) > 1:
+            evicted_path, evicted = self.maps.popitem(last=False)
+            self.size -= get_map_size(evicted)
+
+    def discard(self, path):
+        tm = self.maps.pop(path, None)
+        if tm is not None:
+            self.size -= get_map_size(tm)
+
+    def invalidate(self, paths):
+        # Discards maps built from any of paths
+        paths = set(os.path.abspath(path) for path in paths)
+        for path, tm in self.maps.items():
+            if any(os.path.abspath(source) in paths for source in tm.source_files):
+                self.discard(path)
+
+map_cache = MapCache()
+
 def parse(tmx_file):
+    # Returns a copy-on-write view of the cached map, see Tilemap.copy
+    tmx_file = bacon.get_resource_path(tmx_file)
+    tm = map_cache.get(tmx_file)
+    if tm is None:
+        tm = load(tmx_file)
+        map_cache.add(tmx_file, tm)
+    return tm.copy()
+
+def get_map_textures(tmx_file):
+    # Tileset images the map uses, without loading them or the map.  Tilesets
+    # come before the layers, so only the start of the file is read.
     tmx_file = bacon.get_resource_path(tmx_file)
     base_dir = os.path.dirname(tmx_file)
+    textures = []
+    for event, elem in ET.iterparse(tmx_file, events=('start', 'end')):
+        if event == 'start' and elem.tag in ('layer', 'objectgroup'):
+            break
+        if event == 'end' and elem.tag == 'tileset':
+            source = elem.get('source')
+            if source:
+                elem = ET.parse(os.path.join(base_dir, source)).getroot()
+            for child in elem:
+                if child.tag == 'image':
+                    textures.append(os.path.join(base_dir, child.get('source')))
+    return textures
+
+def load(tmx_file):
+    # Loads the compiled map instead while it is up to date, see mapfile
+    compiled_file = mapfile.get_compiled_path(tmx_file)
+    if os.path.exists(compiled_file):
+        compiled = mapfile.read_map(compiled_file)
+        if compiled and mapfile.is_up_to_date(compiled_file, compiled):
+            return load_compiled(compiled, os.path.dirname(tmx_file))
+    return parse_tmx(tmx_file)
+
+def parse_tmx(tmx_file):
+    base_dir = os.path.dirname(tmx_file)
 
     tree = ET.parse(tmx_file)
     elem = tree.getroot()
@@ -198,16 +260,65 @@ def parse(tmx_file):
 
     tm = tilemap.Tilemap(tile_width, tile_height, cols, rows)
     tm.tilesets = []
+    tm.gid_images = [None]
     layers = []
     object_layers = []
 
     for child in elem:
         if child.tag == 'tileset':
             tm.tilesets.append(parse_tileset_ref(child, base_dir))
+            tm.gid_images = get_gid_images(tm.tilesets)
         elif child.tag == 'layer':
-            parse_layer(tm, child, tm.tilesets)
+            parse_layer(tm, child, tm.gid_images)
         elif child.tag == 'objectgroup':
             parse_object_group(tm, child)
-        
+
+    for layer in tm.layers:
+        if layer.name in mapfile.non_collision_layers:
+            continue
+        for i, image in enumerate(layer.images):
+            if image and hasattr(image, 'properties'):
+                tm.collision[i] |= mapfile.get_collision_mask(image.properties)
+
+    # Files the map was built from, for reloading it when one changes
+    tm.source_files = [tmx_file]
+    for tileset in tm.tilesets:
+        tm.source_files.extend(tileset.source_files)
                     
     return tm
+
+def load_compiled(compiled, base_dir):
+    cols = compiled['cols']
+    rows = compiled['rows']
+    tm = tilemap.Tilemap(compiled['tile_width'], compiled['tile_height'], cols, rows)
+    tm.tilesets = []
+    tm.source_files = [os.path.join(base_dir, path) for path in compiled['source_files']]
+
+    tileset_images = [Tileset.get_cached_image(os.path.join(base_dir, path)) for path in compiled['tilesets']]
+    images = [None]
+    for tileset_index, (x1, y1, x2, y2), properties in compiled['tiles']:
+        image = drawbatch.set_atlas(tileset_images[tileset_index].get_region(x1, y1, x2, y2), tileset_images[tileset_index])
+        if properties:
+            image.properties = dict(properties)
+        images.append(image)
+
+    for name, properties, offset_y, cells in compiled['layers']:
+        layer = tilemap.TilemapLayer(name, cols, rows)
+        layer.properties = dict(properties)
+        layer.offset_y = offset_y
+        layer.images = [images[i] for i in array.array('H', cells)]
+        tm.layers.append(layer)
+
+    for name, objects in compiled['object_layers']:
+        layer = tilemap.TilemapObjectLayer(name)
+        for name, type, x, y, width, height, tile_index, properties in objects:
+            tilemap_object = tilemap.TilemapObject(name, type, x, y, width, height)
+            if tile_index != -1:
+                tilemap_object.image = images[tile_index]
+            tilemap_object.properties = dict(properties)
+            layer.objects.append(tilemap_object)
+        tm.object_layers.append(layer)
+
+    tm.collision = array.array('B', compiled['collision'])
+    tm.entrances = dict(compiled['entrances'])
+    return tm
@@ -1,51 +1,142 @@
 from math import floor
+import array
 import bisect
-import heapq
 
 import bacon
 from common import Rect
+import collision
+import drawbatch
+import flowfield
+import mapfile
+import pathfind
+import profiling
 
 class Tile(object):
+    # View of a cell of a map, created by Tilemap.tiles on first use.  The
+    # cell's state is in the map's per-cell arrays, so most cells never need
+    # a Tile.  The tile at index cols * rows stands for everywhere off the map.
+    __slots__ = ['tiles', 'index', 'tx', 'ty']
+
     path_cost = 1
-    path_parent = None
-
-    walkable_animal = True
-    walkable_villager = True
-    walkable_entrance = True
-    entrance_owner = None
-    _walkable = True
-
-    def __init__(self, tx, ty, rect, walkable=True, accept_items=True):
-        self.tx = tx
-        self.ty = ty
-        self.rect = rect
-        if not walkable:
-            self._walkable = walkable
-        self.accept_items = accept_items
-        self.can_target = True
-        self.items = []
+
+    def __init__(self, tiles, index):
+        self.tiles = tiles
+        self.index = index
+        if index < tiles.cell_count:
+            self.tx = index % tiles.map.cols
+            self.ty = index / tiles.map.cols
+        else:
+            self.tx = self.ty = -1
 
     def __lt__(self, other):
         return (self.tx, self.ty) < (other.tx, other.ty)
 
+    @property
+    def rect(self):
+        if self.tx < 0:
+            return Rect(0, 0, 0, 0)
+        tm = self.tiles.map
+        x = self.tx * tm.tile_width
+        y = self.ty * tm.tile_height
+        return Rect(x, y, x + tm.tile_width, y + tm.tile_height)
+
+    @property
+    def accept_items(self):
+        return self.tx >= 0
+
+    @property
+    def can_target(self):
+        return self.tx >= 0
+
+    @property
+    def items(self):
+        return self.tiles.items.get(self.index, ())
+
+    def get_flags(self):
+        if self.tx < 0:
+            return 0
+        return self.tiles.map.collision_model.flags[self.index]
+
     def is_walkable(self):
-        return self._walkable and all(item.walkable for item in self.items)
+        if self.tx < 0 or not self.tiles.map.collision_model.walkable['all'][self.index]:
+            return False
+        return not self.tiles.item_counts[self.index] or all(item.walkable for item in self.items)
     def set_walkable(self, walkable):
-        self._walkable = walkable
+        if self.tx >= 0:
+            self.tiles.map.set_walkable(self.index, walkable)
     walkable = property(is_walkable, set_walkable)
 
+    @property
+    def walkable_animal(self):
+        return not self.get_flags() & mapfile.unwalkable_animal
+
+    @property
+    def walkable_villager(self):
+        return not self.get_flags() & mapfile.unwalkable_villager
+
+    @property
+    def walkable_entrance(self):
+        return not self.get_flags() & mapfile.unwalkable_entrance
+
+    @property
+    def entrance_owner(self):
+        if self.get_flags() & mapfile.unwalkable_entrance:
+            return self.tiles.map.entrances.get(self.index)
+        return None
+
     def add_item(self, item):
-        self.items.append(item)
-        item.x = self.rect.center_x
-        item.y = self.rect.center_y
+        self.tiles.items.setdefault(self.index, []).append(item)
+        self.tiles.item_counts[self.index] += 1
+        rect = self.rect
+        item.x = rect.center_x
+        item.y = rect.center_y
 
     def remove_item(self, item):
-        try:
-            self.items.remove(item)
-        except ValueError:
-            pass
+        items = self.tiles.items.get(self.index)
+        if items and item in items:
+            items.remove(item)
+            self.tiles.item_counts[self.index] -= 1
+            if not items:
+                del self.tiles.items[self.index]
+
+class TileList(object):
+    # The tiles of a map, indexed as the cells are.  Item counts are kept per
+    # cell so walkability only looks at the items of cells that have some.
+    # A Tile is created the first time its cell is looked at and kept, so a
+    # cell always gives the same Tile.
+    def __init__(self, tilemap):
+        self.map = tilemap
+        self.cell_count = tilemap.cols * tilemap.rows
+        self.item_counts = array.array('H', [0]) * (self.cell_count + 1)
+        self.items = {}
+        self.views = {}
+
+    def __len__(self):
+        return self.cell_count + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get(i) for i in range(*index.indices(self.cell_count + 1))]
+        if index < 0:
+            index += self.cell_count + 1
+        if not 0 <= index <= self.cell_count:
+            raise IndexError(index)
+        return self.get(index)
+
+    def __iter__(self):
+        for i in range(self.cell_count + 1):
+            yield self.get(i)
+
+    def get(self, index):
+        # As tiles[index], for an index known to be in range
+        tile = self.views.get(index)
+        if tile is None:
+            tile = self.views[index] = Tile(self, index)
+        return tile
 
 class TilemapObject(object):
+    __slots__ = ['name', 'type', 'x', 'y', 'width', 'height', 'image', 'properties']
+
     def __init__(self, name, type, x, y, width=0, height=0):
         self.name = name
         self.type = type
@@ -67,12 +158,38 @@ class TilemapLayer(object):
         self.images = [None] * (cols * rows)
         self.properties = {}
         self.offset_y = 0
+        self.shared = False
+
+    def copy(self):
+        # The copy shares images until either layer changes a tile
+        layer = TilemapLayer.__new__(TilemapLayer)
+        layer.__dict__.update(self.__dict__)
+        layer.shared = self.shared = True
+        return layer
+
+    def set_image(self, index, image):
+        if self.shared:
+            self.images = list(self.images)
+            self.shared = False
+        self.images[index] = image
 
 class TilemapScanline(object):
     def __init__(self):
         self.sprites = []
 
+identity_transform = [1, 0, 0, 0,
+                      0, 1, 0, 0,
+                      0, 0, 1, 0,
+                      0, 0, 0, 1]
+
 class Tilemap(object):
+    # Width and height, in tiles, of the pre-rendered regions draw uses
+    chunk_size = 16
+    # Width and height, in tiles, of the clusters of the pathfinding region
+    # graph; paths between cells further apart than eight clusters use it, as
+    # shorter searches are quicker on the cells themselves
+    path_cluster_size = 8
+
     def __init__(self, tile_width, tile_height, cols, rows):
         self.tile_width = tile_width
         self.tile_height = tile_height
@@ -81,30 +198,90 @@ class Tilemap(object):
         self.layers = []
         self.object_layers = []
         self.scanlines = [TilemapScanline() for row in range(rows)]
+        self.scanline_sprite_count = 0
         self.sprite_layer_index = 6
+        self.chunks = {}
+        self.chunk_layers = []
 
-        self.tiles = []
-        y = 0
-        for row in range(rows):
-            x = 0
-            for col in range(cols):
-                self.tiles.append(Tile(col, row, Rect(x, y, x + tile_width, y + tile_height)))
-                x += tile_width
-            y += tile_height
+        # Per-cell mapfile collision and walkability flags, and the owners of
+        # entrance cells
+        self.collision = array.array('B', [0] * (cols * rows))
+        self.entrances = {}
+        self._tiles = None
 
-        # default tile
-        self.tiles.append(Tile(-1, -1, Rect(0, 0, 0, 0), walkable=False, accept_items=False))
-        self.tiles[-1].can_target = False
+        # Built from collision on first use, once for a map and all its
+        # copies, which share it until one changes walkability; see
+        # collision.py
+        self._collision_model = None
+        self.collision_model_shared = False
+        self.source_map = None
+        self._path_finder = None
+        self._region_graphs = {}
+        self._flow_fields = None
+
+    def copy(self):
+        # Copy-on-write view of a loaded map: layer images, tilesets, objects
+        # and collision are shared, the layer list, tiles and sprites are not
+        tm = Tilemap.__new__(Tilemap)
+        tm.__dict__.update(self.__dict__)
+        tm.layers = [layer.copy() for layer in self.layers]
+        tm.scanlines = [TilemapScanline() for row in range(self.rows)]
+        tm.scanline_sprite_count = 0
+        tm.chunks = {}
+        tm.chunk_layers = []
+        tm._tiles = None
+        tm.source_map = self.source_map or self
+        if self._collision_model is not None:
+            tm.collision_model_shared = self.collision_model_shared = True
+        tm._path_finder = None
+        tm._region_graphs = {}
+        tm._flow_fields = None
+        return tm
+
+    @property
+    def tiles(self):
+        # Created on first use, as drawing and collision don't need them
+        if self._tiles is None:
+            self._tiles = self.create_tiles()
+        return self._tiles
+
+    @property
+    def collision_model(self):
+        if self._collision_model is None:
+            if self.source_map is not None:
+                self._collision_model = self.source_map.collision_model
+                self.collision_model_shared = self.source_map.collision_model_shared = True
+            else:
+                self._collision_model = collision.CollisionModel(self.cols, self.rows, self.collision)
+        return self._collision_model
+
+    def set_walkable(self, index, walkable):
+        # Changes walkability for movement and pathfinding as well as the tile
+        model = self.collision_model
+        if self.collision_model_shared:
+            model = self._collision_model = model.copy()
+            self.collision_model_shared = False
+        model.set_walkable(index, walkable)
+        for graph in self._region_graphs.values():
+            graph.model = model
+            graph.invalidate(index)
+        if self._flow_fields is not None:
+            self._flow_fields.invalidate(model)
+
+    def create_tiles(self):
+        return TileList(self)
 
     def add_sprite(self, sprite):
         scan = int(floor(sprite.y / self.tile_height))
         sprite._scanline = scan
         bisect.insort(self.scanlines[scan].sprites, sprite)
+        self.scanline_sprite_count += 1
 
     def remove_sprite(self, sprite):
         try:
             oldscan = sprite._scanline
             self.scanlines[oldscan].sprites.remove(sprite)
+            self.scanline_sprite_count -= 1
         except:
             pass
 
@@ -121,11 +298,11 @@ class Tilemap(object):
         ty = floor(y / self.tile_height)
         if (tx < 0 or tx >= self.cols or
             ty < 0 or ty >= self.rows):
-            return len(self.tiles) - 1
+            return self.cols * self.rows
         return int(ty * self.cols + tx)
 
     def get_tile_at(self, x, y):
-        return self.tiles[self.get_tile_index(x, y)]
+        return self.tiles.get(self.get_tile_index(x, y))
 
     def get_tile_rect(self, x, y):
         tx = floor(x / self.tile_width)
@@ -137,24 +314,124 @@ class Tilemap(object):
     def get_bounds(self):
         return Rect(0, 0, self.cols * self.tile_width, self.rows * self.tile_height)
 
+    def set_tile_image(self, layer, index, image):
+        layer.set_image(index, image)
+        self.chunks.pop(((index % self.cols) / self.chunk_size, (index / self.cols) / self.chunk_size), None)
+
+    def can_draw_chunks(self):
+        # Chunks hold every layer, so they can't be used when sprites must be
+        # drawn between the ground and overlay layers, or a layer is offset
+        # into the row above
+        if self.scanline_sprite_count:
+            return False
+        for layer in self.layers:
+            if layer.offset_y:
+                return False
+        return True
+
+    def bake_chunk(self, cx, cy):
+        tile_width = self.tile_width
+        tile_height = self.tile_height
+        tx1 = cx * self.chunk_size
+        ty1 = cy * self.chunk_size
+        tx2 = min(self.cols, tx1 + self.chunk_size)
+        ty2 = min(self.rows, ty1 + self.chunk_size)
+
+        # Empty regions are remembered as False and not drawn
+        if not any(layer.images[ty * self.cols + tx]
+                   for layer in self.layers
+                   for ty in range(ty1, ty2)
+                   for tx in range(tx1, tx2)):
+            self.chunks[cx, cy] = False
+            return False
+
+        chunk = bacon.Image(width=(tx2 - tx1) * tile_width, height=(ty2 - ty1) * tile_height, sample_nearest=True, atlas=0)
+
+        bacon.push_target(chunk)
+        bacon.push_transform()
+        bacon.set_transform(identity_transform)
+        bacon.push_color()
+        bacon.set_color(1, 1, 1, 1)
+        bacon.clear(0, 0, 0, 0)
+        batch = drawbatch.batch
+        for layer in self.layers:
+            images = layer.images
+            for ty in range(ty1, ty2):
+                ti = ty * self.cols + tx1
+                y1 = (ty - ty1) * tile_height
+                for tx in range(tx1, tx2):
+                    image = images[ti]
+                    if image:
+                        x1 = (tx - tx1) * tile_width
+                        batch.add(image, x1, y1, x1 + tile_width, y1 + tile_height)
+                    ti += 1
+            batch.split()
+        batch.flush()
+        bacon.pop_color()
+        bacon.pop_transform()
+        bacon.pop_target()
+
+        self.chunks[cx, cy] = chunk
+        return chunk
+
+    def draw_chunks(self, rect):
+        chunk_width = self.chunk_size * self.tile_width
+        chunk_height = self.chunk_size * self.tile_height
+        cx1 = max(0, int(floor(rect.x1 / chunk_width)))
+        cy1 = max(0, int(floor(rect.y1 / chunk_height)))
+        cx2 = min((self.cols + self.chunk_size - 1) / self.chunk_size, int(floor(rect.x2 / chunk_width)) + 1)
+        cy2 = min((self.rows + self.chunk_size - 1) / self.chunk_size, int(floor(rect.y2 / chunk_height)) + 1)
+        # Bake before adding to the batch, as baking flushes it
+        for cy in range(cy1, cy2):
+            for cx in range(cx1, cx2):
+                if (cx, cy) not in self.chunks:
+                    self.bake_chunk(cx, cy)
+
+        batch = drawbatch.batch
+        for cy in range(cy1, cy2):
+            for cx in range(cx1, cx2):
+                chunk = self.chunks[cx, cy]
+                if chunk:
+                    batch.add(chunk, cx * chunk_width, cy * chunk_height)
+        batch.flush()
+
+    @profiling.timed('Tilemap.draw')
     def draw(self, rect):
+        # Layers are static once the map is loaded, so they are drawn from
+        # pre-rendered chunks where possible; set_tile_image or a change to
+        # the layer list rebakes them.
+        if self.layers != self.chunk_layers:
+            self.chunks = {}
+            self.chunk_layers = list(self.layers)
+        if self.can_draw_chunks():
+            self.draw_chunks(rect)
+            return
+
         tx1 = max(0, int(floor(rect.x1 / self.tile_width)))
         ty1 = max(0, int(floor(rect.y1 / self.tile_height)))
         tx2 = min(self.cols, int(floor(rect.x2 / self.tile_width)) + 1)
         ty2 = min(self.rows, int(floor(rect.y2 / self.tile_height)) + 5)
-        sprite_layer_index = self.sprite_layer_index
+        tile_width = self.tile_width
+        tile_height = self.tile_height
+        ground_layers = self.layers[:self.sprite_layer_index]
+        overlay_layers = self.layers[self.sprite_layer_index:]
+        batch = drawbatch.batch
         for ty in range(ty1, ty2):
-            ti = ty * self.cols + tx1
+            y1 = ty * tile_height
+            y2 = y1 + tile_height
 
             # Draw ground tiles
-            for tx in range(tx1, tx2):
-                tile = self.tiles[ti]
-                r = tile.rect
-                for layer in self.layers[:sprite_layer_index]:
-                    image = layer.images[ti]
+            for layer in ground_layers:
+                images = layer.images
+                ti = ty * self.cols + tx1
+                for tx in range(tx1, tx2):
+                    image = images[ti]
                     if image:
-                        bacon.draw_image(image, r.x1, r.y1, r.x2, r.y2)
-                ti += 1
+                        x1 = tx * tile_width
+                        batch.add(image, x1, y1, x1 + tile_width, y2)
+                    ti += 1
+                batch.split()
+            batch.flush()
 
             # Draw sorted scanline sprites
             scanline = self.scanlines[ty]
@@ -164,71 +441,68 @@ class Tilemap(object):
                     sprite.draw()
 
             # Overlay tiles
-            ti = ty * self.cols + tx1
-            for tx in range(tx1, tx2):
-                tile = self.tiles[ti]
-                r = tile.rect
-                for layer in self.layers[sprite_layer_index:]:
-                    image = layer.images[ti]
+            for layer in overlay_layers:
+                images = layer.images
+                ti = ty * self.cols + tx1
+                for tx in range(tx1, tx2):
+                    image = images[ti]
                     if image:
-                        bacon.draw_image(image, r.x1, r.y1 + layer.offset_y, r.x2, r.y2 + layer.offset_y)
-                ti += 1
-
-    def get_path(self, start_tile, arrived_func, heuristic_func, max_size):
-        # http://stackoverflow.com/questions/4159331/python-speed-up-an-a-star-pathfinding-algorithm
-        
-        def retrace(c):
-            path = [c]
-            while c.path_parent is not None:
-                c = c.path_parent
-                path.append(c)
-            path.reverse()
-            return path
-        
-        def candidates(tile):
-            tx = tile.tx
-            ty = tile.ty
-            i = ty * self.cols + tx
-            left = right = up = down = None
-            if tx > 0:
-                left = self.tiles[i - 1]
-                yield left
-            if tx < self.cols - 1:
-                right = self.tiles[i + 1]
-                yield right
-            if ty > 0:
-                up = self.tiles[i - self.cols]
-                yield up
-            if ty < self.rows - 1:
-                down = self.tiles[i + self.cols]
-                yield down
-            if left and left.walkable:
-                if up and up.walkable:
-                    yield self.tiles[i - self.cols - 1]
-                if down and down.walkable:
-                    yield self.tiles[i + self.cols - 1]
-            if right and right.walkable:
-                if up and up.walkable:
-                    yield self.tiles[i - self.cols + 1]
-                if down and down.walkable:
-                    yield self.tiles[i + self.cols + 1]
-
-        closed = set()
-        open_set = set()
-        open = []
-        open.append((0, start_tile))
-        start_tile.path_parent = None
-        while open and max_size >= 0:
-            max_size -= 1
-            score, current = heapq.heappop(open)
-            if arrived_func(current):
-                return retrace(current)
-            
-            closed.add(current)
-            for tile in candidates(current):
-                if tile not in closed and tile not in open_set:
-                    g = heuristic_func(tile)
-                    open_set.add(tile)
-                    heapq.heappush(open, (score + g + 1, tile))
-                    tile.path_parent = current
-        return []
+                        x1 = tx * tile_width
+                        batch.add(image, x1, y1 + layer.offset_y, x1 + tile_width, y2 + layer.offset_y)
+                    ti += 1
+                batch.split()
+            batch.flush()
+
+    def get_path_finder(self):
+        if self._path_finder is None:
+            self._path_finder = pathfind.PathFinder(self.cols, self.rows)
+        return self._path_finder
+
+    def get_path(self, start_tile, arrived_func, heuristic_func, max_size, movement_class='all'):
+        # Tiles from start_tile to the first tile arrived_func accepts, through
+        # tiles movement_class can walk on and expanding at most max_size of
+        # them; see pathfind
+        tiles = self.tiles
+        if start_tile.tx < 0:
+            return []
+        model = self.collision_model
+        get_tile = tiles.get
+        path = self.get_path_finder().find(model.walkable[movement_class],
+                                           model.exits,
+                                           start_tile.ty * self.cols + start_tile.tx,
+                                           lambda i: arrived_func(get_tile(i)),
+                                           lambda i: heuristic_func(get_tile(i)),
+                                           max_size)
+        return [get_tile(i) for i in path]
+
+    def get_region_graph(self, movement_class='all'):
+        # Built on the first long path search, see pathfind.RegionGraph
+        graph = self._region_graphs.get(movement_class)
+        if graph is None:
+            graph = pathfind.RegionGraph(self.collision_model, movement_class, self.path_cluster_size)
+            self._region_graphs[movement_class] = graph
+        return graph
+
+    def find_path(self, start_index, goal_index, max_size, movement_class='all'):
+        # Cell indices from start_index to goal_index, without creating tiles.
+        # Long paths are found through the region graph, where max_size bounds
+        # the graph nodes expanded rather than cells.
+        model = self.collision_model
+        if pathfind.get_octile_distance(self.cols, start_index, goal_index) > self.path_cluster_size * 8:
+            return self.get_region_graph(movement_class).find(start_index, goal_index, max_size)
+        return self.get_path_finder().find_to(model.walkable[movement_class], model.exits, start_index, goal_index, max_size)
+
+    @property
+    def flow_fields(self):
+        if self._flow_fields is None:
+            self._flow_fields = flowfield.FlowFieldCache(self.collision_model)
+        return self._flow_fields
+
+    def get_flow_field(self, goal_index, movement_class='all'):
+        # For any number of movers heading to goal_index; the field is built
+        # over the following frames by update_flow_fields, see flowfield
+        return self.flow_fields.get(goal_index, movement_class)
+
+    def update_flow_fields(self):
+        if self._flow_fields is not None:
+            self._flow_fields.update()
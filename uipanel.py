@@ -0,0 +1,54 @@
+# Retained UI panels.  A panel is rendered once into a texture and the texture
+# is drawn each frame, until the state it was rendered from changes.
+#
+# The state is a tuple of every value the panel shows, built by the caller each
+# frame; comparing it is much cheaper than formatting, laying out and drawing
+# the text and border tiles of the panel again.
+
+import bacon
+
+identity_transform = [1, 0, 0, 0,
+                      0, 1, 0, 0,
+                      0, 0, 1, 0,
+                      0, 0, 0, 1]
+
+class RetainedPanel(object):
+    def __init__(self, draw_func):
+        # draw_func(*state) draws the panel in screen coordinates
+        self.draw_func = draw_func
+        self.image = None
+        self.bounds = None
+        self.state = None
+        self.render_count = 0
+
+    def invalidate(self):
+        self.state = None
+
+    def draw(self, bounds, state):
+        # bounds is the screen rectangle draw_func draws within
+        x1, y1, x2, y2 = bounds
+        if bounds != self.bounds:
+            self.image = bacon.Image(width=int(x2 - x1), height=int(y2 - y1), sample_nearest=True, atlas=0)
+            self.bounds = bounds
+            self.state = None
+
+        if state != self.state:
+            self.render(state)
+
+        bacon.draw_image(self.image, x1, y1, x2, y2)
+
+    def render(self, state):
+        x1, y1, x2, y2 = self.bounds
+        bacon.push_target(self.image)
+        bacon.push_transform()
+        bacon.set_transform(identity_transform)
+        bacon.translate(-x1, -y1)
+        bacon.push_color()
+        bacon.set_color(1, 1, 1, 1)
+        bacon.clear(0, 0, 0, 0)
+        self.draw_func(*state)
+        bacon.pop_color()
+        bacon.pop_transform()
+        bacon.pop_target()
+        self.state = state
+        self.render_count += 1